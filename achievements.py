@@ -0,0 +1,82 @@
+"""
+Правила достижений по счетчикам пользователя, обновляемым при каждой записи
+"""
+
+from typing import Iterable, List
+from config import FAST_FOOD_CATEGORY, SMART_SPENDER_DAYS
+
+SECONDS_PER_DAY = 86400
+
+# Бит достижения в achievement_progress.earned; новые достижения добавляются только в конец
+ACHIEVEMENT_BITS = {achievement_id: 1 << bit for bit, achievement_id in enumerate(
+    ('first_save', 'week_saver', 'goal_reached', 'smart_spender', 'big_saver'))}
+
+class AchievementProgress:
+    """Счетчики, по которым каждое правило проверяется за O(1)
+
+    week, week_income, week_expense - последняя неделя с операциями и ее суммы
+    в копейках; fast_food_since - время последней траты на фастфуд (или первой
+    операции, если таких трат не было); earned - биты уже выданных достижений.
+    """
+
+    __slots__ = ('week', 'week_income', 'week_expense', 'fast_food_since', 'earned')
+
+    def __init__(self, week: int, week_income: int = 0, week_expense: int = 0,
+                 fast_food_since: int = 0, earned: int = 0):
+        self.week = week
+        self.week_income = week_income
+        self.week_expense = week_expense
+        self.fast_food_since = fast_food_since
+        self.earned = earned
+
+    def __repr__(self) -> str:
+        return (f"AchievementProgress(week={self.week}, week_income={self.week_income}, "
+                f"week_expense={self.week_expense}, fast_food_since={self.fast_food_since}, "
+                f"earned={self.earned:#x})")
+
+    def record_transaction(self, amount: int, category: str, transaction_type: str,
+                           timestamp: int, week: int, balance: int, big_saver_balance: int) -> List[str]:
+        """Учет операции (суммы в копейках); достижения, заработанные ею впервые"""
+        candidates = []
+
+        # Первая операция новой недели закрывает предыдущую: доходы больше расходов - неделя с экономией
+        if week > self.week:
+            if self.week_income > self.week_expense:
+                candidates.append('week_saver')
+            self.week, self.week_income, self.week_expense = week, 0, 0
+        # Операции задним числом в уже закрытые недели не попадают
+        if week == self.week:
+            if transaction_type == 'income':
+                self.week_income += amount
+            elif transaction_type == 'expense':
+                self.week_expense += amount
+
+        # Серия без фастфуда: трата в другой категории спустя неделю после последнего фастфуда
+        if transaction_type == 'expense':
+            if category == FAST_FOOD_CATEGORY:
+                self.fast_food_since = max(self.fast_food_since, timestamp)
+            elif timestamp - self.fast_food_since >= SMART_SPENDER_DAYS * SECONDS_PER_DAY:
+                candidates.append('smart_spender')
+
+        candidates.extend(self.balance_achievements(balance, transaction_type == 'income', big_saver_balance))
+        return self.earn(candidates)
+
+    @staticmethod
+    def balance_achievements(balance: int, after_income: bool, big_saver_balance: int) -> List[str]:
+        """Достижения по текущему балансу в копейках"""
+        candidates = []
+        if after_income and balance > 0:
+            candidates.append('first_save')
+        if balance >= big_saver_balance:
+            candidates.append('big_saver')
+        return candidates
+
+    def earn(self, achievement_ids: Iterable[str]) -> List[str]:
+        """Отметка достижений выданными; возвращает те, что еще не были выданы"""
+        earned = []
+        for achievement_id in achievement_ids:
+            bit = ACHIEVEMENT_BITS[achievement_id]
+            if not self.earned & bit:
+                self.earned |= bit
+                earned.append(achievement_id)
+        return earned
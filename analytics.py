@@ -1,137 +1,239 @@
-import matplotlib.pyplot as plt
+import matplotlib
+import matplotlib.style
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from cycler import cycler
+from PIL import Image
 import seaborn as sns
-import pandas as pd
 import numpy as np
-from datetime import datetime, timedelta
-from typing import List, Dict, Tuple
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Tuple
+import functools
+import inspect
 import io
-from database import Database
-from config import EXPENSE_CATEGORIES, INCOME_CATEGORIES
+import threading
+import time
+from database import Database, SECONDS_PER_DAY
+from chart_cache import ChartCache
+from analytics_engine import AnalyticsEngine
+from config import (CHART_PROFILES, CHART_AUTO_PROFILES, CHART_BYTE_BUDGET, CHART_TIME_BUDGET,
+                    CHART_TEMPLATES_PER_WORKER)
+
+# Стиль графиков: seaborn-v0_8 с палитрой husl
+CHART_STYLE = {
+    **matplotlib.style.library['seaborn-v0_8'],
+    'axes.prop_cycle': cycler(color=sns.color_palette('husl')),
+}
+
+# rcParams общие для процесса: стиль включается только на время построения фигуры,
+# и построение фигур в разных потоках не должно пересекаться
+_style_lock = threading.Lock()
+
+@contextmanager
+def _chart_style():
+    """Стиль графиков на время создания фигуры и ее художников"""
+    with _style_lock, matplotlib.rc_context(CHART_STYLE):
+        yield
+
+def _cached_chart(windowed: bool = False):
+    """Кэширование графика по (пользователь, график, параметры, версия данных)
+
+    windowed - график за последние N дней: в ключ входит текущий день,
+    чтобы окно сдвигалось и без новых записей.
+    """
+    def decorator(method):
+        method.windowed = windowed
+
+        @functools.wraps(method)
+        def wrapper(self, user_id: int, *args, **kwargs):
+            key = self.cache_key(method.__name__, user_id, self.db.get_data_version(user_id), *args, **kwargs)
+            chart = self.cache.get(key)
+            if chart is None:
+                chart = method(self, user_id, *args, **kwargs)
+                self.cache.put(key, chart)
+            return chart
+        return wrapper
+    return decorator
 
 class Analytics:
-    def __init__(self, db: Database):
+    def __init__(self, db: Database, cache: ChartCache = None, profiles: Dict = None,
+                 auto_profiles: Tuple = CHART_AUTO_PROFILES, byte_budget: int = CHART_BYTE_BUDGET,
+                 time_budget: float = CHART_TIME_BUDGET, engine: AnalyticsEngine = None,
+                 max_templates: int = CHART_TEMPLATES_PER_WORKER):
         self.db = db
-        # Настройка стиля графиков
-        plt.style.use('seaborn-v0_8')
-        sns.set_palette("husl")
+        self.engine = engine if engine is not None else AnalyticsEngine(db)
+        self.cache = cache if cache is not None else ChartCache()
+        self.profiles = profiles if profiles is not None else CHART_PROFILES
+        self.auto_profiles = auto_profiles
+        self.byte_budget = byte_budget
+        self.time_budget = time_budget
+        # Сглаженное время кодирования: (размер фигуры, профиль) -> секунды
+        self._encode_times = {}
+        # Заготовки графиков: свои у каждого потока, не больше max_templates (0 - без повторного использования)
+        self.max_templates = max_templates
+        self._local = threading.local()
+    
+    def cache_key(self, chart: str, user_id: int, version: int, *args, **kwargs) -> Tuple:
+        """Ключ кэша: (пользователь, график, параметры со значениями по умолчанию, версия данных)"""
+        method = getattr(type(self), chart).__wrapped__
+        bound = inspect.signature(method).bind(self, user_id, *args, **kwargs)
+        bound.apply_defaults()
+        params = tuple(value for name, value in bound.arguments.items() if name not in ('self', 'user_id'))
+        if method.windowed:
+            params += (int(time.time()) // SECONDS_PER_DAY,)
+        return (user_id, chart, params, version)
     
-    def create_expense_pie_chart(self, user_id: int, days: int = 30) -> bytes:
+    def render(self, chart: str, user_id: int, *args, **kwargs) -> bytes:
+        """Отрисовка графика по имени метода в обход кэша"""
+        return getattr(type(self), chart).__wrapped__(self, user_id, *args, **kwargs)
+    
+    @_cached_chart(windowed=True)
+    def create_expense_pie_chart(self, user_id: int, days: int = 30, profile: str = 'auto') -> bytes:
         """Создание круговой диаграммы расходов"""
-        expenses = self.db.get_expenses_by_category(user_id, days)
+        expenses = self.engine.datasets(user_id, days=days)['categories']
         
         if not expenses:
-            return self._create_empty_chart("Нет данных о расходах")
+            return self._create_empty_chart("Нет данных о расходах", profile)
         
         categories, amounts = zip(*expenses)
         
-        # Создаем график
-        fig, ax = plt.subplots(figsize=(10, 8))
-        colors = plt.cm.Set3(np.linspace(0, 1, len(categories)))
-        
-        wedges, texts, autotexts = ax.pie(amounts, labels=categories, autopct='%1.1f%%',
-                                          colors=colors, startangle=90)
-        
-        ax.set_title(f'Расходы по категориям (за {days} дней)', fontsize=16, fontweight='bold')
-        
-        # Улучшаем отображение текста
-        for text in texts:
-            text.set_fontsize(10)
-        for autotext in autotexts:
-            autotext.set_fontsize(9)
-            autotext.set_color('white')
-            autotext.set_fontweight('bold')
-        
-        plt.tight_layout()
+        with _chart_style():
+            template = self._template(('pie',), self._build_pie_template)
+            ax = template['ax']
+            template['title'].set_text(f'Расходы по категориям (за {days} дней)')
+            
+            # Секторы и подписи зависят от числа категорий - пересоздаются на готовых осях
+            for artist in template['artists']:
+                artist.remove()
+            template['artists'] = []
+            colors = matplotlib.colormaps['Set3'](np.linspace(0, 1, len(categories)))
+            try:
+                wedges, texts, autotexts = ax.pie(amounts, labels=categories, autopct='%1.1f%%',
+                                                  colors=colors, startangle=90)
+            except BaseException:
+                # Прерванная отрисовка (таймаут, ошибка) могла оставить часть секторов на осях
+                self._discard_template(('pie',))
+                raise
+            template['artists'] = wedges + texts + autotexts
+            
+            # Улучшаем отображение текста
+            for text in texts:
+                text.set_fontsize(10)
+            for autotext in autotexts:
+                autotext.set_fontsize(9)
+                autotext.set_color('white')
+                autotext.set_fontweight('bold')
+            
+            self._layout(template)
         
-        return self._save_chart_to_bytes()
+        return self._save_chart_to_bytes(template['fig'], profile)
+    
+    def _build_pie_template(self) -> Dict:
+        """Фигура круговой диаграммы: оси и заголовок"""
+        fig, ax = self._new_figure(figsize=(10, 8))
+        title = ax.set_title('', fontsize=16, fontweight='bold')
+        return {'fig': fig, 'ax': ax, 'title': title, 'artists': []}
     
-    def create_income_vs_expense_chart(self, user_id: int, days: int = 30) -> bytes:
+    @_cached_chart(windowed=True)
+    def create_income_vs_expense_chart(self, user_id: int, days: int = 30, profile: str = 'auto') -> bytes:
         """Создание графика доходов vs расходов"""
-        transactions = self.db.get_transactions(user_id, 1000)  # Получаем больше транзакций
-        
-        if not transactions:
-            return self._create_empty_chart("Нет данных о транзакциях")
-        
-        # Фильтруем по дате
-        cutoff_date = datetime.now() - timedelta(days=days)
-        filtered_transactions = []
-        
-        for trans in transactions:
-            trans_date = datetime.strptime(trans['date'], '%Y-%m-%d %H:%M:%S')
-            if trans_date >= cutoff_date:
-                filtered_transactions.append(trans)
-        
-        if not filtered_transactions:
-            return self._create_empty_chart(f"Нет данных за последние {days} дней")
-        
-        # Группируем по дням
-        daily_data = {}
-        for trans in filtered_transactions:
-            date = trans['date'].split()[0]
-            if date not in daily_data:
-                daily_data[date] = {'income': 0, 'expense': 0}
+        daily_totals = self.engine.datasets(user_id, days=days)['daily']
+        
+        if not daily_totals:
+            return self._create_empty_chart(f"Нет данных за последние {days} дней", profile)
+        
+        dates, incomes, expenses = zip(*daily_totals)
+        
+        with _chart_style():
+            template = self._template(('income_vs_expense', len(dates)),
+                                      lambda: self._build_income_vs_expense_template(len(dates)))
+            ax = template['ax']
+            template['title'].set_text(f'Доходы vs Расходы (за {days} дней)')
+            self._set_heights(template['incomes'], incomes)
+            self._set_heights(template['expenses'], expenses)
+            ax.set_xticklabels([date[5:] for date in dates], rotation=45)
+            ax.relim()
+            ax.autoscale_view()
             
-            if trans['type'] == 'income':
-                daily_data[date]['income'] += trans['amount']
-            else:
-                daily_data[date]['expense'] += trans['amount']
+            self._layout(template)
         
-        dates = sorted(daily_data.keys())
-        incomes = [daily_data[date]['income'] for date in dates]
-        expenses = [daily_data[date]['expense'] for date in dates]
-        
-        # Создаем график
-        fig, ax = plt.subplots(figsize=(12, 6))
+        return self._save_chart_to_bytes(template['fig'], profile)
+    
+    def _build_income_vs_expense_template(self, count: int) -> Dict:
+        """Фигура доходов и расходов по дням на count дней"""
+        fig, ax = self._new_figure(figsize=(12, 6))
         
-        x = range(len(dates))
+        x = range(count)
         width = 0.35
+        zeros = [0] * count
         
-        ax.bar([i - width/2 for i in x], incomes, width, label='Доходы', color='green', alpha=0.7)
-        ax.bar([i + width/2 for i in x], expenses, width, label='Расходы', color='red', alpha=0.7)
+        incomes = ax.bar([i - width/2 for i in x], zeros, width, label='Доходы', color='green', alpha=0.7)
+        expenses = ax.bar([i + width/2 for i in x], zeros, width, label='Расходы', color='red', alpha=0.7)
         
         ax.set_xlabel('Дата')
         ax.set_ylabel('Сумма (руб.)')
-        ax.set_title(f'Доходы vs Расходы (за {days} дней)', fontsize=16, fontweight='bold')
+        title = ax.set_title('', fontsize=16, fontweight='bold')
         ax.legend()
         
         # Настройка осей
         ax.set_xticks(x)
-        ax.set_xticklabels([date[5:] for date in dates], rotation=45)
-        
-        plt.tight_layout()
-        
-        return self._save_chart_to_bytes()
+        return {'fig': fig, 'ax': ax, 'title': title, 'incomes': incomes, 'expenses': expenses}
     
-    def create_savings_progress_chart(self, user_id: int) -> bytes:
+    @_cached_chart()
+    def create_savings_progress_chart(self, user_id: int, profile: str = 'auto') -> bytes:
         """Создание графика прогресса накоплений"""
         goals = self.db.get_user_goals(user_id)
         
         if not goals:
-            return self._create_empty_chart("У вас нет активных целей")
+            return self._create_empty_chart("У вас нет активных целей", profile)
         
         # Фильтруем только активные цели
         active_goals = [goal for goal in goals if not goal['is_completed']]
         
         if not active_goals:
-            return self._create_empty_chart("Все цели достигнуты! 🎉")
+            return self._create_empty_chart("Все цели достигнуты! 🎉", profile)
         
         goal_names = [goal['title'] for goal in active_goals]
         current_amounts = [goal['current_amount'] for goal in active_goals]
         target_amounts = [goal['target_amount'] for goal in active_goals]
         
-        # Создаем график
-        fig, ax = plt.subplots(figsize=(12, 8))
+        with _chart_style():
+            template = self._template(('savings_progress', len(goal_names)),
+                                      lambda: self._build_savings_progress_template(len(goal_names)))
+            ax = template['ax']
+            self._set_heights(template['current'], current_amounts)
+            self._set_heights(template['target'], target_amounts)
+            ax.set_xticklabels(goal_names, rotation=45, ha='right')
+            
+            # Процентное соотношение над текущими накоплениями
+            for i, (label, current, target) in enumerate(zip(template['labels'], current_amounts,
+                                                             target_amounts)):
+                percentage = (current / target) * 100 if target > 0 else 0
+                label.set_position((i, current + max(current_amounts) * 0.02))
+                label.set_text(f'{percentage:.1f}%')
+            ax.relim()
+            ax.autoscale_view()
+            
+            self._layout(template)
+        
+        return self._save_chart_to_bytes(template['fig'], profile)
+    
+    def _build_savings_progress_template(self, count: int) -> Dict:
+        """Фигура прогресса на count целей"""
+        fig, ax = self._new_figure(figsize=(12, 8))
         
-        x = range(len(goal_names))
+        x = range(count)
         width = 0.35
+        zeros = [0] * count
         
         # График текущего прогресса
-        bars1 = ax.bar([i - width/2 for i in x], current_amounts, width, 
-                      label='Текущие накопления', color='lightblue', alpha=0.8)
+        current = ax.bar([i - width/2 for i in x], zeros, width,
+                         label='Текущие накопления', color='lightblue', alpha=0.8)
         
         # График целевой суммы
-        bars2 = ax.bar([i + width/2 for i in x], target_amounts, width, 
-                      label='Целевая сумма', color='orange', alpha=0.6)
+        target = ax.bar([i + width/2 for i in x], zeros, width,
+                        label='Целевая сумма', color='orange', alpha=0.6)
         
         ax.set_xlabel('Цели')
         ax.set_ylabel('Сумма (руб.)')
@@ -140,93 +242,189 @@ class Analytics:
         
         # Настройка осей
         ax.set_xticks(x)
-        ax.set_xticklabels(goal_names, rotation=45, ha='right')
-        
-        # Добавляем процентное соотношение
-        for i, (current, target) in enumerate(zip(current_amounts, target_amounts)):
-            percentage = (current / target) * 100 if target > 0 else 0
-            ax.text(i, current + max(current_amounts) * 0.02, 
-                   f'{percentage:.1f}%', ha='center', va='bottom', fontweight='bold')
-        
-        plt.tight_layout()
-        
-        return self._save_chart_to_bytes()
+        labels = [ax.text(i, 0, '', ha='center', va='bottom', fontweight='bold') for i in x]
+        return {'fig': fig, 'ax': ax, 'current': current, 'target': target, 'labels': labels}
     
-    def create_monthly_trend_chart(self, user_id: int, months: int = 6) -> bytes:
+    @_cached_chart()
+    def create_monthly_trend_chart(self, user_id: int, months: int = 6, profile: str = 'auto') -> bytes:
         """Создание графика месячных трендов"""
-        transactions = self.db.get_transactions(user_id, 5000)
+        # Последние N месяцев с операциями
+        monthly_totals = self.engine.datasets(user_id, months=max(months, 2))['monthly']
+        
+        if len(monthly_totals) < 2:
+            return self._create_empty_chart("Недостаточно данных для анализа трендов", profile)
         
-        if not transactions:
-            return self._create_empty_chart("Недостаточно данных для анализа трендов")
+        recent_months, incomes, expenses, savings = zip(*monthly_totals[-months:])
         
-        # Группируем по месяцам
-        monthly_data = {}
-        for trans in transactions:
-            date = datetime.strptime(trans['date'], '%Y-%m-%d %H:%M:%S')
-            month_key = f"{date.year}-{date.month:02d}"
+        with _chart_style():
+            template = self._template(('monthly_trend', len(recent_months)),
+                                      lambda: self._build_monthly_trend_template(len(recent_months)))
+            ax1, ax2 = template['axes']
+            labels = [month[5:] for month in recent_months]
             
-            if month_key not in monthly_data:
-                monthly_data[month_key] = {'income': 0, 'expense': 0}
+            # График доходов и расходов
+            self._set_heights(template['incomes'], incomes)
+            self._set_heights(template['expenses'], expenses)
+            ax1.set_xticklabels(labels)
             
-            if trans['type'] == 'income':
-                monthly_data[month_key]['income'] += trans['amount']
-            else:
-                monthly_data[month_key]['expense'] += trans['amount']
-        
-        # Сортируем по месяцам
-        sorted_months = sorted(monthly_data.keys())
-        
-        if len(sorted_months) < 2:
-            return self._create_empty_chart("Недостаточно данных для анализа трендов")
-        
-        # Берем последние N месяцев
-        recent_months = sorted_months[-months:]
-        
-        incomes = [monthly_data[month]['income'] for month in recent_months]
-        expenses = [monthly_data[month]['expense'] for month in recent_months]
-        savings = [income - expense for income, expense in zip(incomes, expenses)]
+            # График накоплений
+            self._set_heights(template['savings'], savings)
+            for bar, value in zip(template['savings'], savings):
+                bar.set_facecolor('green' if value >= 0 else 'red')
+            ax2.set_xticklabels(labels)
+            
+            for ax in (ax1, ax2):
+                ax.relim()
+                ax.autoscale_view()
+            
+            self._layout(template)
         
-        # Создаем график
-        fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(12, 10))
+        return self._save_chart_to_bytes(template['fig'], profile)
+    
+    def _build_monthly_trend_template(self, count: int) -> Dict:
+        """Фигура месячных трендов на count месяцев"""
+        fig, (ax1, ax2) = self._new_figure(2, 1, figsize=(12, 10))
         
-        x = range(len(recent_months))
+        x = range(count)
         width = 0.35
+        zeros = [0] * count
         
         # График доходов и расходов
-        ax1.bar([i - width/2 for i in x], incomes, width, label='Доходы', color='green', alpha=0.7)
-        ax1.bar([i + width/2 for i in x], expenses, width, label='Расходы', color='red', alpha=0.7)
+        incomes = ax1.bar([i - width/2 for i in x], zeros, width, label='Доходы', color='green', alpha=0.7)
+        expenses = ax1.bar([i + width/2 for i in x], zeros, width, label='Расходы', color='red', alpha=0.7)
         ax1.set_title('Месячные доходы и расходы', fontsize=14, fontweight='bold')
         ax1.legend()
         ax1.set_xticks(x)
-        ax1.set_xticklabels([month[5:] for month in recent_months])
         
         # График накоплений
-        colors = ['green' if s >= 0 else 'red' for s in savings]
-        ax2.bar(x, savings, color=colors, alpha=0.7)
+        savings = ax2.bar(x, zeros, color='green', alpha=0.7)
         ax2.set_title('Месячные накопления', fontsize=14, fontweight='bold')
         ax2.set_xticks(x)
-        ax2.set_xticklabels([month[5:] for month in recent_months])
         ax2.axhline(y=0, color='black', linestyle='-', alpha=0.3)
-        
-        plt.tight_layout()
-        
-        return self._save_chart_to_bytes()
+        return {'fig': fig, 'axes': (ax1, ax2), 'incomes': incomes, 'expenses': expenses,
+                'savings': savings}
     
-    def _create_empty_chart(self, message: str) -> bytes:
+    def _create_empty_chart(self, message: str, profile: str = 'auto') -> bytes:
         """Создание пустого графика с сообщением"""
-        fig, ax = plt.subplots(figsize=(8, 6))
-        ax.text(0.5, 0.5, message, ha='center', va='center', 
-               transform=ax.transAxes, fontsize=14, fontweight='bold')
+        with _chart_style():
+            template = self._template(('empty',), self._build_empty_template)
+            template['text'].set_text(message)
+            template['fig'].draw_without_rendering()
+        
+        return self._save_chart_to_bytes(template['fig'], profile)
+    
+    def _build_empty_template(self) -> Dict:
+        """Фигура для сообщения без данных"""
+        fig, ax = self._new_figure(figsize=(8, 6))
+        text = ax.text(0.5, 0.5, '', ha='center', va='center',
+                       transform=ax.transAxes, fontsize=14, fontweight='bold')
         ax.set_xlim(0, 1)
         ax.set_ylim(0, 1)
         ax.axis('off')
-        
-        return self._save_chart_to_bytes()
+        return {'fig': fig, 'text': text}
+    
+    def _template(self, key: Tuple, build) -> Dict:
+        """Заготовка графика из реестра текущего потока
+        
+        Фигура, оси, заголовки, легенды и деления создаются один раз на вид
+        графика и число столбцов; при отрисовке меняются только данные.
+        Реестр у каждого потока свой (в пуле процессов - у каждого процесса),
+        поэтому заготовку не нужно блокировать на время кодирования.
+        """
+        if self.max_templates <= 0:
+            return self._build_template(build)
+        
+        templates = getattr(self._local, 'templates', None)
+        if templates is None:
+            templates = self._local.templates = OrderedDict()
+        
+        template = templates.get(key)
+        if template is None:
+            template = templates[key] = self._build_template(build)
+            while len(templates) > self.max_templates:
+                templates.popitem(last=False)
+        templates.move_to_end(key)
+        return template
+    
+    def _discard_template(self, key: Tuple):
+        """Удаление заготовки из реестра текущего потока - следующая отрисовка соберет новую"""
+        templates = getattr(self._local, 'templates', None)
+        if templates is not None:
+            templates.pop(key, None)
+    
+    @staticmethod
+    def _build_template(build) -> Dict:
+        """Новая заготовка с исходными отступами фигуры"""
+        template = build()
+        # tight_layout каждый раз считает от отступов новой фигуры, как в первый раз
+        template['subplotpars'] = {name: getattr(template['fig'].subplotpars, name)
+                                   for name in ('left', 'right', 'bottom', 'top', 'wspace', 'hspace')}
+        return template
     
-    def _save_chart_to_bytes(self) -> bytes:
-        """Сохранение графика в байты"""
+    @staticmethod
+    def _set_heights(bars, heights):
+        """Новые высоты столбцов заготовки"""
+        for bar, height in zip(bars, heights):
+            bar.set_height(height)
+    
+    @staticmethod
+    def _layout(template: Dict):
+        """Компоновка заготовки с новыми данными"""
+        fig = template['fig']
+        fig.subplots_adjust(**template['subplotpars'])
+        fig.tight_layout()
+        # Деления осей создаются при первой отрисовке и читают rcParams - тоже внутри стиля
+        fig.draw_without_rendering()
+    
+    def _new_figure(self, nrows: int = 1, ncols: int = 1, figsize: Tuple = None):
+        """Отдельная фигура с холстом Agg, без глобального состояния pyplot"""
+        fig = Figure(figsize=figsize)
+        FigureCanvasAgg(fig)
+        return fig, fig.subplots(nrows, ncols)
+    
+    def _save_chart_to_bytes(self, fig: Figure, profile: str = 'auto') -> bytes:
+        """Сохранение графика в байты по профилю
+        
+        'auto' перебирает профили от подробного к легкому: первый, уложившийся
+        в бюджет по размеру, и отправляется. Профили, которые раньше кодировались
+        дольше бюджета по времени, пропускаются сразу.
+        """
+        if profile != 'auto':
+            return self._encode(fig, self.profiles[profile])
+        
+        size = tuple(fig.get_size_inches())
+        candidates = [name for name in self.auto_profiles
+                      if self._encode_times.get((size, name), 0) <= self.time_budget]
+        if not candidates:
+            candidates = self.auto_profiles[-1:]
+        
+        for name in candidates:
+            start = time.perf_counter()
+            data = self._encode(fig, self.profiles[name])
+            elapsed = time.perf_counter() - start
+            previous = self._encode_times.get((size, name), elapsed)
+            self._encode_times[(size, name)] = 0.7 * previous + 0.3 * elapsed
+            if len(data) <= self.byte_budget:
+                break
+        return data
+    
+    @staticmethod
+    def _encode(fig: Figure, profile: Dict) -> bytes:
+        """Растеризация фигуры и кодирование: png, png8 (палитра), jpeg или webp"""
         buffer = io.BytesIO()
-        plt.savefig(buffer, format='png', dpi=300, bbox_inches='tight')
+        image_format = profile['format']
+        
+        if image_format != 'png8':
+            fig.savefig(buffer, format=image_format, dpi=profile['dpi'], bbox_inches='tight',
+                        pil_kwargs=profile.get('pil_kwargs', {}))
+            return buffer.getvalue()
+        
+        # У графиков немного цветов: палитра из 256 цветов почти не видна, а файл в разы меньше
+        fig.savefig(buffer, format='png', dpi=profile['dpi'], bbox_inches='tight',
+                    pil_kwargs={'compress_level': 1})
         buffer.seek(0)
-        plt.close()
-        return buffer.getvalue() 
\ No newline at end of file
+        with Image.open(buffer) as image:
+            palette_image = image.convert('RGB').quantize(colors=256, method=Image.Quantize.FASTOCTREE)
+        output = io.BytesIO()
+        palette_image.save(output, format='PNG', optimize=True)
+        return output.getvalue() 
\ No newline at end of file
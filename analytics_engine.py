@@ -0,0 +1,95 @@
+"""
+Наборы данных аналитики: сводки пользователя загружаются столбцами и агрегируются векторно
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List
+import numpy as np
+import pandas as pd
+from database import Database, SECONDS_PER_DAY
+from config import ANALYTICS_FRAME_CACHE_USERS
+
+def _rubles(values: np.ndarray) -> List[float]:
+    """Целые копейки -> рубли"""
+    return (values / 100).tolist()
+
+class AnalyticsEngine:
+    """Все наборы данных для графиков и текстовых отчетов за один проход
+
+    Сводки пользователя читаются из базы одним запросом и хранятся в памяти
+    до изменения версии данных. Расходы по категориям и итоги считаются
+    группировками pandas, без циклов по строкам; ряды по дням и месяцам
+    берутся из агрегатов SQL над теми же сводками.
+    """
+
+    def __init__(self, db: Database, max_users: int = ANALYTICS_FRAME_CACHE_USERS):
+        self.db = db
+        self.max_users = max_users
+        self._frames = OrderedDict()  # user_id -> (версия данных, сводки)
+        self._lock = threading.Lock()
+
+    def load(self, user_id: int) -> pd.DataFrame:
+        """Сводки пользователя столбцами; повторно читаются только после новых записей"""
+        version = self.db.get_data_version(user_id)
+        with self._lock:
+            cached = self._frames.get(user_id)
+            if cached is not None and cached[0] == version:
+                self._frames.move_to_end(user_id)
+                return cached[1]
+
+        frame = self._prepare(self.db.get_rollup_frame(user_id))
+        with self._lock:
+            self._frames[user_id] = (version, frame)
+            self._frames.move_to_end(user_id)
+            while len(self._frames) > self.max_users:
+                self._frames.popitem(last=False)
+        return frame
+
+    @staticmethod
+    def _prepare(frame: pd.DataFrame) -> pd.DataFrame:
+        """Столбцы доходов и расходов - один раз на загрузку"""
+        is_income = frame['type'].to_numpy() == 'income'
+        total = frame['total'].to_numpy()
+        return pd.DataFrame({
+            'day': frame['day'].to_numpy(),
+            'category': frame['category'].to_numpy(),
+            'is_income': is_income,
+            'income': np.where(is_income, total, 0),
+            'expense': np.where(is_income, 0, total),
+        })
+
+    def datasets(self, user_id: int, days: int = 30, months: int = 6) -> Dict:
+        """Наборы данных пользователя в рублях
+
+        categories - [(категория, расходы)] за days дней по убыванию суммы
+        daily - [(YYYY-MM-DD, доходы, расходы)] за days дней
+        monthly - [(YYYY-MM, доходы, расходы, накопления)] за последние months месяцев с операциями
+        totals - (доходы, расходы, накопления) за days дней
+        """
+        first_day = int(time.time()) // SECONDS_PER_DAY - int(days)
+        frame = self.load(user_id)
+        window = frame[frame['day'].to_numpy() >= first_day]
+
+        expenses = window[~window['is_income'].to_numpy()]
+        by_category = expenses.groupby('category', sort=False)['expense'].sum()
+        by_category = by_category.sort_values(ascending=False, kind='stable')
+        income, expense = int(window['income'].sum()), int(window['expense'].sum())
+
+        # Ряды по дням и месяцам SQLite группирует по индексу сводок сам
+        daily = self.db.get_daily_totals(user_id, since=first_day * SECONDS_PER_DAY)
+        monthly = self.db.get_monthly_totals(user_id, limit=int(months))
+
+        return {
+            'categories': list(zip(by_category.index.tolist(), _rubles(by_category.to_numpy()))),
+            'daily': daily,
+            'monthly': [(month, month_income, month_expense, round(month_income - month_expense, 2))
+                        for month, month_income, month_expense in monthly],
+            'totals': (income / 100, expense / 100, (income - expense) / 100),
+        }
+
+    def clear(self):
+        """Сброс загруженных сводок"""
+        with self._lock:
+            self._frames.clear()
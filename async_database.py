@@ -0,0 +1,132 @@
+"""
+Асинхронный доступ к базе данных для обработчиков бота
+"""
+
+import asyncio
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Tuple
+from database import Database, WriteQueue
+from config import DATABASE_READER_THREADS, IMPORT_CHUNK_SIZE
+
+def _write_method(name: str):
+    """Асинхронный вызов метода Database в потоке записи"""
+    async def method(self, *args, **kwargs):
+        return await self.run_write(getattr(self.db, name), *args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = f"Асинхронный Database.{name} (поток записи)"
+    return method
+
+def _queued_write_method(name: str):
+    """Асинхронный вызов через очередь группового коммита (если она включена)"""
+    async def method(self, *args, **kwargs):
+        if self.write_queue is None:
+            return await self.run_write(getattr(self.db, name), *args, **kwargs)
+        # Ожидание завершается только после коммита пакета с этой записью
+        return await asyncio.wrap_future(getattr(self.write_queue, name)(*args, **kwargs))
+    method.__name__ = name
+    method.__doc__ = f"Асинхронный Database.{name} (групповой коммит)"
+    return method
+
+def _read_method(name: str):
+    """Асинхронный вызов метода Database в пуле чтения"""
+    async def method(self, *args, **kwargs):
+        return await self.run_read(getattr(self.db, name), *args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = f"Асинхронный Database.{name} (пул чтения)"
+    return method
+
+class AsyncDatabase:
+    """Неблокирующая обертка над Database: один поток записи и пул потоков чтения"""
+
+    def __init__(self, db: Database, reader_threads: int = DATABASE_READER_THREADS,
+                 group_commit: bool = True):
+        self.db = db
+        # Единственный писатель не конкурирует за блокировку SQLite, читатели работают параллельно (WAL)
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        # Пакеты группового коммита записываются тем же потоком
+        self.write_queue = WriteQueue(db, executor=self._writer) if group_commit else None
+        self._readers = ThreadPoolExecutor(max_workers=reader_threads, thread_name_prefix='db-reader')
+
+    async def run_write(self, func, *args, **kwargs):
+        """Выполнение изменяющей операции в потоке записи"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, functools.partial(func, *args, **kwargs))
+
+    async def run_read(self, func, *args, **kwargs):
+        """Выполнение читающей операции в пуле чтения"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, functools.partial(func, *args, **kwargs))
+
+    def close(self):
+        """Остановка потоков и закрытие соединений"""
+        if self.write_queue is not None:
+            self.write_queue.close()
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        self.db.close()
+
+    # Запись
+    add_user = _write_method('add_user')
+    add_transaction = _queued_write_method('add_transaction')
+    add_goal = _write_method('add_goal')
+    update_goal_progress = _write_method('update_goal_progress')
+    add_achievement = _queued_write_method('add_achievement')
+    update_user_points = _queued_write_method('update_user_points')
+    reconcile_balances = _write_method('reconcile_balances')
+    rebuild_rollups = _write_method('rebuild_rollups')
+    replace_global_rollups = _write_method('replace_global_rollups')
+    set_conversation_state = _write_method('set_conversation_state')
+    delete_conversation_state = _write_method('delete_conversation_state')
+    sweep_conversation_states = _write_method('sweep_conversation_states')
+    toggle_analytics_text = _write_method('toggle_analytics_text')
+    import_chunk = _write_method('import_chunk')
+    finish_import = _write_method('finish_import')
+    init_database = _write_method('init_database')
+
+    # Чтение
+    get_user_balance = _read_method('get_user_balance')
+    get_transactions = _read_method('get_transactions')
+    get_transactions_page = _read_method('get_transactions_page')
+    get_expenses_by_category = _read_method('get_expenses_by_category')
+    get_daily_totals = _read_method('get_daily_totals')
+    get_monthly_totals = _read_method('get_monthly_totals')
+    get_rollup_frame = _read_method('get_rollup_frame')
+    get_user_goals = _read_method('get_user_goals')
+    get_user_achievements = _read_method('get_user_achievements')
+    get_user_points = _read_method('get_user_points')
+    get_analytics_text = _read_method('get_analytics_text')
+    get_data_version = _read_method('get_data_version')
+    get_recently_active_users = _read_method('get_recently_active_users')
+    get_global_stats = _read_method('get_global_stats')
+    stream_global_rollups = _read_method('stream_global_rollups')
+    get_conversation_state = _read_method('get_conversation_state')
+
+    async def import_transactions(self, user_id: int, rows: Iterable[Tuple],
+                                  chunk_size: int = IMPORT_CHUNK_SIZE) -> int:
+        """Импорт порциями, каждая - короткая транзакция в потоке записи
+
+        rows читается (и, например, разбирается из файла) в стороннем потоке,
+        а между порциями поток записи успевает выполнить остальные записи.
+        Уже закоммиченные порции завершаются finish_import и при ошибке.
+        """
+        loop = asyncio.get_running_loop()
+        rows = iter(rows)
+        imported = income = 0
+        try:
+            while True:
+                chunk = await loop.run_in_executor(None, lambda: list(itertools.islice(rows, chunk_size)))
+                if not chunk:
+                    break
+                income += await self.import_chunk(user_id, chunk)
+                imported += len(chunk)
+        finally:
+            if imported:
+                await self.finish_import(user_id, income > 0)
+        return imported
+
+    async def recompute_global_rollups(self) -> int:
+        """Пересчет общих сводок: журнал читается в пуле чтения, поток записи занят только заменой"""
+        totals, until_id = await self.stream_global_rollups()
+        return await self.replace_global_rollups(totals, until_id)
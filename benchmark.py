@@ -0,0 +1,847 @@
+#!/usr/bin/env python3
+"""
+Бенчмарки производительности финансового бота
+Запуск: python benchmark.py <имя бенчмарка> [параметры]
+"""
+
+import argparse
+import asyncio
+import datetime
+import os
+import sqlite3
+import statistics
+import tempfile
+import resource
+import threading
+import time
+import tracemalloc
+from database import Database, WriteQueue, format_timestamp, from_minor_units
+from migrations import MIGRATIONS, rebuild_activity, rebuild_balances
+from async_database import AsyncDatabase
+from analytics import Analytics
+from analytics_engine import AnalyticsEngine
+from chart_cache import ChartCache
+from render_pool import ChartRenderPool
+from conversation_state import ConversationState
+from webhook import WebhookServer, run_bot
+from fake_telegram import FakeTelegram, message_update
+from update_processor import UserOrderedUpdateProcessor
+from handlers import BotHandlers
+from keyboards import KEYBOARDS
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import BaseUpdateProcessor, MessageHandler, SimpleUpdateProcessor, filters
+from importer import import_file, import_file_async
+from exporter import export_transactions
+from config import (WRITE_BATCH_SIZE, WRITE_FLUSH_INTERVAL_MS, RENDER_WORKERS, EXPENSE_CATEGORIES,
+                    WEBHOOK_MAX_CONNECTIONS, ACHIEVEMENTS)
+
+def _measure(func, iterations: int) -> list:
+    """Замер времени каждого вызова функции в микросекундах"""
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1_000_000)
+    return timings
+
+def _report(name: str, timings: list):
+    """Вывод медианы и 95-го перцентиля"""
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f"{name:<40} median {statistics.median(timings):>9.1f} µs   p95 {p95:>9.1f} µs")
+
+def bench_connections(args):
+    """Соединение на каждый вызов против пула постоянных соединений"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        db = Database(path)
+        user_id = 1
+        db.add_user(user_id, 'bench', 'Bench')
+        for i in range(1000):
+            db.add_transaction(user_id, 100 + i, '🍔 Еда и фастфуд', 'bench', 'expense')
+
+        # До: так работали методы Database до появления пула
+        def legacy_add():
+            conn = sqlite3.connect(path)
+            conn.execute('''
+                INSERT INTO transactions (user_id, amount, category, description, transaction_type)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (user_id, 100, '🚌 Транспорт', 'bench', 'expense'))
+            conn.commit()
+            conn.close()
+
+        def legacy_balance():
+            conn = sqlite3.connect(path)
+            conn.execute('''
+                SELECT
+                    COALESCE(SUM(CASE WHEN transaction_type = 'income' THEN amount ELSE 0 END), 0) -
+                    COALESCE(SUM(CASE WHEN transaction_type = 'expense' THEN amount ELSE 0 END), 0)
+                FROM transactions
+                WHERE user_id = ?
+            ''', (user_id,)).fetchone()
+            conn.close()
+
+        def legacy_points():
+            conn = sqlite3.connect(path)
+            conn.execute('SELECT points FROM users WHERE user_id = ?', (user_id,)).fetchone()
+            conn.close()
+
+        print(f"Итераций: {args.iterations}")
+        _report("до: add_transaction", _measure(legacy_add, args.iterations))
+        _report("после: add_transaction", _measure(
+            lambda: db.add_transaction(user_id, 100, '🚌 Транспорт', 'bench', 'expense'), args.iterations))
+        _report("до: get_user_balance", _measure(legacy_balance, args.iterations))
+        _report("после: get_user_balance", _measure(lambda: db.get_user_balance(user_id), args.iterations))
+        _report("до: get_user_points", _measure(legacy_points, args.iterations))
+        _report("после: get_user_points", _measure(lambda: db.get_user_points(user_id), args.iterations))
+        db.close()
+
+def bench_group_commit(args):
+    """Вставки в секунду: коммит на каждую запись против группового коммита"""
+    writers = args.writers
+    per_writer = args.iterations // writers
+
+    def run_writers(write):
+        threads = [threading.Thread(target=write, args=(user_id,)) for user_id in range(writers)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return writers * per_writer / (time.perf_counter() - start)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'))
+        write_queue = WriteQueue(db, batch_size=args.batch_size, flush_interval_ms=args.flush_ms)
+
+        def direct(user_id):
+            for _ in range(per_writer):
+                db.add_transaction(user_id, 100, '🚌 Транспорт', 'bench', 'expense')
+
+        def grouped(user_id):
+            # Каждый писатель ждет подтверждения своей записи, как обработчик бота
+            for _ in range(per_writer):
+                write_queue.add_transaction(user_id, 100, '🚌 Транспорт', 'bench', 'expense').result()
+
+        print(f"Писателей: {writers}, записей: {writers * per_writer}, "
+              f"пакет до {args.batch_size} записей / {args.flush_ms} мс")
+        print(f"{'коммит на каждую запись':<40} {run_writers(direct):>10.0f} вставок/с")
+        print(f"{'групповой коммит':<40} {run_writers(grouped):>10.0f} вставок/с")
+
+        # Всплеск: все записи поставлены сразу, ожидание всех подтверждений
+        count = writers * per_writer
+        start = time.perf_counter()
+        for _ in range(count):
+            db.add_transaction(1, 100, '🚌 Транспорт', 'bench', 'expense')
+        print(f"{'всплеск, коммит на каждую запись':<40} {count / (time.perf_counter() - start):>10.0f} вставок/с")
+
+        start = time.perf_counter()
+        futures = [write_queue.add_transaction(1, 100, '🚌 Транспорт', 'bench', 'expense')
+                   for _ in range(count)]
+        for future in futures:
+            future.result()
+        print(f"{'всплеск, групповой коммит':<40} {count / (time.perf_counter() - start):>10.0f} вставок/с")
+
+        write_queue.close()
+        db.close()
+
+def bench_pagination(args):
+    """Задержка страницы истории в зависимости от глубины: курсор против OFFSET"""
+    rows = args.rows
+    page_size = 10
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'))
+        conn = db._get_connection()
+        now = int(time.time())
+        with conn:
+            conn.executemany('''
+                INSERT INTO transactions (user_id, amount, category, description, transaction_type, date)
+                VALUES (1, 10000, '🚌 Транспорт', 'bench', 'expense', ?)
+            ''', ((now - i * 60,) for i in range(rows)))
+
+        # Курсоры начала каждой страницы на нужной глубине
+        depths = [0, rows // 100, rows // 10, rows // 2, rows - page_size]
+        boundaries = {}
+        for depth in depths:
+            row = conn.execute('''
+                SELECT date, id FROM transactions WHERE user_id = 1
+                ORDER BY date DESC, id DESC LIMIT 1 OFFSET ?
+            ''', (max(depth - 1, 0),)).fetchone()
+            boundaries[depth] = row if depth else None
+
+        def offset_page(depth):
+            conn.execute('''
+                SELECT id, amount, category, description, transaction_type, date
+                FROM transactions WHERE user_id = 1
+                ORDER BY date DESC, id DESC LIMIT ? OFFSET ?
+            ''', (page_size, depth)).fetchall()
+
+        print(f"Транзакций у пользователя: {rows}")
+        for depth in depths:
+            _report(f"OFFSET, глубина {depth}", _measure(lambda: offset_page(depth), args.iterations))
+            _report(f"курсор, глубина {depth}", _measure(
+                lambda: db.get_transactions_page(1, page_size, before=boundaries[depth]), args.iterations))
+        db.close()
+
+# Синтетическая история: 1000 пользователей, два года, суммы до 1000 руб.
+_STORAGE_USERS = 1000
+_STORAGE_START = 1704067200  # 2024-01-01 00:00:00 UTC
+_STORAGE_SPAN = 2 * 365 * 86400
+
+def _fill_storage(conn: sqlite3.Connection, rows: int, legacy: bool):
+    """Заполнение transactions в старом (REAL/TEXT) или новом (INTEGER) формате"""
+    if legacy:
+        amount, date = "(i % 100000) / 100.0", f"datetime({_STORAGE_START} + i * {_STORAGE_SPAN} / ?1, 'unixepoch')"
+    else:
+        amount, date = "i % 100000", f"{_STORAGE_START} + i * {_STORAGE_SPAN} / ?1"
+    with conn:
+        conn.execute(f'''
+            WITH RECURSIVE seq(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM seq WHERE i < ?1 - 1)
+            INSERT INTO transactions (user_id, amount, category, description, transaction_type, date)
+            SELECT i % {_STORAGE_USERS}, {amount},
+                   CASE i % 4 WHEN 0 THEN '🚌 Транспорт' WHEN 1 THEN '🍔 Еда и фастфуд'
+                               WHEN 2 THEN '🎮 Развлечения' ELSE '📚 Учеба' END,
+                   'Операция', CASE WHEN i % 10 THEN 'expense' ELSE 'income' END, {date}
+            FROM seq
+        ''', (rows,))
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+def bench_storage(args):
+    """Размер базы и время запросов: REAL/TEXT против целых копеек и секунд Unix"""
+    rows = args.rows
+    month_start = _STORAGE_START + _STORAGE_SPAN - 30 * 86400
+    with tempfile.TemporaryDirectory() as tmp:
+        # Старый формат - схема до миграции 5 с теми же индексами
+        legacy_path = os.path.join(tmp, 'legacy.db')
+        legacy = sqlite3.connect(legacy_path)
+        legacy.execute('PRAGMA journal_mode=WAL')
+        for version, _, migrate in MIGRATIONS:
+            if version < 5:
+                with legacy:
+                    migrate(legacy.cursor())
+        start = time.perf_counter()
+        _fill_storage(legacy, rows, legacy=True)
+        legacy_fill = time.perf_counter() - start
+
+        db = Database(os.path.join(tmp, 'compact.db'))
+        compact = db._get_connection()
+        start = time.perf_counter()
+        _fill_storage(compact, rows, legacy=False)
+        compact_fill = time.perf_counter() - start
+
+        print(f"Строк: {rows}")
+        print(f"Заполнение: REAL/TEXT {legacy_fill:.1f} с, INTEGER {compact_fill:.1f} с")
+        print(f"Размер: REAL/TEXT {os.path.getsize(legacy_path) / 1024 / 1024:.1f} МБ, "
+              f"INTEGER {os.path.getsize(db.db_path) / 1024 / 1024:.1f} МБ")
+
+        # Расходы пользователя за последние 30 дней: сравнение строк против сравнения целых
+        legacy_cutoff = format_timestamp(month_start)
+        _report("сумма за 30 дней, REAL/TEXT", _measure(lambda: legacy.execute('''
+            SELECT SUM(amount) FROM transactions
+            WHERE user_id = 7 AND transaction_type = 'expense' AND date >= ?
+        ''', (legacy_cutoff,)).fetchone(), args.iterations))
+        _report("сумма за 30 дней, INTEGER", _measure(lambda: compact.execute('''
+            SELECT SUM(amount) FROM transactions
+            WHERE user_id = 7 AND transaction_type = 'expense' AND date >= ?
+        ''', (month_start,)).fetchone(), args.iterations))
+
+        # Вся история пользователя по дням
+        _report("история по дням, REAL/TEXT", _measure(lambda: legacy.execute('''
+            SELECT date(date), SUM(amount) FROM transactions
+            WHERE user_id = 7 AND transaction_type = 'expense' GROUP BY date(date)
+        ''').fetchall(), args.iterations // 10))
+        _report("история по дням, INTEGER", _measure(lambda: compact.execute('''
+            SELECT date / 86400, SUM(amount) FROM transactions
+            WHERE user_id = 7 AND transaction_type = 'expense' GROUP BY date / 86400
+        ''').fetchall(), args.iterations // 10))
+
+        # Фильтр по дате на стороне Python, как в прежней аналитике
+        legacy_rows = legacy.execute(
+            'SELECT date, amount FROM transactions WHERE user_id = 7').fetchall()
+        compact_rows = compact.execute(
+            'SELECT date, amount FROM transactions WHERE user_id = 7').fetchall()
+        cutoff = datetime.datetime.fromtimestamp(month_start)
+        _report(f"фильтр {len(legacy_rows)} строк в Python, strptime", _measure(lambda: sum(
+            amount for date, amount in legacy_rows
+            if datetime.datetime.strptime(date, '%Y-%m-%d %H:%M:%S') >= cutoff
+        ), args.iterations // 10))
+        _report(f"фильтр {len(compact_rows)} строк в Python, int", _measure(lambda: sum(
+            amount for date, amount in compact_rows if date >= month_start
+        ), args.iterations // 10))
+
+        # Точность: сумма всех сумм в float против целых копеек
+        float_total = legacy.execute('SELECT SUM(amount) FROM transactions').fetchone()[0]
+        exact_total = compact.execute('SELECT SUM(amount) FROM transactions').fetchone()[0]
+        print(f"Сумма по всей базе: REAL {float_total!r}, INTEGER {from_minor_units(exact_total)!r} "
+              f"(расхождение {abs(float_total - exact_total / 100):.6f} руб.)")
+
+        legacy.close()
+        db.close()
+
+async def _render_round(render, users: list) -> tuple:
+    """Одновременные запросы графиков: общее время и максимальная задержка цикла событий"""
+    lag = 0.0
+    done = False
+
+    async def probe():
+        nonlocal lag
+        while not done:
+            start = time.perf_counter()
+            await asyncio.sleep(0.005)
+            lag = max(lag, time.perf_counter() - start - 0.005)
+
+    probe_task = asyncio.create_task(probe())
+    start = time.perf_counter()
+    await asyncio.gather(*(render(user_id) for user_id in users))
+    elapsed = time.perf_counter() - start
+    done = True
+    await probe_task
+    return elapsed, lag
+
+def bench_render(args):
+    """Пропускная способность графиков: отрисовка в обработчике против пула процессов"""
+    chart = 'create_monthly_trend_chart'
+    concurrency = (4, 8, 16)
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'))
+        users = range(1, max(concurrency) * 2 + 1)
+        for user_id in users:
+            db.import_transactions(user_id, (
+                (f"2024-{i % 12 + 1:02d}-{i % 28 + 1:02d} 12:00:00", i % 500 + 10, "🍔 Еда и фастфуд",
+                 "Операция", 'expense' if i % 5 else 'income')
+                for i in range(500)
+            ))
+        analytics = Analytics(db, ChartCache(max_bytes=0, disk_dir=None))
+
+        async def run():
+            async_db = AsyncDatabase(db)
+            pool = ChartRenderPool(async_db, analytics, workers=args.workers, max_pending=max(concurrency))
+            pool.start()
+            await pool.render(chart, 0)  # дождаться запуска процессов
+
+            async def inline(user_id):
+                # Прежнее поведение: matplotlib прямо в обработчике
+                return analytics.render(chart, user_id)
+
+            async def pooled(user_id):
+                return await pool.render(chart, user_id)
+
+            print(f"Процессов в пуле: {args.workers}, CPU: {os.cpu_count()}")
+            for n in concurrency:
+                for name, render in (("в обработчике", inline), ("пул процессов", pooled)):
+                    elapsed, lag = await _render_round(render, list(users)[:n])
+                    print(f"{n:>2} запросов, {name:<14} {elapsed:6.2f} с, {n / elapsed:5.2f} графиков/с, "
+                          f"макс. задержка цикла {lag * 1000:7.1f} мс")
+            pool.close()
+            async_db.close()
+
+        asyncio.run(run())
+
+def bench_profiles(args):
+    """Время кодирования и размер каждого графика в каждом профиле вывода"""
+    charts = ('create_expense_pie_chart', 'create_income_vs_expense_chart',
+              'create_savings_progress_chart', 'create_monthly_trend_chart')
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'))
+        categories = list(EXPENSE_CATEGORIES)
+        now = datetime.datetime.now()
+        db.import_transactions(1, (
+            ((now - datetime.timedelta(hours=i * 3)).strftime('%Y-%m-%d %H:%M:%S'), i % 500 + 10,
+             categories[i % len(categories)],
+             "Операция", 'expense' if i % 5 else 'income')
+            for i in range(2000)
+        ))
+        db.add_goal(1, "Отпуск", 100000, "savings")
+        db.update_goal_progress(1, 35000)
+        analytics = Analytics(db, ChartCache(max_bytes=0, disk_dir=None))
+
+        # Фигура собирается один раз, затем кодируется в каждом профиле
+        figures = {}
+        save = analytics._save_chart_to_bytes
+        analytics._save_chart_to_bytes = lambda fig, profile='auto': figures.setdefault('fig', fig) and b''
+        print(f"{'график':<32} {'профиль':<8} {'кодирование':>12} {'размер':>10}")
+        for chart in charts:
+            figures.clear()
+            getattr(analytics, chart).__wrapped__(analytics, 1)
+            fig = figures['fig']
+            for name, profile in analytics.profiles.items():
+                data = analytics._encode(fig, profile)
+                elapsed = statistics.median(_measure(lambda: analytics._encode(fig, profile), 5)) / 1000
+                print(f"{chart:<32} {name:<8} {elapsed:9.1f} мс {len(data) / 1024:7.1f} КБ")
+            data = save(fig)
+            chosen = next((name for name, profile in analytics.profiles.items()
+                           if analytics._encode(fig, profile) == data), '?')
+            print(f"{chart:<32} {'auto':<8} {'-> ' + chosen:>12} {len(data) / 1024:7.1f} КБ\n")
+        db.close()
+
+def bench_templates(args):
+    """Время графика: новая фигура на каждый вызов против готовой заготовки"""
+    charts = ('create_expense_pie_chart', 'create_income_vs_expense_chart',
+              'create_savings_progress_chart', 'create_monthly_trend_chart')
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'))
+        categories = list(EXPENSE_CATEGORIES)
+        now = int(time.time())
+        users = (1, 2)
+        for user_id in users:
+            db.import_transactions(user_id, (
+                (format_timestamp(now - i * 3000 * user_id), i % 500 * user_id + 10,
+                 categories[i % len(categories)], "Операция", 'expense' if i % 5 else 'income')
+                for i in range(5000)
+            ))
+            db.add_goal(user_id, "Отпуск", 100000, "savings")
+            db.add_goal(user_id, "Ноутбук", 80000 * user_id, "savings")
+        fresh = Analytics(db, ChartCache(max_bytes=0, disk_dir=None), max_templates=0)
+        reused = Analytics(db, ChartCache(max_bytes=0, disk_dir=None))
+
+        # Пользователи чередуются: заготовка каждый раз получает другие данные
+        for profile in ('preview', 'full'):
+            print(f"Профиль {profile}:")
+            for chart in charts:
+                for name, analytics in (("новая фигура", fresh), ("заготовка", reused)):
+                    calls = iter(users * args.iterations)
+                    analytics.render(chart, users[0], profile=profile)
+                    timings = _measure(lambda: analytics.render(chart, next(calls), profile=profile),
+                                       args.iterations)
+                    _report(f"  {chart[7:-6]}, {name}", timings)
+        db.close()
+
+def _loop_datasets(transactions: list, days: int, months: int) -> dict:
+    """Прежний расчет: циклы по словарям транзакций"""
+    cutoff = time.time() - days * 86400
+    categories, daily, monthly = {}, {}, {}
+    for trans in transactions:
+        month = monthly.setdefault(trans['date'][:7], {'income': 0, 'expense': 0})
+        month[trans['type'] if trans['type'] == 'income' else 'expense'] += trans['amount']
+        if trans['timestamp'] < cutoff:
+            continue
+        day = daily.setdefault(trans['date'].split()[0], {'income': 0, 'expense': 0})
+        if trans['type'] == 'income':
+            day['income'] += trans['amount']
+        else:
+            day['expense'] += trans['amount']
+            categories[trans['category']] = categories.get(trans['category'], 0) + trans['amount']
+    recent = sorted(monthly)[-months:]
+    return {
+        'categories': sorted(categories.items(), key=lambda item: item[1], reverse=True),
+        'daily': [(date, daily[date]['income'], daily[date]['expense']) for date in sorted(daily)],
+        'monthly': [(month, monthly[month]['income'], monthly[month]['expense'],
+                     monthly[month]['income'] - monthly[month]['expense']) for month in recent],
+    }
+
+def bench_engine(args):
+    """Наборы данных аналитики: циклы по транзакциям, запросы SQL и векторный расчет"""
+    categories = list(EXPENSE_CATEGORIES)
+    for size in (int(size) for size in args.sizes.split(',')):
+        with tempfile.TemporaryDirectory() as tmp:
+            db = Database(os.path.join(tmp, 'bench.db'))
+            now = int(time.time())
+            # История на три года при любом числе записей
+            step = max(3 * 365 * 86400 // size, 1)
+            db.import_transactions(1, (
+                (format_timestamp(now - i * step), i % 5000 / 10 + 10, categories[i % len(categories)],
+                 "Операция", 'income' if i % 5 == 0 else 'expense')
+                for i in range(size)
+            ))
+            engine = AnalyticsEngine(db)
+            since = (now // 86400 - 30) * 86400
+
+            def loops():
+                return _loop_datasets(db.get_transactions(1, size), 30, 6)
+
+            def sql():
+                return (db.get_expenses_by_category(1, 30), db.get_daily_totals(1, since=since),
+                        db.get_monthly_totals(1, limit=6))
+
+            def engine_cold():
+                engine.clear()
+                return engine.datasets(1)
+
+            print(f"{size:,} транзакций:")
+            iterations = 3 if size >= 1_000_000 else 10
+            for name, func in (("циклы по транзакциям", loops), ("три запроса SQL", sql),
+                               ("векторно, загрузка", engine_cold), ("векторно, сводки в памяти",
+                                                                    lambda: engine.datasets(1))):
+                _report(f"  {name}", _measure(func, iterations))
+            db.close()
+
+def bench_import(args):
+    """Время и пиковая память потокового импорта CSV"""
+    rows = args.rows
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'import.csv')
+        categories = ['Транспорт', 'Еда и фастфуд', 'Развлечения', 'Учеба']
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            f.write("date;amount;category;description\n")
+            for i in range(rows):
+                amount = f"{-(i % 1000 + 1)},50" if i % 10 else "25000"
+                f.write(f"2024-{i % 12 + 1:02d}-{i % 28 + 1:02d} 12:00:00;{amount};"
+                        f"{categories[i % len(categories)]};Операция {i}\n")
+
+        db = Database(os.path.join(tmp, 'bench.db'))
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        result = import_file(db, 1, path, 'csv')
+        elapsed = time.perf_counter() - start
+        # ru_maxrss в Linux - пиковый размер процесса в КБ
+        rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+
+        print(f"Строк в файле: {rows} ({os.path.getsize(path) / 1024 / 1024:.1f} МБ)")
+        print(f"Импортировано: {result.imported} за {elapsed:.2f} с "
+              f"({result.imported / elapsed:.0f} строк/с), рост пиковой памяти {rss_growth / 1024:.1f} МБ")
+        db.close()
+
+        # Импорт из обработчика: сколько ждут записи других пользователей, пока он идет
+        async def run():
+            async_db = AsyncDatabase(Database(os.path.join(tmp, 'concurrent.db')))
+            waits = []
+            import_task = asyncio.create_task(import_file_async(async_db, 1, path, 'csv'))
+            while not import_task.done():
+                start = time.perf_counter()
+                await async_db.add_transaction(2, 10, "🚌 Транспорт", "Проезд", "expense")
+                waits.append(time.perf_counter() - start)
+                await asyncio.sleep(0.01)
+            await import_task
+            async_db.close()
+            return waits
+
+        waits = asyncio.run(run())
+        print(f"Записи во время импорта из обработчика: {len(waits)}, ожидание "
+              f"median {statistics.median(waits) * 1000:.1f} мс, max {max(waits) * 1000:.1f} мс")
+
+def bench_export(args):
+    """Время и пиковая память потокового экспорта (память не должна расти с историей)"""
+    rows = args.rows
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'))
+        db.import_transactions(1, (
+            (f"2024-{i % 12 + 1:02d}-{i % 28 + 1:02d} 12:00:00", i % 1000 + 1.5,
+             "🍔 Еда и фастфуд", f"Операция {i}", 'expense')
+            for i in range(rows)
+        ))
+
+        for export_format in args.formats.split(','):
+            path = os.path.join(tmp, f'export.{export_format}')
+            rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            start = time.perf_counter()
+            exported = export_transactions(db, 1, path, export_format)
+            elapsed = time.perf_counter() - start
+            rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+
+            print(f"{export_format}: {exported} строк за {elapsed:.2f} с ({exported / elapsed:.0f} строк/с), "
+                  f"файл {os.path.getsize(path) / 1024 / 1024:.1f} МБ, "
+                  f"рост пиковой памяти {rss_growth / 1024:.1f} МБ")
+        db.close()
+
+def bench_admin_stats(args):
+    """/admin_stats: общие счетчики против полного сканирования журнала, потоковая сверка"""
+    rows, users = args.rows, args.users
+    now = int(time.time())
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'))
+        conn = db._get_connection()
+        # Операции за последние 90 дней, пользователи равномерно
+        with conn:
+            conn.execute('''
+                WITH RECURSIVE seq(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM seq WHERE i < ?1 - 1)
+                INSERT INTO transactions (user_id, amount, category, description, transaction_type, date)
+                SELECT i % ?2, i % 100000,
+                       CASE i % 4 WHEN 0 THEN '🚌 Транспорт' WHEN 1 THEN '🍔 Еда и фастфуд'
+                                   WHEN 2 THEN '🎮 Развлечения' ELSE '📚 Учеба' END,
+                       'Операция', CASE WHEN i % 10 THEN 'expense' ELSE 'income' END,
+                       ?3 - (i * 7919) % (90 * 86400)
+                FROM seq
+            ''', (rows, users, now))
+        db.rebuild_rollups()
+        with conn:
+            rebuild_activity(conn.cursor())
+        print(f"Строк: {rows}, пользователей: {users}")
+
+        def full_scan():
+            """Те же цифры прямыми запросами к transactions"""
+            since = now - 30 * 86400
+            for window in (1, 7, 30):
+                conn.execute('SELECT COUNT(DISTINCT user_id) FROM transactions WHERE date >= ?',
+                             (now - window * 86400,)).fetchone()
+            conn.execute('SELECT COUNT(DISTINCT user_id) FROM transactions').fetchone()
+            conn.execute('''
+                SELECT transaction_type, SUM(amount), COUNT(*) FROM transactions
+                WHERE date >= ? GROUP BY transaction_type
+            ''', (since,)).fetchall()
+            conn.execute('''
+                SELECT category, SUM(amount) AS total FROM transactions
+                WHERE date >= ? AND transaction_type = 'expense'
+                GROUP BY category ORDER BY total DESC LIMIT 5
+            ''', (since,)).fetchall()
+
+        _report("полное сканирование журнала", _measure(full_scan, max(args.iterations // 200, 3)))
+        _report("общие счетчики", _measure(db.get_global_stats, max(args.iterations // 20, 10)))
+
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        drifts = db.recompute_global_rollups()
+        elapsed = time.perf_counter() - start
+        rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+        print(f"Потоковая сверка: {elapsed:.2f} с ({rows / elapsed:.0f} строк/с), расхождений {drifts}, "
+              f"рост пиковой памяти {rss_growth / 1024:.1f} МБ")
+        db.close()
+
+def _traced_size(build) -> tuple:
+    """Результат build() и память Python, которую он удерживает (МБ)"""
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size / 1024 / 1024
+
+def bench_achievements(args):
+    """Запись операции: счетчики достижений против прежней проверки по истории"""
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'))
+        conn = db._get_connection()
+        db.add_user(1, "bench", "Bench")
+        with conn:
+            conn.execute('''
+                WITH RECURSIVE seq(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM seq WHERE i < ?1 - 1)
+                INSERT INTO transactions (user_id, amount, category, description, transaction_type, date)
+                SELECT 1, 10000, '🚌 Транспорт', 'Операция', CASE WHEN i % 10 THEN 'expense' ELSE 'income' END,
+                       ?2 - i * 60
+                FROM seq
+            ''', (args.rows, int(time.time())))
+            rebuild_balances(conn.cursor())
+        print(f"Строк в истории пользователя: {args.rows}")
+
+        def legacy_check():
+            """Прежняя BotHandlers.check_achievements после каждой записи"""
+            db.get_user_balance(1)
+            db.get_transactions(1, 1000)
+            for achievement_id in ('big_saver', 'week_saver'):
+                db.add_achievement(1, achievement_id)
+                db.update_user_points(1, ACHIEVEMENTS[achievement_id]['points'])
+
+        iterations = max(args.iterations // 10, 50)
+        _report("прежняя проверка (без записи)", _measure(legacy_check, iterations))
+        db.add_transaction(1, 100, "🚌 Транспорт", "Прогрев", "expense")  # счетчики строятся по журналу
+        _report("запись с правилами достижений", _measure(
+            lambda: db.add_transaction(1, 100, "🚌 Транспорт", "Метро", "expense"), iterations))
+
+def bench_conversations(args):
+    """Память под брошенные диалоги: словарь словарей, записи со __slots__, SQLite с TTL"""
+    count = args.rows
+    category = '🍔 Еда и фастфуд'
+    print(f"Брошенных диалогов: {count}")
+
+    # SQLite первым: пиковая память процесса еще не поднята словарями
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'))
+        conn = db._get_connection()
+        expired = int(time.time()) - 1
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        for start in range(0, count, 100_000):
+            with conn:
+                conn.executemany('''
+                    INSERT INTO conversation_states (user_id, transaction_type, category, amount, expires_at)
+                    VALUES (?, 'expense', ?, ?, ?)
+                ''', ((user_id, category, 10000 + user_id % 1000, expired)
+                      for user_id in range(start, min(start + 100_000, count))))
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+        print(f"SQLite: файл {os.path.getsize(db.db_path) / 1024 / 1024:.1f} МБ, "
+              f"рост пиковой памяти процесса {rss_growth / 1024:.1f} МБ (страничный кэш соединения)")
+
+        live = int(time.time()) + 3600
+        _report("шаг диалога: запись", _measure(
+            lambda: db.set_conversation_state(count + 1, 'expense', category, 100.5, live), args.iterations))
+        _report("шаг диалога: чтение", _measure(lambda: db.get_conversation_state(count + 1), args.iterations))
+
+        start = time.perf_counter()
+        removed = batches = 0
+        while True:
+            batch = db.sweep_conversation_states()
+            removed += batch
+            batches += 1
+            if not batch:
+                break
+        elapsed = time.perf_counter() - start
+        remaining = conn.execute('SELECT COUNT(*) FROM conversation_states').fetchone()[0]
+        print(f"Сборщик: удалено {removed} за {elapsed:.2f} с, {batches} транзакций "
+              f"(по {elapsed / batches * 1000:.0f} мс), осталось {remaining}")
+        db.close()
+
+    # До: self.user_states[user_id] = {...} без удаления
+    states, size = _traced_size(lambda: {
+        user_id: {'transaction_type': 'expense', 'category': category, 'amount': 100.0 + user_id % 1000}
+        for user_id in range(count)
+    })
+    print(f"dict словарей в памяти процесса: {size:.1f} МБ")
+    del states
+
+    states, size = _traced_size(lambda: {
+        user_id: ConversationState('expense', category, 100.0 + user_id % 1000)
+        for user_id in range(count)
+    })
+    print(f"dict записей со __slots__:       {size:.1f} МБ")
+    del states
+
+async def _ingest(mode: str, count: int, chats: int, latency: float,
+                  update_processor: BaseUpdateProcessor = None) -> float:
+    """Секунды от первого обновления до ответа на последнее через локальную замену Telegram"""
+    telegram = FakeTelegram(latency)
+    await telegram.start()
+    application = telegram.build_application(update_processor)
+    handled = 0
+    done = asyncio.Event()
+    last_seen = {}
+    reordered = 0
+
+    async def reply(update, context):
+        nonlocal handled, reordered
+        chat_id = update.effective_chat.id
+        reordered += last_seen.get(chat_id, 0) > update.update_id
+        last_seen[chat_id] = update.update_id
+        await update.message.reply_text("ok")
+        handled += 1
+        if handled == count:
+            done.set()
+
+    application.add_handler(MessageHandler(filters.TEXT, reply))
+    updates = [message_update(i + 1, i % chats + 1, "ping") for i in range(count)]
+    server = WebhookServer(application, host='127.0.0.1', port=0, secret_token='bench', queue_size=count)
+    stop = asyncio.Event()
+    runner = asyncio.create_task(run_bot(application, mode, 'https://bench.local', server, stop))
+    while not (telegram.webhook_url if mode == 'webhook' else telegram.calls['getUpdates']):
+        await asyncio.sleep(0.01)
+
+    start = time.perf_counter()
+    if mode == 'webhook':
+        delivery = asyncio.create_task(telegram.post_updates(
+            f"http://127.0.0.1:{server.port}{server.path}", updates, WEBHOOK_MAX_CONNECTIONS,
+            secret_token='bench', retry_after=0.05))
+    else:
+        telegram.add_updates(updates)
+    await done.wait()
+    elapsed = time.perf_counter() - start
+
+    if mode == 'webhook':
+        await delivery
+    stop.set()
+    await runner
+    await telegram.stop()
+    if reordered:
+        raise RuntimeError(f"Обновления чата обработаны не по порядку: {reordered}")
+    return elapsed
+
+def bench_webhook(args):
+    """Обновлений в секунду: long polling против webhook с ограниченной очередью"""
+    latency = args.latency_ms / 1000
+    print(f"Обновлений: {args.updates}, чатов: {args.chats}, задержка ответа Telegram {args.latency_ms} мс")
+    for mode in ('polling', 'webhook'):
+        elapsed = asyncio.run(_ingest(mode, args.updates, args.chats, latency))
+        print(f"{mode:<8} {elapsed:6.2f} с, {args.updates / elapsed:7.0f} обновлений/с")
+
+def bench_updates(args):
+    """Обновлений в секунду при long polling: по одному против параллельно с порядком по пользователям"""
+    latency = args.latency_ms / 1000
+    print(f"Обновлений: {args.updates}, чатов: {args.chats}, задержка ответа Telegram {args.latency_ms} мс")
+    for label, processor in (('по одному', SimpleUpdateProcessor(1)),
+                             ('параллельно', UserOrderedUpdateProcessor())):
+        elapsed = asyncio.run(_ingest('polling', args.updates, args.chats, latency, processor))
+        print(f"{label:<12} {elapsed:6.2f} с, {args.updates / elapsed:7.0f} обновлений/с")
+
+def _legacy_route(data: str) -> str:
+    """Прежняя цепочка if/elif из BotHandlers.button_handler (имя обработчика)"""
+    if data == "income":
+        return "show_income_categories"
+    elif data == "expense":
+        return "show_expense_categories"
+    elif data == "balance":
+        return "show_balance"
+    elif data == "goals":
+        return "show_goals"
+    elif data == "achievements":
+        return "show_achievements"
+    elif data == "tips":
+        return "show_tips"
+    elif data == "analytics":
+        return "show_analytics_menu"
+    elif data == "history" or data.startswith("history_"):
+        return "show_history"
+    elif data.startswith("category_"):
+        return "handle_category_selection"
+    elif data.startswith("analytics_"):
+        return "handle_analytics_selection"
+    elif data == "add_goal":
+        return "start_add_goal"
+    elif data == "back_to_main":
+        return "show_main_menu"
+    elif data == "cancel":
+        return "cancel_entry"
+
+def _legacy_keyboard(categories) -> InlineKeyboardMarkup:
+    """Клавиатура категорий, как ее собирал каждый вызов show_expense_categories"""
+    keyboard = []
+    for category in categories:
+        keyboard.append([InlineKeyboardButton(category, callback_data=f"category_expense_{category}")])
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")])
+    return InlineKeyboardMarkup(keyboard)
+
+def bench_dispatch(args):
+    """Стоимость нажатия на кнопку: цепочка if/elif против таблицы, сборка клавиатуры против реестра"""
+    router = BotHandlers(None, None, None, None).router
+    # Нажатия вперемешку: пункты меню, возвраты, категории, листание истории и аналитика
+    buttons = [button.callback_data for keyboard in KEYBOARDS.values()
+               for row in keyboard.inline_keyboard for button in row]
+    buttons += ["history_older_1725193800_123456", "history_newer_1725193800_123457"] * 5
+    assert all(_legacy_route(data) == (route[0].__name__ if route else None)
+               for data, route in ((data, router.resolve(data)) for data in buttons))
+    print(f"Нажатий в наборе: {len(buttons)}")
+
+    def per_press(name: str, func):
+        timings = _measure(func, args.iterations)
+        print(f"{name:<40} median {statistics.median(timings) * 1000 / len(buttons):>7.0f} нс на нажатие")
+
+    per_press("цепочка if/elif", lambda: [_legacy_route(data) for data in buttons])
+    per_press("таблица CallbackRouter", lambda: [router.resolve(data) for data in buttons])
+    _report("сборка клавиатуры расходов", _measure(lambda: _legacy_keyboard(EXPENSE_CATEGORIES), args.iterations))
+    _report("клавиатура из реестра", _measure(lambda: KEYBOARDS['expense_categories'], args.iterations))
+
+BENCHMARKS = {
+    'connections': bench_connections,
+    'group_commit': bench_group_commit,
+    'pagination': bench_pagination,
+    'import': bench_import,
+    'export': bench_export,
+    'storage': bench_storage,
+    'render': bench_render,
+    'profiles': bench_profiles,
+    'engine': bench_engine,
+    'templates': bench_templates,
+    'admin_stats': bench_admin_stats,
+    'conversations': bench_conversations,
+    'achievements': bench_achievements,
+    'dispatch': bench_dispatch,
+    'webhook': bench_webhook,
+    'updates': bench_updates,
+}
+
+def main():
+    """Разбор аргументов и запуск выбранного бенчмарка"""
+    parser = argparse.ArgumentParser(description="Бенчмарки финансового бота")
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--rows', type=int, default=100_000, help="Размер синтетической истории")
+    parser.add_argument('--users', type=int, default=300_000, help="Число пользователей (admin_stats)")
+    parser.add_argument('--updates', type=int, default=1000, help="Число обновлений (webhook, updates)")
+    parser.add_argument('--chats', type=int, default=100, help="Число чатов (webhook, updates)")
+    parser.add_argument('--latency-ms', type=int, default=20, help="Задержка ответа Telegram (webhook, updates)")
+    parser.add_argument('--writers', type=int, default=16, help="Число параллельных писателей")
+    parser.add_argument('--batch-size', type=int, default=WRITE_BATCH_SIZE)
+    parser.add_argument('--flush-ms', type=int, default=WRITE_FLUSH_INTERVAL_MS)
+    parser.add_argument('--workers', type=int, default=RENDER_WORKERS, help="Процессов отрисовки графиков")
+    parser.add_argument('--sizes', default='1000,100000,1000000', help="Размеры истории через запятую")
+    parser.add_argument('--formats', default='csv,parquet', help="Форматы экспорта через запятую")
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+if __name__ == '__main__':
+    main()
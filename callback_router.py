@@ -0,0 +1,43 @@
+"""
+Маршрутизация нажатий на кнопки по callback_data
+"""
+
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+Handler = Callable[..., Awaitable[Any]]
+
+class CallbackRouter:
+    """callback_data -> обработчик за два поиска в словаре
+
+    Сначала ищется точное совпадение ("balance", "back_to_main"), затем
+    префикс до первого "_" ("history_older_..." -> "history"). Обработчику
+    префикса остаток строки передается вторым аргументом, поэтому данные
+    кнопки разбираются один раз. Стоимость не зависит от числа кнопок.
+    """
+
+    def __init__(self):
+        self._exact: Dict[str, Tuple[Handler, Tuple[str, ...]]] = {}  # готовый ответ resolve
+        self._prefixes: Dict[str, Handler] = {}
+
+    def exact(self, data: str, handler: Handler):
+        """handler(query) для callback_data, равного data"""
+        self._exact[data] = (handler, ())
+
+    def prefix(self, prefix: str, handler: Handler):
+        """handler(query, остаток) для callback_data вида "<prefix>_<остаток>" """
+        if '_' in prefix:
+            raise ValueError(f"Префикс не должен содержать '_': {prefix}")
+        self._prefixes[prefix] = handler
+
+    def resolve(self, data: str) -> Optional[Tuple[Handler, Tuple[str, ...]]]:
+        """(обработчик, аргументы после query) или None для неизвестной кнопки"""
+        route = self._exact.get(data)
+        if route is not None:
+            return route
+        separator = data.find('_')
+        if separator < 0:
+            return None
+        handler = self._prefixes.get(data[:separator])
+        if handler is None:
+            return None
+        return handler, (data[separator + 1:],)
@@ -0,0 +1,166 @@
+"""
+Кэш готовых графиков: LRU в памяти с ограничением по байтам и необязательный дисковый уровень
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional
+from config import CHART_CACHE_MAX_BYTES, CHART_CACHE_DIR, CHART_CACHE_DISK_MAX_BYTES
+
+logger = logging.getLogger(__name__)
+
+class ChartCache:
+    """Кэш байтов графика по ключу (пользователь, график, параметры, версия данных)
+
+    Версия данных входит в ключ, поэтому устаревшие графики не удаляются явно:
+    они перестают запрашиваться и вытесняются по LRU.
+    """
+
+    def __init__(self, max_bytes: int = CHART_CACHE_MAX_BYTES, disk_dir: Optional[str] = CHART_CACHE_DIR,
+                 disk_max_bytes: int = CHART_CACHE_DISK_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()  # ключ -> байты, от давно использованных к недавним
+        self._size = 0
+        self._disk_entries = OrderedDict()  # имя файла -> размер
+        self._disk_size = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._load_disk_index()
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        """Готовый график или None"""
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+
+        data = self._read_disk(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._store(key, data)
+        return data
+
+    def put(self, key: Hashable, data: bytes):
+        """Сохранение графика в памяти и на диске"""
+        with self._lock:
+            self._store(key, data)
+        self._write_disk(key, data)
+
+    def clear(self):
+        """Очистка памяти (дисковый уровень сохраняется)"""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self) -> Dict:
+        """Счетчики попаданий и занятый объем"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'disk_entries': len(self._disk_entries),
+                'disk_bytes': self._disk_size
+            }
+
+    def _store(self, key: Hashable, data: bytes):
+        """Запись в LRU и вытеснение сверх лимита (под блокировкой)"""
+        if len(data) > self.max_bytes:
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._size -= len(previous)
+        self._entries[key] = data
+        self._size += len(data)
+
+        while self._size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+            self.evictions += 1
+
+    @staticmethod
+    def _file_name(key: Hashable) -> str:
+        """Имя файла дискового кэша: ключ состоит из чисел и строк, repr стабилен между запусками"""
+        return hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+
+    def _load_disk_index(self):
+        """Файлы, оставшиеся от прошлых запусков, от старых к новым"""
+        files = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.is_file() and not entry.name.startswith('.'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(files):
+            self._disk_entries[name] = size
+            self._disk_size += size
+
+    def _read_disk(self, key: Hashable) -> Optional[bytes]:
+        """Чтение графика с диска"""
+        if not self.disk_dir:
+            return None
+        name = self._file_name(key)
+        with self._lock:
+            if name not in self._disk_entries:
+                return None
+            self._disk_entries.move_to_end(name)
+        try:
+            with open(os.path.join(self.disk_dir, name), 'rb') as f:
+                return f.read()
+        except OSError:
+            with self._lock:
+                self._disk_size -= self._disk_entries.pop(name, 0)
+            return None
+
+    def _write_disk(self, key: Hashable, data: bytes):
+        """Атомарная запись графика на диск и удаление давно не используемых файлов"""
+        if not self.disk_dir or len(data) > self.disk_max_bytes:
+            return
+        name = self._file_name(key)
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, prefix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, os.path.join(self.disk_dir, name))
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить график в дисковый кэш: {e}")
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        with self._lock:
+            self._disk_size -= self._disk_entries.pop(name, 0)
+            self._disk_entries[name] = len(data)
+            self._disk_size += len(data)
+            evicted = []
+            while self._disk_size > self.disk_max_bytes:
+                old_name, size = self._disk_entries.popitem(last=False)
+                self._disk_size -= size
+                evicted.append(old_name)
+
+        for old_name in evicted:
+            try:
+                os.remove(os.path.join(self.disk_dir, old_name))
+            except OSError:
+                pass
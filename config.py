@@ -7,8 +7,84 @@ load_dotenv()
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_ID = int(os.getenv('ADMIN_ID', 0))
 
+# Прием обновлений: 'polling' (getUpdates) или 'webhook' (Telegram сам присылает обновления)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # публичный адрес HTTPS, например https://bot.example.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')  # сверяется с заголовком X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_HOST = '0.0.0.0'
+WEBHOOK_PORT = int(os.getenv('PORT', 8443))
+WEBHOOK_QUEUE_SIZE = 1000  # принятых обновлений, ждущих места в обработке (MAX_PENDING_UPDATES); сверх - ответ 503
+WEBHOOK_MAX_CONNECTIONS = 40  # одновременных соединений Telegram с сервером
+WEBHOOK_MAX_CLIENT_CONNECTIONS = 100  # открытых соединений с сервером (Telegram и проверки здоровья); сверх - 503
+WEBHOOK_READ_TIMEOUT = 10  # секунд на заголовки и на тело запроса; медленный клиент получает 408
+WEBHOOK_IDLE_TIMEOUT = 60  # секунд простоя keep-alive соединения до закрытия
+
+# Параллельная обработка обновлений (обновления одного пользователя - по очереди)
+CONCURRENT_UPDATES = 32  # обработчиков, выполняющихся одновременно
+MAX_PENDING_UPDATES = 1000  # обновлений в работе вместе с ждущими очереди своего пользователя
+
 # Настройки базы данных
 DATABASE_PATH = 'finance_bot.db'
+DATABASE_SYNCHRONOUS = 'NORMAL'  # в режиме WAL NORMAL безопасен при падении процесса
+DATABASE_CACHE_SIZE_KB = 16384  # страничный кэш на одно соединение
+DATABASE_MMAP_SIZE = 64 * 1024 * 1024
+DATABASE_STATEMENT_CACHE_SIZE = 128  # кэш подготовленных выражений
+DATABASE_READER_THREADS = 4  # потоки чтения асинхронного доступа к базе
+DATABASE_BUSY_TIMEOUT = 30  # секунд ожидания блокировки записи (массовый импорт держит ее дольше)
+WRITE_BATCH_SIZE = 64  # групповой коммит: сброс очереди записи по числу операций
+WRITE_FLUSH_INTERVAL_MS = 2  # ... или через столько миллисекунд после первой операции
+IMPORT_CHUNK_SIZE = 5000  # строк в одном executemany при импорте
+EXPORT_BATCH_SIZE = 5000  # строк в одной выборке fetchmany (и группе строк Parquet) при экспорте
+
+# Статистика администратора (/admin_stats)
+ADMIN_STATS_DAYS = 30  # период объема операций и топа категорий
+ADMIN_STATS_COHORT_WEEKS = 6  # недельных когорт в таблице удержания
+GLOBAL_STATS_RECOMPUTE_INTERVAL = 24 * 3600  # секунд между сверками общих сводок с журналом
+
+# Диалог ввода операции (категория -> сумма -> описание)
+CONVERSATION_TTL = 30 * 60  # секунд с последнего шага, после которых диалог забывается
+CONVERSATION_SWEEP_INTERVAL = 10 * 60  # секунд между удалениями истекших диалогов
+CONVERSATION_SWEEP_BATCH = 5000  # диалогов, удаляемых одной транзакцией
+
+# Настройки интерфейса
+HISTORY_PAGE_SIZE = 10  # транзакций на странице истории
+
+# Профили вывода графиков: разрешение и формат
+CHART_PROFILES = {
+    'print': {'dpi': 300, 'format': 'png'},  # без потерь, для печати
+    'full': {'dpi': 150, 'format': 'png8'},  # палитра 256 цветов
+    'preview': {'dpi': 100, 'format': 'png8'},  # экран телефона
+    'lite': {'dpi': 80, 'format': 'jpeg', 'pil_kwargs': {'quality': 85, 'optimize': True}},
+    'webp': {'dpi': 150, 'format': 'webp', 'pil_kwargs': {'quality': 85, 'method': 4}},
+}
+CHART_AUTO_PROFILES = ('full', 'preview', 'lite')  # порядок перебора для profile='auto'
+CHART_BYTE_BUDGET = 300 * 1024  # размер графика для отправки в чат
+CHART_TIME_BUDGET = 1.0  # секунд на растеризацию и кодирование
+CHART_TEMPLATES_PER_WORKER = 32  # готовых фигур на поток отрисовки (0 - фигура на каждый график)
+
+# Кэш готовых графиков
+CHART_CACHE_MAX_BYTES = 32 * 1024 * 1024  # LRU в памяти процесса
+CHART_CACHE_DIR = os.getenv('CHART_CACHE_DIR')  # каталог дискового кэша (не задан - без диска)
+CHART_CACHE_DISK_MAX_BYTES = 256 * 1024 * 1024
+
+# Наборы данных аналитики
+ANALYTICS_FRAME_CACHE_USERS = 256  # сводок пользователей в памяти процесса
+# Очередь графиков заполнена - ответить текстовой аналитикой вместо "попробуйте позже"
+ANALYTICS_TEXT_FALLBACK = os.getenv('ANALYTICS_TEXT_FALLBACK', '1') == '1'
+
+# Отрисовка графиков в отдельных процессах
+RENDER_WORKERS = min(4, os.cpu_count() or 1)
+RENDER_QUEUE_SIZE = 16  # графиков в работе и в очереди, сверх - ответ "занято"
+RENDER_TIMEOUT = 20  # секунд на один график
+RENDER_KILL_GRACE = 5  # ... и еще столько до принудительной остановки процесса
+
+# Фоновая отрисовка графиков недавно активных пользователей (JobQueue)
+PRERENDER_INTERVAL = 300  # секунд между проходами
+PRERENDER_ACTIVE_WINDOW = 24 * 3600  # данные менялись за это время - пользователь активен
+PRERENDER_MAX_USERS = 200  # пользователей за проход
+PRERENDER_CPU_BUDGET = 0.25  # доля одного ядра: после графика за t секунд пауза t * (1 / доля - 1)
+PRERENDER_CHARTS = ('create_monthly_trend_chart', 'create_savings_progress_chart')
 
 # Настройки геймификации
 ACHIEVEMENTS = {
@@ -18,6 +94,9 @@ ACHIEVEMENTS = {
     'smart_spender': {'name': 'Умный тратильщик', 'description': 'Не тратил на фастфуд неделю', 'points': 30},
     'big_saver': {'name': 'Большой накопитель', 'description': 'Накопил 1000 рублей', 'points': 200}
 }
+FAST_FOOD_CATEGORY = '🍔 Еда и фастфуд'  # smart_spender: неделя без трат в этой категории
+SMART_SPENDER_DAYS = 7
+BIG_SAVER_BALANCE = 1000  # рублей на балансе для big_saver
 
 # Категории расходов
 EXPENSE_CATEGORIES = [
@@ -0,0 +1,74 @@
+"""
+Состояния диалога ввода операции с ограниченным временем жизни
+"""
+
+import asyncio
+import logging
+import time
+from typing import Optional
+from async_database import AsyncDatabase
+from config import CONVERSATION_TTL, CONVERSATION_SWEEP_BATCH
+
+logger = logging.getLogger(__name__)
+
+class ConversationState:
+    """Шаг диалога: выбраны тип и категория, сумма появляется после ее ввода"""
+
+    __slots__ = ('transaction_type', 'category', 'amount', 'expires_at')
+
+    def __init__(self, transaction_type: str, category: str, amount: Optional[float] = None,
+                 expires_at: int = 0):
+        self.transaction_type = transaction_type
+        self.category = category
+        self.amount = amount
+        self.expires_at = expires_at
+
+    def __repr__(self) -> str:
+        return (f"ConversationState({self.transaction_type!r}, {self.category!r}, "
+                f"amount={self.amount!r}, expires_at={self.expires_at})")
+
+class ConversationStore:
+    """Диалоги хранятся в SQLite, а не в словаре процесса
+
+    Переживают перезапуск и видны всем процессам бота, работающим с одной
+    базой. Каждый шаг продлевает жизнь диалога на ttl секунд; истекший
+    диалог не возвращается get, а периодический sweep удаляет такие строки
+    порциями, не занимая поток записи надолго.
+    """
+
+    def __init__(self, db: AsyncDatabase, ttl: int = CONVERSATION_TTL,
+                 sweep_batch: int = CONVERSATION_SWEEP_BATCH):
+        self.db = db
+        self.ttl = ttl
+        self.sweep_batch = sweep_batch
+
+    async def get(self, user_id: int) -> Optional[ConversationState]:
+        """Текущий шаг диалога или None"""
+        row = await self.db.get_conversation_state(user_id)
+        return ConversationState(*row) if row is not None else None
+
+    async def save(self, user_id: int, state: ConversationState) -> ConversationState:
+        """Запись шага с продлением срока жизни"""
+        state.expires_at = int(time.time()) + self.ttl
+        await self.db.set_conversation_state(user_id, state.transaction_type, state.category,
+                                             state.amount, state.expires_at)
+        return state
+
+    async def discard(self, user_id: int):
+        """Диалог завершен или отменен"""
+        await self.db.delete_conversation_state(user_id)
+
+    async def sweep(self, context=None) -> int:
+        """Удаление истекших диалогов (callback для JobQueue.run_repeating)"""
+        now = int(time.time())
+        removed = 0
+        while True:
+            batch = await self.db.sweep_conversation_states(now, self.sweep_batch)
+            removed += batch
+            if batch < self.sweep_batch:
+                break
+            # Между порциями поток записи успевает обработать запросы пользователей
+            await asyncio.sleep(0)
+        if removed:
+            logger.info(f"Удалено истекших диалогов: {removed}")
+        return removed
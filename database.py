@@ -1,177 +1,775 @@
+import math
 import sqlite3
+import threading
+import itertools
+import queue
+import time
 import datetime
-from typing import List, Dict, Optional, Tuple
-from config import DATABASE_PATH
+import pandas as pd
+from concurrent.futures import Executor, Future
+from typing import List, Dict, Iterable, Iterator, Optional, Tuple
+from config import (DATABASE_PATH, DATABASE_CACHE_SIZE_KB, DATABASE_MMAP_SIZE,
+                    DATABASE_SYNCHRONOUS, DATABASE_STATEMENT_CACHE_SIZE,
+                    DATABASE_BUSY_TIMEOUT, WRITE_BATCH_SIZE, WRITE_FLUSH_INTERVAL_MS,
+                    IMPORT_CHUNK_SIZE, EXPORT_BATCH_SIZE, ADMIN_STATS_DAYS, ADMIN_STATS_COHORT_WEEKS,
+                    CONVERSATION_SWEEP_BATCH, ACHIEVEMENTS, FAST_FOOD_CATEGORY, BIG_SAVER_BALANCE)
+from achievements import ACHIEVEMENT_BITS, AchievementProgress
+from migrations import apply_migrations, rebuild_balances, rebuild_rollups, rebuild_global_rollups
+
+# Суммы хранятся в целых копейках, даты - в секундах Unix (UTC).
+# Преобразование выполняется только на границе API класса Database.
+MAX_MINOR_UNITS = 2 ** 63 - 1  # предел INTEGER в SQLite
+
+def to_minor_units(amount: float) -> int:
+    """Рубли -> целые копейки; ValueError для inf, nan и сумм вне диапазона INTEGER"""
+    minor = amount * 100
+    if not math.isfinite(minor) or abs(minor) > MAX_MINOR_UNITS:
+        raise ValueError(f"сумма вне допустимого диапазона: {amount}")
+    return round(minor)
+
+def from_minor_units(amount: int) -> float:
+    """Целые копейки -> рубли"""
+    return amount / 100
+
+def to_timestamp(date: str) -> int:
+    """'YYYY-MM-DD HH:MM:SS' (UTC) -> секунды Unix"""
+    parsed = datetime.datetime.fromisoformat(date)
+    return int(parsed.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+def format_timestamp(timestamp: int) -> str:
+    """Секунды Unix -> 'YYYY-MM-DD HH:MM:SS' (UTC)"""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp))
+
+SECONDS_PER_DAY = 86400
+
+def week_number(timestamp: int) -> int:
+    """Номер недели от начала эпохи; недели начинаются с понедельника"""
+    return (timestamp // SECONDS_PER_DAY + 3) // 7
+
+def week_start(week: int) -> str:
+    """Номер недели -> дата ее понедельника 'YYYY-MM-DD'"""
+    return time.strftime('%Y-%m-%d', time.gmtime((week * 7 - 3) * SECONDS_PER_DAY))
+
+class ConnectionPool:
+    """Пул постоянных соединений SQLite (одно соединение на поток)"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def get_connection(self) -> sqlite3.Connection:
+        """Получение соединения текущего потока"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _connect(self) -> sqlite3.Connection:
+        """Открытие соединения с настроенными PRAGMA"""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                               timeout=DATABASE_BUSY_TIMEOUT,
+                               cached_statements=DATABASE_STATEMENT_CACHE_SIZE)
+        # WAL позволяет читателям не блокироваться на время записи
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA synchronous={DATABASE_SYNCHRONOUS}')
+        conn.execute(f'PRAGMA cache_size=-{DATABASE_CACHE_SIZE_KB}')
+        conn.execute(f'PRAGMA mmap_size={DATABASE_MMAP_SIZE}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+
+    def close_all(self):
+        """Закрытие всех соединений пула"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+            self._local = threading.local()
+        for conn in connections:
+            conn.close()
 
 class Database:
-    def __init__(self):
-        self.db_path = DATABASE_PATH
+    def __init__(self, db_path: str = None):
+        self.db_path = db_path or DATABASE_PATH
+        self.pool = ConnectionPool(self.db_path)
         self.init_database()
     
+    def _get_connection(self) -> sqlite3.Connection:
+        """Получение соединения из пула"""
+        return self.pool.get_connection()
+    
+    def close(self):
+        """Закрытие всех соединений с базой данных"""
+        self.pool.close_all()
+    
     def init_database(self):
-        """Инициализация базы данных"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        """Инициализация базы данных и применение миграций схемы"""
+        apply_migrations(self._get_connection())
+    
+    def add_user(self, user_id: int, username: str = None, first_name: str = None):
+        """Добавление нового пользователя"""
+        conn = self._get_connection()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR IGNORE INTO users (user_id, username, first_name)
+                VALUES (?, ?, ?)
+            ''', (user_id, username, first_name))
+    
+    def add_transaction(self, user_id: int, amount: float, category: str, 
+                       description: str, transaction_type: str) -> List[str]:
+        """Добавление транзакции; возвращает впервые полученные достижения"""
+        conn = self._get_connection()
+        with conn:
+            return self._insert_transaction(conn.cursor(), user_id, to_minor_units(amount), category,
+                                            description, transaction_type)
+    
+    def _insert_transaction(self, cursor: sqlite3.Cursor, user_id: int, amount: int,
+                            category: str, description: str, transaction_type: str) -> List[str]:
+        """Запись транзакции (сумма в копейках) внутри уже открытой транзакции SQLite"""
+        now = int(time.time())
+        # Счетчики достижений читаются до записи: при первом обращении они заполняются по журналу
+        progress = self._load_achievement_progress(cursor, user_id, now)
+        
+        cursor.execute('''
+            INSERT INTO transactions (user_id, amount, category, description, transaction_type)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, amount, category, description, transaction_type))
+        # lastrowid читается сразу: UPSERT баланса ниже меняет его на rowid строки balances
+        transaction_id = cursor.lastrowid
+        
+        # Баланс, сводки и достижения обновляются в той же транзакции, что и запись в журнале
+        self._apply_balance_delta(cursor, user_id, amount, transaction_type)
+        self._apply_rollup_delta(cursor, transaction_id)
+        self._bump_data_version(cursor, user_id)
+        
+        earned = progress.record_transaction(amount, category, transaction_type, now, week_number(now),
+                                             self._balance_minor(cursor, user_id),
+                                             to_minor_units(BIG_SAVER_BALANCE))
+        self._save_achievement_progress(cursor, user_id, progress)
+        return self._award_achievements(cursor, user_id, earned)
+    
+    def import_transactions(self, user_id: int, rows: Iterable[Tuple],
+                            chunk_size: int = IMPORT_CHUNK_SIZE) -> int:
+        """Массовая загрузка транзакций (date, amount, category, description, type)
         
-        # Таблица пользователей
+        Строки читаются из итератора порциями; каждая порция - отдельная
+        короткая транзакция (см. import_chunk), поэтому импорт большого файла
+        не держит блокировку записи SQLite до конца загрузки. Если импорт
+        прерван, уже закоммиченные порции все равно учитываются в достижениях.
+        """
+        imported = income = 0
+        rows = iter(rows)
+        try:
+            while True:
+                chunk = list(itertools.islice(rows, chunk_size))
+                if not chunk:
+                    break
+                chunk_income = self.import_chunk(user_id, chunk)
+                imported += len(chunk)
+                income += chunk_income
+        finally:
+            if imported:
+                self.finish_import(user_id, income > 0)
+        return imported
+    
+    def import_chunk(self, user_id: int, rows: List[Tuple]) -> int:
+        """Вставка порции импорта через executemany одной транзакцией; сумма доходов в копейках
+        
+        Баланс, дневные и общие сводки обновляются в той же транзакции по суммам
+        порции, а не на каждую строку, так что после коммита любой порции они
+        согласованы с журналом.
+        """
+        conn = self._get_connection()
+        income = expense = 0
+        rollups = {}
+        
+        rows = [
+            (to_timestamp(date), to_minor_units(amount), category, description, transaction_type)
+            for date, amount, category, description, transaction_type in rows
+        ]
+        for date, amount, category, _, transaction_type in rows:
+            if transaction_type == 'income':
+                income += amount
+            elif transaction_type == 'expense':
+                expense += amount
+            key = (transaction_type, date // SECONDS_PER_DAY, category)
+            total, count = rollups.get(key, (0, 0))
+            rollups[key] = (total + amount, count + 1)
+        
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.executemany('''
+                INSERT INTO transactions (user_id, date, amount, category, description, transaction_type)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [(user_id, *row) for row in rows])
+            
+            cursor.execute('''
+                INSERT INTO balances (user_id, income, expense)
+                VALUES (?, ?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    income = income + excluded.income,
+                    expense = expense + excluded.expense
+            ''', (user_id, income, expense))
+            
+            cursor.executemany('''
+                INSERT INTO daily_rollups (user_id, transaction_type, day, category, total, count)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (user_id, transaction_type, day, category) DO UPDATE SET
+                    total = total + excluded.total,
+                    count = count + excluded.count
+            ''', [(user_id, *key, total, count) for key, (total, count) in rollups.items()])
+            
+            cursor.executemany('''
+                INSERT INTO global_rollups (transaction_type, day, category, total, count)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (day, transaction_type, category) DO UPDATE SET
+                    total = total + excluded.total,
+                    count = count + excluded.count
+            ''', [(*key, total, count) for key, (total, count) in rollups.items()])
+            
+            self._bump_data_version(cursor, user_id)
+        
+        return income
+    
+    def finish_import(self, user_id: int, after_income: bool):
+        """Завершение импорта: счетчики достижений по журналу и правила, зависящие от баланса"""
+        conn = self._get_connection()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            # Импорт - история, а не новые события: счетчики достижений строятся по журналу
+            # заново, из правил проверяются только зависящие от баланса
+            cursor.execute('DELETE FROM achievement_progress WHERE user_id = ?', (user_id,))
+            progress = self._seed_achievement_progress(cursor, user_id, int(time.time()))
+            earned = progress.earn(AchievementProgress.balance_achievements(
+                self._balance_minor(cursor, user_id), after_income, to_minor_units(BIG_SAVER_BALANCE)))
+            self._save_achievement_progress(cursor, user_id, progress)
+            self._award_achievements(cursor, user_id, earned)
+    
+    def _apply_balance_delta(self, cursor: sqlite3.Cursor, user_id: int, amount: int,
+                             transaction_type: str):
+        """Изменение материализованного баланса пользователя"""
+        income = amount if transaction_type == 'income' else 0
+        expense = amount if transaction_type == 'expense' else 0
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                points INTEGER DEFAULT 0,
-                is_premium BOOLEAN DEFAULT FALSE
-            )
-        ''')
-        
-        # Таблица транзакций
+            INSERT INTO balances (user_id, income, expense)
+            VALUES (?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET
+                income = income + excluded.income,
+                expense = expense + excluded.expense
+        ''', (user_id, income, expense))
+    
+    def _balance_minor(self, cursor: sqlite3.Cursor, user_id: int) -> int:
+        """Материализованный баланс в копейках"""
+        cursor.execute('SELECT income - expense FROM balances WHERE user_id = ?', (user_id,))
+        row = cursor.fetchone()
+        return row[0] if row else 0
+    
+    def _apply_rollup_delta(self, cursor: sqlite3.Cursor, transaction_id: int):
+        """Учет транзакции в дневных сводках пользователя и в общих"""
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS transactions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                amount REAL,
-                category TEXT,
-                description TEXT,
-                transaction_type TEXT,
-                date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        ''')
-        
-        # Таблица целей
+            INSERT INTO daily_rollups (user_id, transaction_type, day, category, total, count)
+            SELECT user_id, transaction_type, date / 86400, COALESCE(category, ''), amount, 1
+            FROM transactions
+            WHERE id = ?
+            ON CONFLICT (user_id, transaction_type, day, category) DO UPDATE SET
+                total = total + excluded.total,
+                count = count + 1
+        ''', (transaction_id,))
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS goals (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                title TEXT,
-                target_amount REAL,
-                current_amount REAL DEFAULT 0,
-                goal_type TEXT,
-                created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                is_completed BOOLEAN DEFAULT FALSE,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        ''')
-        
-        # Таблица достижений
+            INSERT INTO global_rollups (day, transaction_type, category, total, count)
+            SELECT date / 86400, transaction_type, COALESCE(category, ''), amount, 1
+            FROM transactions
+            WHERE id = ?
+            ON CONFLICT (day, transaction_type, category) DO UPDATE SET
+                total = total + excluded.total,
+                count = count + 1
+        ''', (transaction_id,))
+    
+    def _bump_data_version(self, cursor: sqlite3.Cursor, user_id: int):
+        """Новая версия данных пользователя: закэшированные графики устарели
+        
+        Первое изменение за неделю засчитывается в недельную активность когорты пользователя.
+        """
+        now = int(time.time())
+        week = week_number(now)
+        cursor.execute('SELECT created_at, updated_at FROM data_versions WHERE user_id = ?', (user_id,))
+        row = cursor.fetchone()
+        if row is None or week_number(row[1]) < week:
+            cohort_week = week if row is None else week_number(row[0])
+            cursor.execute('''
+                INSERT INTO activity_weeks (cohort_week, week, users)
+                VALUES (?, ?, 1)
+                ON CONFLICT (cohort_week, week) DO UPDATE SET users = users + 1
+            ''', (cohort_week, week))
+        
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS achievements (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                achievement_id TEXT,
-                earned_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
+            INSERT INTO data_versions (user_id, version, created_at, updated_at)
+            VALUES (?, 1, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET version = version + 1, updated_at = excluded.updated_at
+        ''', (user_id, now, now))
     
-    def add_user(self, user_id: int, username: str = None, first_name: str = None):
-        """Добавление нового пользователя"""
-        conn = sqlite3.connect(self.db_path)
+    def get_data_version(self, user_id: int) -> int:
+        """Текущая версия данных пользователя"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT version FROM data_versions WHERE user_id = ?', (user_id,))
+        result = cursor.fetchone()
+        return result[0] if result else 0
+    
+    def get_recently_active_users(self, since: int, limit: int = 1000) -> List[int]:
+        """Пользователи, чьи данные менялись с момента since (секунды Unix), от недавних к давним"""
+        conn = self._get_connection()
         cursor = conn.cursor()
         
         cursor.execute('''
-            INSERT OR IGNORE INTO users (user_id, username, first_name)
-            VALUES (?, ?, ?)
-        ''', (user_id, username, first_name))
+            SELECT user_id FROM data_versions
+            WHERE updated_at >= ?
+            ORDER BY updated_at DESC
+            LIMIT ?
+        ''', (since, limit))
+        return [row[0] for row in cursor.fetchall()]
+    
+    def rebuild_rollups(self):
+        """Перестроение дневных сводок по журналу транзакций"""
+        conn = self._get_connection()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            rebuild_rollups(cursor)
+            rebuild_global_rollups(cursor)
+    
+    def stream_global_rollups(self, until_id: int = None,
+                              chunk_size: int = EXPORT_BATCH_SIZE) -> Tuple[Dict[Tuple, Tuple[int, int]], int]:
+        """Общие дневные сводки, посчитанные заново по журналу транзакций с id <= until_id
         
-        conn.commit()
-        conn.close()
+        Журнал читается окнами по первичному ключу, каждое окно агрегируется
+        в SQLite; в памяти только суммы по (день, тип, категория). Возвращает
+        {(day, type, category): (total, count)} и until_id.
+        """
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        if until_id is None:
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM transactions')
+            until_id = cursor.fetchone()[0]
+        
+        totals = {}
+        for start in range(0, until_id, chunk_size):
+            cursor.execute('''
+                SELECT date / 86400, transaction_type, COALESCE(category, ''), SUM(amount), COUNT(*)
+                FROM transactions
+                WHERE id > ? AND id <= ?
+                GROUP BY 1, 2, 3
+            ''', (start, min(start + chunk_size, until_id)))
+            for day, transaction_type, category, total, count in cursor:
+                key = (day, transaction_type, category)
+                stored_total, stored_count = totals.get(key, (0, 0))
+                totals[key] = (stored_total + total, stored_count + count)
+        return totals, until_id
     
-    def add_transaction(self, user_id: int, amount: float, category: str, 
-                       description: str, transaction_type: str):
-        """Добавление транзакции"""
-        conn = sqlite3.connect(self.db_path)
+    def replace_global_rollups(self, totals: Dict[Tuple, Tuple[int, int]], until_id: int) -> int:
+        """Замена общих сводок пересчитанными stream_global_rollups
+        
+        Операции, записанные после until_id, досчитываются в той же транзакции.
+        Возвращает число исправленных строк сводки.
+        """
+        totals = dict(totals)
+        conn = self._get_connection()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('''
+                SELECT date / 86400, transaction_type, COALESCE(category, ''), SUM(amount), COUNT(*)
+                FROM transactions
+                WHERE id > ?
+                GROUP BY 1, 2, 3
+            ''', (until_id,))
+            for day, transaction_type, category, total, count in cursor.fetchall():
+                key = (day, transaction_type, category)
+                stored_total, stored_count = totals.get(key, (0, 0))
+                totals[key] = (stored_total + total, stored_count + count)
+            
+            cursor.execute('SELECT day, transaction_type, category, total, count FROM global_rollups')
+            stored = {tuple(row[:3]): tuple(row[3:]) for row in cursor}
+            drifts = sum(stored.get(key) != totals.get(key) for key in totals.keys() | stored.keys())
+            
+            if drifts:
+                cursor.execute('DELETE FROM global_rollups')
+                cursor.executemany('''
+                    INSERT INTO global_rollups (day, transaction_type, category, total, count)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', [(*key, total, count) for key, (total, count) in totals.items()])
+        
+        return drifts
+    
+    def recompute_global_rollups(self, chunk_size: int = EXPORT_BATCH_SIZE) -> int:
+        """Потоковый пересчет общих сводок по журналу; возвращает число исправленных строк"""
+        totals, until_id = self.stream_global_rollups(chunk_size=chunk_size)
+        return self.replace_global_rollups(totals, until_id)
+    
+    def get_global_stats(self, days: int = ADMIN_STATS_DAYS,
+                         cohort_weeks: int = ADMIN_STATS_COHORT_WEEKS) -> Dict:
+        """Статистика по всем пользователям из общих счетчиков
+        
+        Все выборки идут по первичным ключам и индексам небольших таблиц
+        global_rollups, activity_weeks и data_versions - журнал не читается.
+        """
+        conn = self._get_connection()
         cursor = conn.cursor()
+        now = int(time.time())
+        since = now - days * SECONDS_PER_DAY
         
+        active = {}
+        for window in sorted({1, 7, days}):
+            cursor.execute('SELECT COUNT(*) FROM data_versions WHERE updated_at >= ?',
+                           (now - window * SECONDS_PER_DAY,))
+            active[window] = cursor.fetchone()[0]
+        cursor.execute('SELECT COUNT(*) FROM data_versions WHERE created_at >= ?', (since,))
+        new_users = cursor.fetchone()[0]
+        cursor.execute('SELECT COALESCE(SUM(users), 0) FROM activity_weeks WHERE week = cohort_week')
+        users = cursor.fetchone()[0]
+        
+        first_day = since // SECONDS_PER_DAY + 1
         cursor.execute('''
-            INSERT INTO transactions (user_id, amount, category, description, transaction_type)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, amount, category, description, transaction_type))
+            SELECT transaction_type, SUM(total), SUM(count)
+            FROM global_rollups
+            WHERE day >= ?
+            GROUP BY transaction_type
+        ''', (first_day,))
+        volume = {transaction_type: (total, count) for transaction_type, total, count in cursor}
+        income, income_count = volume.get('income', (0, 0))
+        expense, expense_count = volume.get('expense', (0, 0))
+        
+        cursor.execute('''
+            SELECT category, SUM(total) AS amount, SUM(count)
+            FROM global_rollups
+            WHERE day >= ? AND transaction_type = 'expense'
+            GROUP BY category
+            ORDER BY amount DESC
+            LIMIT 5
+        ''', (first_day,))
+        top_categories = [(category, from_minor_units(total), count) for category, total, count in cursor]
         
-        conn.commit()
-        conn.close()
+        # Удержание: доля когорты, менявшей данные через 1, 2, ... недель после первой
+        week = week_number(now)
+        first_cohort = week - cohort_weeks + 1
+        cursor.execute('''
+            SELECT cohort_week, week, users FROM activity_weeks WHERE cohort_week >= ?
+        ''', (first_cohort,))
+        matrix = {(cohort, active_week): count for cohort, active_week, count in cursor}
+        retention = []
+        for cohort in range(first_cohort, week + 1):
+            size = matrix.get((cohort, cohort), 0)
+            shares = [matrix.get((cohort, cohort + offset), 0) / size if size else None
+                      for offset in range(1, week - cohort + 1)]
+            retention.append((week_start(cohort), size, shares))
+        
+        return {
+            'days': days,
+            'users': users,
+            'new_users': new_users,
+            'active': active,
+            'transactions': income_count + expense_count,
+            'income': from_minor_units(income),
+            'expense': from_minor_units(expense),
+            'top_categories': top_categories,
+            'retention': retention,
+        }
+    
+    def set_conversation_state(self, user_id: int, transaction_type: str, category: str,
+                               amount: Optional[float], expires_at: int):
+        """Сохранение шага диалога ввода операции до момента expires_at (секунды Unix)"""
+        conn = self._get_connection()
+        with conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO conversation_states
+                    (user_id, transaction_type, category, amount, expires_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (user_id, transaction_type, category,
+                  to_minor_units(amount) if amount is not None else None, expires_at))
+    
+    def get_conversation_state(self, user_id: int,
+                               now: int = None) -> Optional[Tuple[str, str, Optional[float], int]]:
+        """(transaction_type, category, amount, expires_at) или None, если диалога нет или он истек"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT transaction_type, category, amount, expires_at
+            FROM conversation_states
+            WHERE user_id = ? AND expires_at > ?
+        ''', (user_id, int(time.time()) if now is None else now))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        transaction_type, category, amount, expires_at = row
+        return (transaction_type, category,
+                from_minor_units(amount) if amount is not None else None, expires_at)
+    
+    def delete_conversation_state(self, user_id: int):
+        """Завершение диалога"""
+        conn = self._get_connection()
+        with conn:
+            conn.execute('DELETE FROM conversation_states WHERE user_id = ?', (user_id,))
+    
+    def sweep_conversation_states(self, now: int = None, limit: int = CONVERSATION_SWEEP_BATCH) -> int:
+        """Удаление не больше limit истекших диалогов; возвращает число удаленных"""
+        conn = self._get_connection()
+        with conn:
+            cursor = conn.execute('''
+                DELETE FROM conversation_states
+                WHERE user_id IN (
+                    SELECT user_id FROM conversation_states WHERE expires_at <= ? LIMIT ?
+                )
+            ''', (int(time.time()) if now is None else now, limit))
+            return cursor.rowcount
     
     def get_user_balance(self, user_id: int) -> float:
         """Получение баланса пользователя"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._get_connection()
         cursor = conn.cursor()
         
         cursor.execute('''
-            SELECT 
-                COALESCE(SUM(CASE WHEN transaction_type = 'income' THEN amount ELSE 0 END), 0) -
-                COALESCE(SUM(CASE WHEN transaction_type = 'expense' THEN amount ELSE 0 END), 0)
-            FROM transactions 
-            WHERE user_id = ?
+            SELECT income - expense FROM balances WHERE user_id = ?
         ''', (user_id,))
         
-        balance = cursor.fetchone()[0] or 0
-        conn.close()
-        return balance
+        result = cursor.fetchone()
+        return from_minor_units(result[0]) if result else 0
+    
+    def reconcile_balances(self, fix: bool = True) -> List[Dict]:
+        """Сверка материализованных балансов с журналом транзакций"""
+        conn = self._get_connection()
+        with conn:
+            cursor = conn.cursor()
+            # IMMEDIATE блокирует запись на время сверки и перестроения
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('''
+                WITH ledger AS (
+                    SELECT user_id,
+                        COALESCE(SUM(CASE WHEN transaction_type = 'income' THEN amount ELSE 0 END), 0) AS income,
+                        COALESCE(SUM(CASE WHEN transaction_type = 'expense' THEN amount ELSE 0 END), 0) AS expense
+                    FROM transactions
+                    GROUP BY user_id
+                )
+                SELECT ledger.user_id, ledger.income, ledger.expense,
+                       COALESCE(balances.income, 0), COALESCE(balances.expense, 0)
+                FROM ledger LEFT JOIN balances USING (user_id)
+                UNION ALL
+                SELECT balances.user_id, 0, 0, balances.income, balances.expense
+                FROM balances
+                WHERE balances.user_id NOT IN (SELECT user_id FROM ledger)
+            ''')
+            
+            drifts = []
+            for row in cursor:
+                # Суммы в копейках сравниваются точно
+                if row[1] != row[3] or row[2] != row[4]:
+                    drifts.append({
+                        'user_id': row[0],
+                        'income': from_minor_units(row[1]),
+                        'expense': from_minor_units(row[2]),
+                        'stored_income': from_minor_units(row[3]),
+                        'stored_expense': from_minor_units(row[4])
+                    })
+            
+            if fix:
+                rebuild_balances(cursor)
+        
+        return drifts
     
     def get_transactions(self, user_id: int, limit: int = 10) -> List[Dict]:
         """Получение последних транзакций пользователя"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._get_connection()
         cursor = conn.cursor()
         
         cursor.execute('''
-            SELECT amount, category, description, transaction_type, date
+            SELECT id, amount, category, description, transaction_type, date
             FROM transactions 
             WHERE user_id = ?
-            ORDER BY date DESC
+            ORDER BY date DESC, id DESC
             LIMIT ?
         ''', (user_id, limit))
         
-        transactions = []
-        for row in cursor.fetchall():
-            transactions.append({
-                'amount': row[0],
-                'category': row[1],
-                'description': row[2],
-                'type': row[3],
-                'date': row[4]
-            })
+        return [self._transaction_from_row(row) for row in cursor.fetchall()]
+    
+    def get_transactions_page(self, user_id: int, limit: int = 10, before: Tuple = None,
+                              after: Tuple = None) -> Tuple[List[Dict], bool, bool]:
+        """Страница истории по курсору (timestamp, id) без OFFSET
+        
+        before - курсор для более старых записей, after - для более новых.
+        Возвращает транзакции от новых к старым и признаки наличия
+        более старых и более новых страниц.
+        """
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        # Берем на одну запись больше, чтобы узнать, есть ли следующая страница
+        if after is not None:
+            cursor.execute('''
+                SELECT id, amount, category, description, transaction_type, date
+                FROM transactions
+                WHERE user_id = ? AND (date, id) > (?, ?)
+                ORDER BY date ASC, id ASC
+                LIMIT ?
+            ''', (user_id, after[0], after[1], limit + 1))
+        elif before is not None:
+            cursor.execute('''
+                SELECT id, amount, category, description, transaction_type, date
+                FROM transactions
+                WHERE user_id = ? AND (date, id) < (?, ?)
+                ORDER BY date DESC, id DESC
+                LIMIT ?
+            ''', (user_id, before[0], before[1], limit + 1))
+        else:
+            cursor.execute('''
+                SELECT id, amount, category, description, transaction_type, date
+                FROM transactions
+                WHERE user_id = ?
+                ORDER BY date DESC, id DESC
+                LIMIT ?
+            ''', (user_id, limit + 1))
         
-        conn.close()
-        return transactions
+        rows = cursor.fetchall()
+        has_more = len(rows) > limit
+        transactions = [self._transaction_from_row(row) for row in rows[:limit]]
+        
+        if after is not None:
+            transactions.reverse()
+            return transactions, True, has_more
+        return transactions, has_more, before is not None
+    
+    def iter_transactions(self, user_id: int,
+                          batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[List[Tuple]]:
+        """Потоковое чтение всей истории пользователя пачками кортежей
+        
+        Каждая пачка - список (date, amount, category, description, type)
+        от старых к новым. История целиком в память не загружается.
+        """
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        # Дата и сумма переводятся в строку и рубли самой SQLite, без цикла в Python
+        cursor.execute('''
+            SELECT datetime(date, 'unixepoch'), amount / 100.0, category, description, transaction_type
+            FROM transactions
+            WHERE user_id = ?
+            ORDER BY date, id
+        ''', (user_id,))
+        
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+    
+    def _transaction_from_row(self, row: Tuple) -> Dict:
+        """Преобразование строки transactions в словарь"""
+        return {
+            'id': row[0],
+            'amount': from_minor_units(row[1]),
+            'category': row[2],
+            'description': row[3],
+            'type': row[4],
+            'date': format_timestamp(row[5]),
+            'timestamp': row[5]
+        }
     
     def get_expenses_by_category(self, user_id: int, days: int = 30) -> List[Tuple]:
         """Получение расходов по категориям за период"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._get_connection()
         cursor = conn.cursor()
         
+        # Читаем дневные сводки вместо отдельных транзакций
+        first_day = int(time.time()) // SECONDS_PER_DAY - int(days)
         cursor.execute('''
-            SELECT category, SUM(amount)
-            FROM transactions 
-            WHERE user_id = ? AND transaction_type = 'expense' 
-            AND date >= datetime('now', '-{} days')
+            SELECT category, SUM(total)
+            FROM daily_rollups
+            WHERE user_id = ? AND transaction_type = 'expense'
+            AND day >= ?
             GROUP BY category
-            ORDER BY SUM(amount) DESC
-        '''.format(days), (user_id,))
+            ORDER BY SUM(total) DESC
+        ''', (user_id, first_day))
         
-        result = cursor.fetchall()
-        conn.close()
+        result = [(category, from_minor_units(total)) for category, total in cursor.fetchall()]
         return result
     
-    def add_goal(self, user_id: int, title: str, target_amount: float, goal_type: str):
-        """Добавление финансовой цели"""
-        conn = sqlite3.connect(self.db_path)
+    def get_rollup_frame(self, user_id: int) -> pd.DataFrame:
+        """Все дневные сводки пользователя столбцами: type, day, category, total, count
+        
+        total остается в копейках (int64): суммирование по столбцу точное,
+        перевод в рубли делает потребитель после агрегации.
+        """
+        return pd.read_sql_query('''
+            SELECT transaction_type AS type, day, category, total, count
+            FROM daily_rollups
+            WHERE user_id = ?
+        ''', self._get_connection(), params=(user_id,),
+            dtype={'type': object, 'day': 'int64', 'category': object, 'total': 'int64', 'count': 'int64'})
+    
+    def get_daily_totals(self, user_id: int, since: int = None,
+                         until: int = None) -> List[Tuple[str, float, float]]:
+        """Доходы и расходы по дням: [(YYYY-MM-DD, доходы, расходы)] от старых к новым
+        
+        since и until - секунды Unix, период [since, until) расширяется до целых суток UTC.
+        """
+        return self._get_period_totals(user_id, "date(day * 86400, 'unixepoch')", since, until)
+    
+    def get_monthly_totals(self, user_id: int, since: int = None, until: int = None,
+                           limit: int = None) -> List[Tuple[str, float, float]]:
+        """Доходы и расходы по месяцам: [(YYYY-MM, доходы, расходы)] от старых к новым
+        
+        limit - только последние limit месяцев с операциями.
+        """
+        return self._get_period_totals(user_id, "strftime('%Y-%m', day * 86400, 'unixepoch')",
+                                       since, until, limit)
+    
+    def _get_period_totals(self, user_id: int, period: str, since: Optional[int],
+                           until: Optional[int], limit: int = None) -> List[Tuple[str, float, float]]:
+        """Суммы доходов и расходов из дневных сводок, сгруппированные по выражению period"""
+        conn = self._get_connection()
         cursor = conn.cursor()
         
-        cursor.execute('''
-            INSERT INTO goals (user_id, title, target_amount, goal_type)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, title, target_amount, goal_type))
+        # Вся история пользователя - это не больше одной строки сводки на день и категорию
+        first_day = since // SECONDS_PER_DAY if since is not None else 0
+        last_day = -(-until // SECONDS_PER_DAY) if until is not None else 2 ** 62
+        cursor.execute(f'''
+            SELECT {period} AS period,
+                   SUM(CASE WHEN transaction_type = 'income' THEN total ELSE 0 END),
+                   SUM(CASE WHEN transaction_type = 'income' THEN 0 ELSE total END)
+            FROM daily_rollups
+            WHERE user_id = ? AND day >= ? AND day < ?
+            GROUP BY period
+            ORDER BY period DESC
+            LIMIT ?
+        ''', (user_id, first_day, last_day, limit if limit is not None else -1))
         
-        conn.commit()
-        conn.close()
+        rows = cursor.fetchall()
+        rows.reverse()
+        return [(period, from_minor_units(income), from_minor_units(expense))
+                for period, income, expense in rows]
+    
+    def add_goal(self, user_id: int, title: str, target_amount: float, goal_type: str):
+        """Добавление финансовой цели"""
+        conn = self._get_connection()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO goals (user_id, title, target_amount, goal_type)
+                VALUES (?, ?, ?, ?)
+            ''', (user_id, title, to_minor_units(target_amount), goal_type))
+            self._bump_data_version(cursor, user_id)
     
     def get_user_goals(self, user_id: int) -> List[Dict]:
         """Получение целей пользователя"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._get_connection()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -186,52 +784,126 @@ class Database:
             goals.append({
                 'id': row[0],
                 'title': row[1],
-                'target_amount': row[2],
-                'current_amount': row[3],
+                'target_amount': from_minor_units(row[2]),
+                'current_amount': from_minor_units(row[3]),
                 'goal_type': row[4],
                 'is_completed': bool(row[5])
             })
-        
-        conn.close()
+
         return goals
     
-    def update_goal_progress(self, goal_id: int, amount: float):
-        """Обновление прогресса цели"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            UPDATE goals 
-            SET current_amount = current_amount + ?
-            WHERE id = ?
-        ''', (amount, goal_id))
-        
-        # Проверяем, достигнута ли цель
-        cursor.execute('''
-            UPDATE goals 
-            SET is_completed = TRUE
-            WHERE id = ? AND current_amount >= target_amount
-        ''', (goal_id,))
-        
-        conn.commit()
-        conn.close()
+    def update_goal_progress(self, goal_id: int, amount: float) -> List[str]:
+        """Обновление прогресса цели; возвращает впервые полученные достижения"""
+        conn = self._get_connection()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE goals 
+                SET current_amount = current_amount + ?
+                WHERE id = ?
+            ''', (to_minor_units(amount), goal_id))
+
+            cursor.execute('SELECT user_id FROM goals WHERE id = ?', (goal_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return []
+            user_id = row[0]
+            self._bump_data_version(cursor, user_id)
+            
+            # Проверяем, достигнута ли цель (только в момент достижения, а не при каждом пополнении)
+            cursor.execute('''
+                UPDATE goals 
+                SET is_completed = TRUE
+                WHERE id = ? AND current_amount >= target_amount AND NOT is_completed
+            ''', (goal_id,))
+            if cursor.rowcount != 1:
+                return []
+            
+            progress = self._load_achievement_progress(cursor, user_id, int(time.time()))
+            earned = progress.earn(['goal_reached'])
+            self._save_achievement_progress(cursor, user_id, progress)
+            return self._award_achievements(cursor, user_id, earned)
     
     def add_achievement(self, user_id: int, achievement_id: str):
         """Добавление достижения пользователю"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
+        conn = self._get_connection()
+        with conn:
+            self._insert_achievement(conn.cursor(), user_id, achievement_id)
+    
+    def _insert_achievement(self, cursor: sqlite3.Cursor, user_id: int, achievement_id: str):
+        """Запись достижения внутри уже открытой транзакции SQLite"""
         cursor.execute('''
             INSERT OR IGNORE INTO achievements (user_id, achievement_id)
             VALUES (?, ?)
         ''', (user_id, achievement_id))
+    
+    def _load_achievement_progress(self, cursor: sqlite3.Cursor, user_id: int, now: int) -> AchievementProgress:
+        """Счетчики достижений пользователя; при первом обращении заполняются по журналу"""
+        cursor.execute('''
+            SELECT week, week_income, week_expense, fast_food_since, earned
+            FROM achievement_progress
+            WHERE user_id = ?
+        ''', (user_id,))
+        row = cursor.fetchone()
+        if row is not None:
+            return AchievementProgress(*row)
+        return self._seed_achievement_progress(cursor, user_id, now)
+    
+    def _seed_achievement_progress(self, cursor: sqlite3.Cursor, user_id: int, now: int) -> AchievementProgress:
+        """Счетчики по уже записанной истории: последняя неделя, последний фастфуд, выданные достижения"""
+        cursor.execute('SELECT MIN(date), MAX(date) FROM transactions WHERE user_id = ?', (user_id,))
+        first, last = cursor.fetchone()
+        if last is None:
+            progress = AchievementProgress(week_number(now), fast_food_since=now)
+        else:
+            week = week_number(last)
+            cursor.execute('''
+                SELECT
+                    COALESCE(SUM(CASE WHEN transaction_type = 'income' THEN amount ELSE 0 END), 0),
+                    COALESCE(SUM(CASE WHEN transaction_type = 'expense' THEN amount ELSE 0 END), 0)
+                FROM transactions
+                WHERE user_id = ? AND date >= ?
+            ''', (user_id, (week * 7 - 3) * SECONDS_PER_DAY))
+            week_income, week_expense = cursor.fetchone()
+            cursor.execute('''
+                SELECT MAX(date) FROM transactions
+                WHERE user_id = ? AND transaction_type = 'expense' AND category = ?
+            ''', (user_id, FAST_FOOD_CATEGORY))
+            fast_food = cursor.fetchone()[0]
+            progress = AchievementProgress(week, week_income, week_expense,
+                                           fast_food if fast_food is not None else first)
         
-        conn.commit()
-        conn.close()
+        cursor.execute('SELECT achievement_id FROM achievements WHERE user_id = ?', (user_id,))
+        progress.earn(row[0] for row in cursor.fetchall() if row[0] in ACHIEVEMENT_BITS)
+        return progress
+    
+    def _save_achievement_progress(self, cursor: sqlite3.Cursor, user_id: int, progress: AchievementProgress):
+        """Запись счетчиков достижений"""
+        cursor.execute('''
+            INSERT INTO achievement_progress (user_id, week, week_income, week_expense, fast_food_since, earned)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET
+                week = excluded.week,
+                week_income = excluded.week_income,
+                week_expense = excluded.week_expense,
+                fast_food_since = excluded.fast_food_since,
+                earned = excluded.earned
+        ''', (user_id, progress.week, progress.week_income, progress.week_expense,
+              progress.fast_food_since, progress.earned))
+    
+    def _award_achievements(self, cursor: sqlite3.Cursor, user_id: int, achievement_ids: List[str]) -> List[str]:
+        """Выдача достижений с очками; уже выданное достижение очков повторно не дает"""
+        awarded = []
+        for achievement_id in achievement_ids:
+            self._insert_achievement(cursor, user_id, achievement_id)
+            if cursor.rowcount == 1:
+                self._add_points(cursor, user_id, ACHIEVEMENTS[achievement_id]['points'])
+                awarded.append(achievement_id)
+        return awarded
     
     def get_user_achievements(self, user_id: int) -> List[str]:
         """Получение достижений пользователя"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._get_connection()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -239,28 +911,153 @@ class Database:
         ''', (user_id,))
         
         achievements = [row[0] for row in cursor.fetchall()]
-        conn.close()
         return achievements
     
     def update_user_points(self, user_id: int, points: int):
         """Обновление очков пользователя"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
+        conn = self._get_connection()
+        with conn:
+            self._add_points(conn.cursor(), user_id, points)
+    
+    def _add_points(self, cursor: sqlite3.Cursor, user_id: int, points: int):
+        """Начисление очков внутри уже открытой транзакции SQLite"""
         cursor.execute('''
             UPDATE users SET points = points + ? WHERE user_id = ?
         ''', (points, user_id))
-        
-        conn.commit()
-        conn.close()
     
     def get_user_points(self, user_id: int) -> int:
         """Получение очков пользователя"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._get_connection()
         cursor = conn.cursor()
         
         cursor.execute('SELECT points FROM users WHERE user_id = ?', (user_id,))
         result = cursor.fetchone()
+
+        return result[0] if result else 0 
+    
+    def get_analytics_text(self, user_id: int) -> bool:
+        """Включена ли у пользователя аналитика текстом вместо графиков"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT analytics_text FROM users WHERE user_id = ?', (user_id,))
+        result = cursor.fetchone()
         
-        conn.close()
-        return result[0] if result else 0 
\ No newline at end of file
+        return bool(result[0]) if result else False
+    
+    def toggle_analytics_text(self, user_id: int) -> bool:
+        """Переключение аналитики текстом; возвращает новое значение"""
+        conn = self._get_connection()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO users (user_id, analytics_text) VALUES (?, 1)
+                ON CONFLICT (user_id) DO UPDATE SET analytics_text = 1 - analytics_text
+                RETURNING analytics_text
+            ''', (user_id,))
+            return bool(cursor.fetchone()[0])
+
+class WriteQueue:
+    """Очередь отложенной записи с групповым коммитом
+
+    Собственный поток только собирает пакеты. Если передан executor (поток
+    записи AsyncDatabase), пакет записывается в нем, и все записи идут через
+    одно соединение, не конкурируя за блокировку SQLite.
+    """
+
+    _STOP = object()
+
+    def __init__(self, db: Database, batch_size: int = WRITE_BATCH_SIZE,
+                 flush_interval_ms: int = WRITE_FLUSH_INTERVAL_MS, executor: Executor = None):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self._executor = executor
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='db-write-queue', daemon=True)
+        self._thread.start()
+
+    def submit(self, operation, *args) -> Future:
+        """Постановка записи в очередь; future завершится после коммита"""
+        future = Future()
+        with self._lock:
+            # После _STOP очередь никто не читает - future завис бы навсегда
+            if self._closed:
+                raise RuntimeError("Очередь записи закрыта")
+            self._queue.put((operation, args, future))
+        return future
+
+    def add_transaction(self, user_id: int, amount: float, category: str,
+                        description: str, transaction_type: str) -> Future:
+        """Отложенное добавление транзакции"""
+        return self.submit(self.db._insert_transaction, user_id, to_minor_units(amount), category,
+                           description, transaction_type)
+
+    def add_achievement(self, user_id: int, achievement_id: str) -> Future:
+        """Отложенное добавление достижения"""
+        return self.submit(self.db._insert_achievement, user_id, achievement_id)
+
+    def update_user_points(self, user_id: int, points: int) -> Future:
+        """Отложенное начисление очков"""
+        return self.submit(self.db._add_points, user_id, points)
+
+    def close(self):
+        """Запись оставшихся операций и остановка потока; новые записи после этого отклоняются"""
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                self._queue.put(self._STOP)
+        self._thread.join()
+
+    def _run(self):
+        """Сбор пакетов: сброс по batch_size записей или по flush_interval с первой записи"""
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is self._STOP:
+                break
+
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            if self._executor is None:
+                self._flush(batch)
+            else:
+                # Следующий пакет собирается, пока поток записи занят этим
+                self._executor.submit(self._flush, batch).result()
+
+    def _flush(self, batch: List[Tuple]):
+        """Запись пакета одной транзакцией"""
+        conn = self.db._get_connection()
+        try:
+            with conn:
+                cursor = conn.cursor()
+                results = [operation(cursor, *args) for operation, args, _ in batch]
+        except Exception:
+            # Ошибочная запись не должна отменять остальные - повторяем пакет по одной
+            for operation, args, future in batch:
+                try:
+                    with conn:
+                        result = operation(conn.cursor(), *args)
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            return
+
+        for (_, _, future), result in zip(batch, results):
+            future.set_result(result)
\ No newline at end of file
@@ -0,0 +1,66 @@
+"""
+Потоковый экспорт истории транзакций в CSV и Parquet
+"""
+
+import csv
+from database import Database
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet доступен только с установленным pyarrow
+    pa = pq = None
+
+EXPORT_COLUMNS = ('date', 'amount', 'category', 'description', 'type')
+
+EXPORT_FORMATS = ('csv', 'parquet')
+
+def parquet_available() -> bool:
+    """Установлен ли pyarrow для экспорта в Parquet"""
+    return pq is not None
+
+def export_csv(db: Database, user_id: int, path: str) -> int:
+    """Запись истории пользователя в CSV пачками из базы"""
+    exported = 0
+    # utf-8-sig, чтобы Excel правильно показал кириллицу и эмодзи
+    with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(EXPORT_COLUMNS)
+        for rows in db.iter_transactions(user_id):
+            writer.writerows(rows)
+            exported += len(rows)
+    return exported
+
+def export_parquet(db: Database, user_id: int, path: str) -> int:
+    """Запись истории пользователя в Parquet: одна пачка из базы - одна группа строк"""
+    if pq is None:
+        raise RuntimeError("Для экспорта в Parquet установите pyarrow")
+
+    schema = pa.schema([
+        ('date', pa.timestamp('s')),
+        ('amount', pa.float64()),
+        ('category', pa.string()),
+        ('description', pa.string()),
+        ('type', pa.string()),
+    ])
+
+    exported = 0
+    with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+        for rows in db.iter_transactions(user_id):
+            columns = list(zip(*rows))
+            batch = pa.record_batch([
+                pa.array(columns[0], pa.string()).cast(pa.timestamp('s')),
+                pa.array(columns[1], pa.float64()),
+                pa.array(columns[2], pa.string()),
+                pa.array(columns[3], pa.string()),
+                pa.array(columns[4], pa.string()),
+            ], schema=schema)
+            writer.write_batch(batch)
+            exported += len(rows)
+    return exported
+
+def export_transactions(db: Database, user_id: int, path: str, export_format: str) -> int:
+    """Экспорт истории в выбранном формате, возвращает число строк"""
+    if export_format == 'parquet':
+        return export_parquet(db, user_id, path)
+    return export_csv(db, user_id, path)
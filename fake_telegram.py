@@ -0,0 +1,153 @@
+"""
+Локальная замена Bot API Telegram для тестов и бенчмарков приема обновлений
+"""
+
+import asyncio
+import json
+import re
+import time
+from collections import Counter
+from typing import Dict, List
+from urllib.parse import parse_qsl, urlsplit
+from telegram.ext import Application, BaseUpdateProcessor
+from update_processor import UserOrderedUpdateProcessor
+from webhook import read_request, write_response
+
+TOKEN = '123456:TEST-TOKEN'
+
+def message_update(update_id: int, user_id: int, text: str) -> Dict:
+    """Обновление с текстовым сообщением пользователя в личном чате"""
+    user = {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user,
+            "text": text,
+        },
+    }
+
+class FakeTelegram:
+    """HTTP-сервер с методами Bot API, которые вызывает бот
+
+    getUpdates отдает обновления из add_updates, setWebhook запоминает адрес,
+    отправка сообщений отвечает через latency секунд - как сеть до Telegram.
+    post_updates играет роль Telegram в режиме webhook.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.updates: List[Dict] = []
+        self.sent: List[Dict] = []
+        self.calls = Counter()
+        self.webhook_url = None
+        self.retries = 0
+        self._server = None
+        self.port = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve_connection, '127.0.0.1', 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    def build_application(self, update_processor: BaseUpdateProcessor = None) -> Application:
+        """Application бота, настроенное на этот сервер вместо api.telegram.org
+
+        Обновления обрабатываются как в main.py, если не передан другой update_processor.
+        """
+        builder = Application.builder().token(TOKEN).base_url(self.base_url).job_queue(None)
+        return builder.concurrent_updates(update_processor or UserOrderedUpdateProcessor()).build()
+
+    def add_updates(self, updates: List[Dict]):
+        """Обновления для getUpdates"""
+        self.updates.extend(updates)
+
+    async def post_updates(self, url: str, updates: List[Dict], connections: int = 40,
+                           secret_token: str = None, retry_after: float = None) -> List[int]:
+        """Доставка обновлений на webhook не более чем через connections соединений; статусы ответов
+
+        Как и Telegram, следующее обновление чата отправляется только после
+        ответа на предыдущее, разные чаты доставляются параллельно. С retry_after
+        отклоненное обновление (503) повторяется через retry_after секунд.
+        """
+        target = urlsplit(url)
+        secret_header = f"X-Telegram-Bot-Api-Secret-Token: {secret_token}\r\n" if secret_token else ""
+        statuses = [0] * len(updates)
+        chats = {}
+        for index, update in enumerate(updates):
+            chats.setdefault(update['message']['chat']['id'], []).append(index)
+        pending = iter(chats.values())
+
+        # Запросы пишутся в сокет напрямую: клиент не должен отнимать процессор у измеряемого бота
+        async def deliver():
+            reader, writer = await asyncio.open_connection(target.hostname, target.port)
+            try:
+                for indexes in pending:
+                    for index in indexes:
+                        body = json.dumps(updates[index]).encode()
+                        while True:
+                            writer.write((f"POST {target.path} HTTP/1.1\r\nHost: {target.netloc}\r\n"
+                                          f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+                                          f"{secret_header}\r\n").encode() + body)
+                            await writer.drain()
+                            head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1')
+                            statuses[index] = int(head.split(' ', 2)[1])
+                            length = re.search(r'(?i)content-length:\s*(\d+)', head)
+                            await reader.readexactly(int(length.group(1)) if length else 0)
+                            if statuses[index] != 503 or retry_after is None:
+                                break
+                            self.retries += 1
+                            await asyncio.sleep(retry_after)
+            finally:
+                writer.close()
+
+        await asyncio.gather(*(deliver() for _ in range(connections)))
+        return statuses
+
+    async def _serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                _, path, _, headers, body = request
+                method = path.rsplit('/', 1)[-1]
+                params = dict(parse_qsl(body.decode())) if body else {}
+                self.calls[method] += 1
+                result = await self._call(method, params)
+                await write_response(writer, 200, json.dumps({"ok": True, "result": result}).encode())
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _call(self, method: str, params: Dict[str, str]):
+        """Ответ метода Bot API"""
+        if method == 'getMe':
+            return {"id": 123456, "is_bot": True, "first_name": "Finance", "username": "finance_test_bot"}
+        if method == 'getUpdates':
+            offset = int(params.get('offset', 0))
+            limit = int(params.get('limit', 100))
+            batch = [update for update in self.updates if update['update_id'] >= offset][:limit]
+            if not batch:
+                await asyncio.sleep(0.01)
+            return batch
+        if method == 'setWebhook':
+            self.webhook_url = params.get('url')
+            return True
+        if method in ('sendMessage', 'editMessageText'):
+            await asyncio.sleep(self.latency)
+            chat_id = int(params['chat_id'])
+            self.sent.append({'chat_id': chat_id, 'text': params.get('text')})
+            return {"message_id": len(self.sent), "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"}, "text": params.get('text')}
+        return True
@@ -1,24 +1,63 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ContextTypes, ConversationHandler
-from database import Database
-from analytics import Analytics
-from config import EXPENSE_CATEGORIES, INCOME_CATEGORIES, ACHIEVEMENTS, FINANCIAL_TIPS
+from telegram.ext import ContextTypes
+from async_database import AsyncDatabase
+from database import to_minor_units
+from render_pool import ChartRenderPool, RenderPoolBusy, RenderTimeout
+from text_analytics import TextAnalytics, admin_report
+from conversation_state import ConversationState, ConversationStore
+from callback_router import CallbackRouter
+from keyboards import KEYBOARDS
+from importer import import_file_async
+from exporter import EXPORT_FORMATS, export_transactions, parquet_available
+from config import (ACHIEVEMENTS, FINANCIAL_TIPS, HISTORY_PAGE_SIZE, ANALYTICS_TEXT_FALLBACK, ADMIN_ID)
+import logging
+import os
 import random
+import tempfile
 from datetime import datetime
 
-# Состояния для ConversationHandler
-CHOOSING_CATEGORY, ENTERING_AMOUNT, ENTERING_DESCRIPTION, CHOOSING_GOAL_TYPE, ENTERING_GOAL_AMOUNT = range(5)
+logger = logging.getLogger(__name__)
+
+# Тип аналитики из callback_data -> (метод Analytics, подпись к графику)
+ANALYTICS_CHARTS = {
+    "expenses": ("create_expense_pie_chart", "📊 Расходы по категориям за последние 30 дней"),
+    "income_vs_expense": ("create_income_vs_expense_chart", "📈 Доходы vs Расходы за последние 30 дней"),
+    "goals": ("create_savings_progress_chart", "🎯 Прогресс накоплений"),
+    "trends": ("create_monthly_trend_chart", "📊 Месячные тренды за последние 6 месяцев"),
+}
 
 class BotHandlers:
-    def __init__(self, db: Database, analytics: Analytics):
+    def __init__(self, db: AsyncDatabase, render_pool: ChartRenderPool, text_analytics: TextAnalytics,
+                 conversations: ConversationStore):
         self.db = db
-        self.analytics = analytics
-        self.user_states = {}  # Для хранения состояния пользователей
+        self.render_pool = render_pool
+        self.text_analytics = text_analytics
+        self.conversations = conversations  # Шаги ввода операции (в базе, с TTL)
+        self.router = self._build_router()
+    
+    def _build_router(self) -> CallbackRouter:
+        """Таблица обработчиков кнопок, заполняется один раз"""
+        router = CallbackRouter()
+        router.exact("income", self.show_income_categories)
+        router.exact("expense", self.show_expense_categories)
+        router.exact("balance", self.show_balance)
+        router.exact("goals", self.show_goals)
+        router.exact("achievements", self.show_achievements)
+        router.exact("tips", self.show_tips)
+        router.exact("analytics", self.show_analytics_menu)
+        router.exact("history", self.show_history)
+        router.exact("add_goal", self.start_add_goal)
+        router.exact("back_to_main", self.show_main_menu)
+        router.exact("cancel", self.cancel_entry)
+        router.prefix("history", self.show_history)
+        router.prefix("category", self.handle_category_selection)
+        router.prefix("analytics", self.handle_analytics_selection)
+        return router
     
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /start"""
         user = update.effective_user
-        self.db.add_user(user.id, user.username, user.first_name)
+        await self.db.add_user(user.id, user.username, user.first_name)
         
         welcome_text = f"""
 🎉 Привет, {user.first_name}! 
@@ -35,157 +74,118 @@ class BotHandlers:
 Выбери действие:
         """
         
-        keyboard = [
-            [InlineKeyboardButton("💰 Доход", callback_data="income")],
-            [InlineKeyboardButton("💸 Расход", callback_data="expense")],
-            [InlineKeyboardButton("📊 Баланс", callback_data="balance")],
-            [InlineKeyboardButton("🎯 Цели", callback_data="goals")],
-            [InlineKeyboardButton("🏆 Достижения", callback_data="achievements")],
-            [InlineKeyboardButton("💡 Советы", callback_data="tips")],
-            [InlineKeyboardButton("📈 Аналитика", callback_data="analytics")],
-            [InlineKeyboardButton("📋 История", callback_data="history")]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(welcome_text, reply_markup=reply_markup)
+        await update.message.reply_text(welcome_text, reply_markup=KEYBOARDS['main_menu'])
     
     async def button_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик нажатий на кнопки"""
         query = update.callback_query
         await query.answer()
         
-        if query.data == "income":
-            await self.show_income_categories(query)
-        elif query.data == "expense":
-            await self.show_expense_categories(query)
-        elif query.data == "balance":
-            await self.show_balance(query)
-        elif query.data == "goals":
-            await self.show_goals(query)
-        elif query.data == "achievements":
-            await self.show_achievements(query)
-        elif query.data == "tips":
-            await self.show_tips(query)
-        elif query.data == "analytics":
-            await self.show_analytics_menu(query)
-        elif query.data == "history":
-            await self.show_history(query)
-        elif query.data.startswith("category_"):
-            await self.handle_category_selection(query)
-        elif query.data.startswith("analytics_"):
-            await self.handle_analytics_selection(query)
-        elif query.data == "add_goal":
-            await self.start_add_goal(query)
-        elif query.data == "back_to_main":
-            await self.show_main_menu(query)
+        route = self.router.resolve(query.data)
+        if route is not None:
+            handler, args = route
+            await handler(query, *args)
     
     async def show_income_categories(self, query):
         """Показать категории доходов"""
-        keyboard = []
-        for category in INCOME_CATEGORIES:
-            keyboard.append([InlineKeyboardButton(category, callback_data=f"category_income_{category}")])
-        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("Выберите категорию дохода:", reply_markup=reply_markup)
+        await query.edit_message_text("Выберите категорию дохода:", reply_markup=KEYBOARDS['income_categories'])
     
     async def show_expense_categories(self, query):
         """Показать категории расходов"""
-        keyboard = []
-        for category in EXPENSE_CATEGORIES:
-            keyboard.append([InlineKeyboardButton(category, callback_data=f"category_expense_{category}")])
-        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("Выберите категорию расхода:", reply_markup=reply_markup)
+        await query.edit_message_text("Выберите категорию расхода:", reply_markup=KEYBOARDS['expense_categories'])
     
-    async def handle_category_selection(self, query):
-        """Обработка выбора категории"""
-        parts = query.data.split("_", 2)
-        transaction_type = parts[1]
-        category = parts[2]
+    async def handle_category_selection(self, query, selection: str):
+        """Обработка выбора категории: selection - "<тип>_<категория>" из callback_data"""
+        transaction_type, _, category = selection.partition("_")
         
         # Сохраняем состояние пользователя
-        self.user_states[query.from_user.id] = {
-            'transaction_type': transaction_type,
-            'category': category
-        }
+        await self.conversations.save(query.from_user.id, ConversationState(transaction_type, category))
         
         await query.edit_message_text(
             f"Введите сумму ({'дохода' if transaction_type == 'income' else 'расхода'}):\n"
             f"Категория: {category}",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Отмена", callback_data="back_to_main")]])
+            reply_markup=KEYBOARDS['cancel']
         )
-        
-        return ENTERING_AMOUNT
     
-    async def handle_amount_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def handle_text_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Текст пользователя - сумма или описание, в зависимости от шага диалога"""
+        state = await self.conversations.get(update.effective_user.id)
+        if state is None:
+            return
+        if state.amount is None:
+            await self.handle_amount_input(update, context, state)
+        else:
+            await self.handle_description_input(update, context, state)
+    
+    async def handle_amount_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                  state: ConversationState = None):
         """Обработка ввода суммы"""
         try:
             amount = float(update.message.text.replace(',', '.'))
+            to_minor_units(amount)  # inf, nan и суммы, не помещающиеся в базу
             if amount <= 0:
                 await update.message.reply_text("Сумма должна быть больше нуля!")
-                return ENTERING_AMOUNT
+                return
             
             user_id = update.effective_user.id
-            if user_id not in self.user_states:
+            if state is None:
+                state = await self.conversations.get(user_id)
+            if state is None:
                 await update.message.reply_text("Произошла ошибка. Попробуйте снова.")
-                return ConversationHandler.END
+                return
             
-            state = self.user_states[user_id]
-            state['amount'] = amount
+            state.amount = amount
+            await self.conversations.save(user_id, state)
             
             await update.message.reply_text(
                 f"Введите описание транзакции:\n"
                 f"Сумма: {amount} руб.\n"
-                f"Категория: {state['category']}"
+                f"Категория: {state.category}"
             )
             
-            return ENTERING_DESCRIPTION
-            
         except ValueError:
             await update.message.reply_text("Пожалуйста, введите корректную сумму!")
-            return ENTERING_AMOUNT
     
-    async def handle_description_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def handle_description_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                       state: ConversationState = None):
         """Обработка ввода описания"""
         description = update.message.text
         user_id = update.effective_user.id
-        state = self.user_states[user_id]
-        
-        # Сохраняем транзакцию
-        self.db.add_transaction(
+        if state is None:
+            state = await self.conversations.get(user_id)
+        if state is None or state.amount is None:
+            await update.message.reply_text("Произошла ошибка. Попробуйте снова.")
+            return
+        
+        # Сохраняем транзакцию; достижения выдаются в той же транзакции базы
+        earned = await self.db.add_transaction(
             user_id=user_id,
-            amount=state['amount'],
-            category=state['category'],
+            amount=state.amount,
+            category=state.category,
             description=description,
-            transaction_type=state['transaction_type']
+            transaction_type=state.transaction_type
         )
         
-        # Проверяем достижения
-        await self.check_achievements(user_id, state['amount'], state['transaction_type'])
-        
         # Очищаем состояние
-        del self.user_states[user_id]
+        await self.conversations.discard(user_id)
         
-        emoji = "💰" if state['transaction_type'] == 'income' else "💸"
+        emoji = "💰" if state.transaction_type == 'income' else "💸"
         await update.message.reply_text(
             f"{emoji} Транзакция сохранена!\n"
-            f"Сумма: {state['amount']} руб.\n"
-            f"Категория: {state['category']}\n"
-            f"Описание: {description}",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Главное меню", callback_data="back_to_main")]])
+            f"Сумма: {state.amount} руб.\n"
+            f"Категория: {state.category}\n"
+            f"Описание: {description}"
+            + self.format_new_achievements(earned),
+            reply_markup=KEYBOARDS['main_menu_link']
         )
-        
-        return ConversationHandler.END
     
     async def show_balance(self, query):
         """Показать баланс пользователя"""
         user_id = query.from_user.id
-        balance = self.db.get_user_balance(user_id)
+        balance = await self.db.get_user_balance(user_id)
         
         # Получаем последние транзакции
-        transactions = self.db.get_transactions(user_id, 5)
+        transactions = await self.db.get_transactions(user_id, 5)
         
         balance_text = f"💰 Ваш баланс: {balance:.2f} руб.\n\n"
         
@@ -196,22 +196,15 @@ class BotHandlers:
                 date = trans['date'][:10]  # Берем только дату
                 balance_text += f"{emoji} {trans['amount']} руб. - {trans['category']} ({date})\n"
         
-        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(balance_text, reply_markup=reply_markup)
+        await query.edit_message_text(balance_text, reply_markup=KEYBOARDS['back_to_main'])
     
     async def show_goals(self, query):
         """Показать цели пользователя"""
         user_id = query.from_user.id
-        goals = self.db.get_user_goals(user_id)
+        goals = await self.db.get_user_goals(user_id)
         
         if not goals:
             goals_text = "🎯 У вас пока нет финансовых целей.\n\nСоздайте свою первую цель!"
-            keyboard = [
-                [InlineKeyboardButton("➕ Добавить цель", callback_data="add_goal")],
-                [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
-            ]
         else:
             goals_text = "🎯 Ваши финансовые цели:\n\n"
             for goal in goals:
@@ -219,31 +212,18 @@ class BotHandlers:
                 progress = (goal['current_amount'] / goal['target_amount']) * 100
                 goals_text += f"{status} {goal['title']}\n"
                 goals_text += f"   Прогресс: {goal['current_amount']:.2f}/{goal['target_amount']:.2f} руб. ({progress:.1f}%)\n\n"
-            
-            keyboard = [
-                [InlineKeyboardButton("➕ Добавить цель", callback_data="add_goal")],
-                [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
-            ]
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(goals_text, reply_markup=reply_markup)
+        await query.edit_message_text(goals_text, reply_markup=KEYBOARDS['goals'])
     
     async def start_add_goal(self, query):
         """Начать процесс добавления цели"""
-        keyboard = [
-            [InlineKeyboardButton("💰 Накопить сумму", callback_data="goal_type_save")],
-            [InlineKeyboardButton("💸 Не тратить на категорию", callback_data="goal_type_spend")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="goals")]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("Выберите тип цели:", reply_markup=reply_markup)
+        await query.edit_message_text("Выберите тип цели:", reply_markup=KEYBOARDS['goal_types'])
     
     async def show_achievements(self, query):
         """Показать достижения пользователя"""
         user_id = query.from_user.id
-        user_achievements = self.db.get_user_achievements(user_id)
-        points = self.db.get_user_points(user_id)
+        user_achievements = await self.db.get_user_achievements(user_id)
+        points = await self.db.get_user_points(user_id)
         
         achievements_text = f"🏆 Ваши достижения\n\n"
         achievements_text += f"💎 Очки: {points}\n\n"
@@ -264,10 +244,7 @@ class BotHandlers:
             status = "✅" if achievement_id in user_achievements else "🔒"
             achievements_text += f"{status} {achievement['name']} (+{achievement['points']} очков)\n"
         
-        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(achievements_text, reply_markup=reply_markup)
+        await query.edit_message_text(achievements_text, reply_markup=KEYBOARDS['back_to_main'])
     
     async def show_tips(self, query):
         """Показать финансовые советы"""
@@ -281,55 +258,53 @@ class BotHandlers:
         for i, tip in enumerate(other_tips, 1):
             tips_text += f"{i}. {tip}\n"
         
-        keyboard = [
-            [InlineKeyboardButton("🔄 Другой совет", callback_data="tips")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(tips_text, reply_markup=reply_markup)
+        await query.edit_message_text(tips_text, reply_markup=KEYBOARDS['tips'])
     
-    async def show_analytics_menu(self, query):
+    async def show_analytics_menu(self, query, text_mode: bool = None):
         """Показать меню аналитики"""
-        keyboard = [
-            [InlineKeyboardButton("📊 Расходы по категориям", callback_data="analytics_expenses")],
-            [InlineKeyboardButton("📈 Доходы vs Расходы", callback_data="analytics_income_vs_expense")],
-            [InlineKeyboardButton("🎯 Прогресс целей", callback_data="analytics_goals")],
-            [InlineKeyboardButton("📊 Месячные тренды", callback_data="analytics_trends")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        if text_mode is None:
+            text_mode = await self.db.get_analytics_text(query.from_user.id)
+        reply_markup = KEYBOARDS['analytics_menu_text' if text_mode else 'analytics_menu']
         await query.edit_message_text("📊 Выберите тип аналитики:", reply_markup=reply_markup)
     
-    async def handle_analytics_selection(self, query):
-        """Обработка выбора типа аналитики"""
+    async def handle_analytics_selection(self, query, analytics_type: str):
+        """Обработка выбора типа аналитики (часть callback_data после "analytics_")"""
         user_id = query.from_user.id
-        analytics_type = query.data.split("_", 1)[1]
+        
+        if analytics_type == "text":
+            # Переключатель "📄 Текстом": цифры вместо картинок (настройка хранится в базе)
+            await self.show_analytics_menu(query, await self.db.toggle_analytics_text(user_id))
+            return
+        
+        if analytics_type not in ANALYTICS_CHARTS:
+            await query.edit_message_text("Неизвестный тип аналитики")
+            return
+        chart, caption = ANALYTICS_CHARTS[analytics_type]
+        
+        reply_markup = KEYBOARDS['analytics_back']
+        
+        if await self.db.get_analytics_text(user_id):
+            await self.send_text_analytics(query, analytics_type, reply_markup)
+            return
+        
+        # График, нарисованный заранее фоновой задачей, отправляется сразу
+        chart_bytes = await self.render_pool.cached(chart, user_id)
+        if chart_bytes is not None:
+            await query.get_bot().send_photo(
+                chat_id=query.from_user.id,
+                photo=chart_bytes,
+                caption=caption,
+                reply_markup=reply_markup
+            )
+            await query.delete_message()
+            return
         
         await query.edit_message_text("📊 Генерирую график...")
         
         try:
-            if analytics_type == "expenses":
-                chart_bytes = self.analytics.create_expense_pie_chart(user_id)
-                caption = "📊 Расходы по категориям за последние 30 дней"
-            elif analytics_type == "income_vs_expense":
-                chart_bytes = self.analytics.create_income_vs_expense_chart(user_id)
-                caption = "📈 Доходы vs Расходы за последние 30 дней"
-            elif analytics_type == "goals":
-                chart_bytes = self.analytics.create_savings_progress_chart(user_id)
-                caption = "🎯 Прогресс накоплений"
-            elif analytics_type == "trends":
-                chart_bytes = self.analytics.create_monthly_trend_chart(user_id)
-                caption = "📊 Месячные тренды за последние 6 месяцев"
-            else:
-                await query.edit_message_text("Неизвестный тип аналитики")
-                return
+            chart_bytes = await self.render_pool.render(chart, user_id)
             
-            keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="analytics")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await context.bot.send_photo(
+            await query.get_bot().send_photo(
                 chat_id=query.from_user.id,
                 photo=chart_bytes,
                 caption=caption,
@@ -337,20 +312,51 @@ class BotHandlers:
             )
             
             # Удаляем сообщение "Генерирую график..."
-            await query.delete()
+            await query.delete_message()
             
+        except RenderPoolBusy:
+            if ANALYTICS_TEXT_FALLBACK:
+                await self.send_text_analytics(query, analytics_type, reply_markup,
+                                               "⏳ Сейчас строится много графиков, вот цифры:\n\n")
+            else:
+                await query.edit_message_text(
+                    "⏳ Сейчас строится много графиков, попробуйте через минуту.",
+                    reply_markup=reply_markup
+                )
+        except RenderTimeout:
+            await query.edit_message_text(
+                "⌛ График строился слишком долго, попробуйте позже.",
+                reply_markup=reply_markup
+            )
         except Exception as e:
             await query.edit_message_text(f"Ошибка при создании графика: {str(e)}")
     
-    async def show_history(self, query):
-        """Показать историю транзакций"""
+    async def send_text_analytics(self, query, analytics_type: str, reply_markup, prefix: str = ""):
+        """Аналитика текстом: те же агрегаты, что и у графиков, без отрисовки"""
+        text = await self.db.run_read(self.text_analytics.render, analytics_type, query.from_user.id)
+        await query.edit_message_text(prefix + text, parse_mode='HTML', reply_markup=reply_markup)
+    
+    async def show_history(self, query, page: str = None):
+        """Показать историю транзакций постранично"""
         user_id = query.from_user.id
-        transactions = self.db.get_transactions(user_id, 10)
+        
+        # Курсор страницы (время, id) приходит в callback_data кнопок навигации: "older_..." или "newer_..."
+        before = after = None
+        if page is not None:
+            direction, _, cursor = page.partition("_")
+            if direction == "older":
+                before = self._parse_history_cursor(cursor)
+            elif direction == "newer":
+                after = self._parse_history_cursor(cursor)
+        
+        transactions, has_older, has_newer = await self.db.get_transactions_page(
+            user_id, HISTORY_PAGE_SIZE, before=before, after=after
+        )
         
         if not transactions:
             history_text = "📋 У вас пока нет транзакций.\n\nНачните вести учет своих финансов!"
         else:
-            history_text = "📋 Последние транзакции:\n\n"
+            history_text = "📋 Последние транзакции:\n\n" if not has_newer else "📋 История транзакций:\n\n"
             for i, trans in enumerate(transactions, 1):
                 emoji = "💰" if trans['type'] == 'income' else "💸"
                 date = trans['date'][:10]
@@ -359,63 +365,149 @@ class BotHandlers:
                 history_text += f"   {trans['description']}\n"
                 history_text += f"   {date}\n\n"
         
-        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        navigation = []
+        if transactions and has_newer:
+            navigation.append(InlineKeyboardButton(
+                "⬅️ Новее", callback_data=f"history_newer_{self._history_cursor(transactions[0])}"
+            ))
+        if transactions and has_older:
+            navigation.append(InlineKeyboardButton(
+                "Старее ➡️", callback_data=f"history_older_{self._history_cursor(transactions[-1])}"
+            ))
+        
+        if navigation:
+            reply_markup = InlineKeyboardMarkup([navigation, *KEYBOARDS['back_to_main'].inline_keyboard])
+        else:
+            reply_markup = KEYBOARDS['back_to_main']
         
         await query.edit_message_text(history_text, reply_markup=reply_markup)
     
+    @staticmethod
+    def _history_cursor(transaction: dict) -> str:
+        """Курсор страницы истории для callback_data"""
+        return f"{transaction['timestamp']}_{transaction['id']}"
+    
+    @staticmethod
+    def _parse_history_cursor(data: str) -> tuple:
+        """Разбор курсора страницы истории из callback_data"""
+        timestamp, transaction_id = data.split("_", 1)
+        return int(timestamp), int(transaction_id)
+    
     async def show_main_menu(self, query):
         """Показать главное меню"""
-        keyboard = [
-            [InlineKeyboardButton("💰 Доход", callback_data="income")],
-            [InlineKeyboardButton("💸 Расход", callback_data="expense")],
-            [InlineKeyboardButton("📊 Баланс", callback_data="balance")],
-            [InlineKeyboardButton("🎯 Цели", callback_data="goals")],
-            [InlineKeyboardButton("🏆 Достижения", callback_data="achievements")],
-            [InlineKeyboardButton("💡 Советы", callback_data="tips")],
-            [InlineKeyboardButton("📈 Аналитика", callback_data="analytics")],
-            [InlineKeyboardButton("📋 История", callback_data="history")]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("Выберите действие:", reply_markup=reply_markup)
+        await query.edit_message_text("Выберите действие:", reply_markup=KEYBOARDS['main_menu'])
     
-    async def check_achievements(self, user_id: int, amount: float, transaction_type: str):
-        """Проверка и выдача достижений"""
-        balance = self.db.get_user_balance(user_id)
-        transactions = self.db.get_transactions(user_id, 1000)
-        
-        # Проверяем различные достижения
-        achievements_to_check = []
-        
-        # Первая экономия
-        if transaction_type == 'income' and balance > 0:
-            achievements_to_check.append('first_save')
-        
-        # Большой накопитель
-        if balance >= 1000:
-            achievements_to_check.append('big_saver')
-        
-        # Проверяем недельную экономию (упрощенно)
-        if len(transactions) >= 7:
-            achievements_to_check.append('week_saver')
-        
-        # Выдаем достижения
-        for achievement_id in achievements_to_check:
-            self.db.add_achievement(user_id, achievement_id)
-            if achievement_id in ACHIEVEMENTS:
-                achievement = ACHIEVEMENTS[achievement_id]
-                self.db.update_user_points(user_id, achievement['points'])
+    async def cancel_entry(self, query):
+        """Кнопка "Отмена" при вводе операции: начатый ввод забывается, а не ждет TTL"""
+        await self.conversations.discard(query.from_user.id)
+        await self.show_main_menu(query)
     
-    async def cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Отмена операции"""
+    def format_new_achievements(self, achievement_ids) -> str:
+        """Строки о новых достижениях для ответа пользователю"""
+        text = ""
+        for achievement_id in achievement_ids or ():
+            achievement = ACHIEVEMENTS[achievement_id]
+            text += f"\n\n🏆 Новое достижение: {achievement['name']} (+{achievement['points']} очков)"
+        return text
+    
+    async def start_import(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /import"""
+        await update.message.reply_text(
+            "📥 Импорт транзакций\n\n"
+            "Пришлите файл CSV (можно выписку из банка) или JSONL.\n"
+            "Колонки: дата, сумма, категория, описание, тип (доход/расход).\n"
+            "Если тип не указан, отрицательные суммы считаются расходами.\n"
+            "Неизвестные категории попадут в «💸 Другое».",
+            reply_markup=KEYBOARDS['main_menu_link']
+        )
+    
+    async def handle_import_document(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Импорт транзакций из присланного файла"""
+        document = update.message.document
         user_id = update.effective_user.id
-        if user_id in self.user_states:
-            del self.user_states[user_id]
+        file_name = (document.file_name or '').lower()
+        file_format = 'jsonl' if file_name.endswith(('.jsonl', '.json')) else 'csv'
+        
+        await update.message.reply_text("⏳ Импортирую транзакции...")
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            # Файл сохраняется на диск и читается потоком, а не целиком в память
+            path = os.path.join(tmp, 'import')
+            telegram_file = await context.bot.get_file(document.file_id)
+            await telegram_file.download_to_drive(path)
+            
+            try:
+                result = await import_file_async(self.db, user_id, path, file_format)
+            except Exception as e:
+                await update.message.reply_text(f"Ошибка при импорте: {str(e)}")
+                return
+        
+        text = f"✅ Импортировано транзакций: {result.imported}"
+        if result.skipped:
+            text += f"\n⚠️ Пропущено строк: {result.skipped}\n" + "\n".join(result.errors)
         
         await update.message.reply_text(
-            "Операция отменена.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Главное меню", callback_data="back_to_main")]])
+            text,
+            reply_markup=KEYBOARDS['main_menu_link']
         )
+
+    async def export_history(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /export [csv|parquet]"""
+        user_id = update.effective_user.id
+        export_format = context.args[0].lower() if context.args else 'csv'
+
+        if export_format not in EXPORT_FORMATS:
+            await update.message.reply_text("Использование: /export [csv|parquet]")
+            return
+        if export_format == 'parquet' and not parquet_available():
+            await update.message.reply_text("Экспорт в Parquet недоступен, используйте /export csv")
+            return
+
+        await update.message.reply_text("⏳ Готовлю выгрузку...")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            # История пишется в файл пачками и отправляется с диска, не собираясь в памяти
+            file_name = f"finance_{user_id}_{datetime.now().strftime('%Y%m%d')}.{export_format}"
+            path = os.path.join(tmp, file_name)
+
+            try:
+                exported = await self.db.run_read(export_transactions, self.db.db, user_id, path, export_format)
+            except Exception as e:
+                await update.message.reply_text(f"Ошибка при экспорте: {str(e)}")
+                return
+
+            if not exported:
+                await update.message.reply_text("У вас пока нет транзакций для выгрузки.")
+                return
+
+            with open(path, 'rb') as f:
+                await context.bot.send_document(
+                    chat_id=update.effective_chat.id,
+                    document=f,
+                    filename=file_name,
+                    caption=f"📤 Выгружено транзакций: {exported}"
+                )
+
+    async def admin_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /admin_stats (только для ADMIN_ID)"""
+        if not ADMIN_ID or update.effective_user.id != ADMIN_ID:
+            await update.message.reply_text("Команда доступна только администратору.")
+            return
+
+        stats = await self.db.get_global_stats()
+        await update.message.reply_text(admin_report(stats), parse_mode='HTML')
+
+    async def recompute_global_stats(self, context: ContextTypes.DEFAULT_TYPE = None):
+        """Сверка общих сводок с журналом транзакций (задача JobQueue)"""
+        drifts = await self.db.recompute_global_rollups()
+        if drifts:
+            logger.warning(f"Общие сводки расходились с журналом в {drifts} строках, исправлено")
+
+    async def cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Отмена операции"""
+        await self.conversations.discard(update.effective_user.id)
         
-        return ConversationHandler.END 
\ No newline at end of file
+        await update.message.reply_text(
+            "Операция отменена.",
+            reply_markup=KEYBOARDS['main_menu_link']
+        )
\ No newline at end of file
@@ -0,0 +1,213 @@
+"""
+Потоковый импорт транзакций из CSV, JSONL и банковских выписок
+"""
+
+import asyncio
+import csv
+import functools
+import json
+from datetime import datetime, timezone
+from typing import Dict, Iterator, Optional, TextIO, Tuple
+from database import Database, to_minor_units
+from async_database import AsyncDatabase
+from config import EXPENSE_CATEGORIES, INCOME_CATEGORIES
+
+# Названия колонок: наши, английские и из выписок популярных банков
+FIELD_ALIASES = {
+    'date': ('date', 'дата', 'дата операции', 'дата платежа'),
+    'amount': ('amount', 'сумма', 'сумма операции', 'сумма платежа'),
+    'category': ('category', 'категория'),
+    'description': ('description', 'описание', 'comment', 'комментарий', 'назначение платежа'),
+    'type': ('type', 'тип', 'transaction_type'),
+}
+
+TYPE_ALIASES = {
+    'income': 'income', 'доход': 'income', '+': 'income',
+    'expense': 'expense', 'расход': 'expense', '-': 'expense',
+}
+
+# Форматы, которые не разбирает datetime.fromisoformat
+DATE_FORMATS = (
+    '%d.%m.%Y %H:%M:%S',
+    '%d.%m.%Y %H:%M',
+    '%d.%m.%Y',
+)
+
+DEFAULT_CATEGORY = '💸 Другое'
+
+MAX_REPORTED_ERRORS = 5
+
+def _category_key(category: str) -> str:
+    """Название категории без эмодзи и регистра: '🚌 Транспорт' -> 'транспорт'"""
+    return ''.join(ch for ch in category if ch.isalnum() or ch == ' ').strip().lower()
+
+# Поиск категории по точному и упрощенному названию
+CATEGORY_LOOKUP = {
+    transaction_type: {
+        **{_category_key(category): category for category in categories},
+        **{category: category for category in categories},
+    }
+    for transaction_type, categories in (('expense', EXPENSE_CATEGORIES), ('income', INCOME_CATEGORIES))
+}
+
+@functools.lru_cache(maxsize=1024)
+def _map_category(transaction_type: str, category: str) -> str:
+    """Категория бота для категории из файла (в файле их обычно немного)"""
+    lookup = CATEGORY_LOOKUP[transaction_type]
+    return lookup.get(category) or lookup.get(_category_key(category)) or DEFAULT_CATEGORY
+
+class ImportResult:
+    """Итог импорта: число загруженных и пропущенных строк"""
+
+    def __init__(self):
+        self.imported = 0
+        self.skipped = 0
+        self.errors = []
+
+    def add_error(self, line: int, message: str):
+        """Учет пропущенной строки (сохраняются только первые ошибки)"""
+        self.skipped += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(f"строка {line}: {message}")
+
+def detect_encoding(path: str) -> str:
+    """UTF-8 или cp1251 (выписки многих банков)"""
+    with open(path, 'rb') as f:
+        sample = f.read(64 * 1024)
+    try:
+        sample.decode('utf-8')
+    except UnicodeDecodeError as e:
+        # Обрезанный на границе блока многобайтовый символ - не ошибка
+        if e.start < len(sample) - 3:
+            return 'cp1251'
+    return 'utf-8-sig'
+
+def iter_csv_records(stream: TextIO) -> Iterator[Dict]:
+    """Потоковое чтение CSV с определением разделителя"""
+    sample = stream.read(4096)
+    stream.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+
+    reader = csv.DictReader(stream, dialect=dialect)
+    if reader.fieldnames:
+        reader.fieldnames = [name.strip().lower() for name in reader.fieldnames]
+    yield from reader
+
+def iter_jsonl_records(stream: TextIO) -> Iterator[Optional[Dict]]:
+    """Потоковое чтение JSONL: одна транзакция на строку"""
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            yield None
+            continue
+        if isinstance(record, dict):
+            yield {str(key).lower(): value for key, value in record.items()}
+        else:
+            yield None
+
+def _field(record: Dict, name: str) -> Optional[str]:
+    """Значение поля с учетом альтернативных названий колонок"""
+    for alias in FIELD_ALIASES[name]:
+        value = record.get(alias)
+        if value not in (None, ''):
+            return str(value).strip()
+    return None
+
+def _parse_amount(value: str) -> float:
+    """Сумма с пробелами-разделителями разрядов и запятой: '-1 234,50'"""
+    cleaned = value.replace('\xa0', '').replace(' ', '').replace(',', '.')
+    amount = float(cleaned)
+    try:
+        to_minor_units(amount)
+    except ValueError:
+        raise ValueError(f"некорректная сумма '{value}'") from None
+    return amount
+
+def _parse_date(value: str) -> str:
+    """Дата в формате базы данных"""
+    # Быстрый путь для ISO 8601 - strptime на порядок медленнее
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        pass
+    else:
+        if parsed.tzinfo is not None:
+            parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+        return parsed.isoformat(sep=' ', timespec='seconds')
+    
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).strftime('%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            continue
+    raise ValueError(f"неизвестный формат даты '{value}'")
+
+def normalize_record(record: Dict) -> Tuple[str, float, str, str, str]:
+    """Проверка записи и приведение к (date, amount, category, description, type)"""
+    date = _field(record, 'date')
+    amount = _field(record, 'amount')
+    if date is None or amount is None:
+        raise ValueError("нет даты или суммы")
+
+    date = _parse_date(date)
+    amount = _parse_amount(amount)
+
+    transaction_type = _field(record, 'type')
+    if transaction_type is not None:
+        transaction_type = TYPE_ALIASES.get(transaction_type.lower())
+        if transaction_type is None:
+            raise ValueError("неизвестный тип операции")
+    else:
+        # В банковских выписках списания идут с минусом
+        transaction_type = 'expense' if amount < 0 else 'income'
+
+    amount = abs(amount)
+    if amount == 0:
+        raise ValueError("нулевая сумма")
+
+    category = _map_category(transaction_type, _field(record, 'category') or '')
+
+    description = _field(record, 'description') or ''
+    return date, amount, category, description, transaction_type
+
+def parse_transactions(stream: TextIO, file_format: str,
+                       result: ImportResult) -> Iterator[Tuple[str, float, str, str, str]]:
+    """Поток проверенных транзакций; ошибочные строки учитываются в result"""
+    if file_format == 'jsonl':
+        records, first_line = iter_jsonl_records(stream), 1
+    else:
+        records, first_line = iter_csv_records(stream), 2  # первая строка CSV - заголовок
+
+    for line, record in enumerate(records, first_line):
+        if record is None:
+            result.add_error(line, "некорректный JSON")
+            continue
+        try:
+            row = normalize_record(record)
+        except ValueError as e:
+            result.add_error(line, str(e))
+            continue
+        result.imported += 1
+        yield row
+
+def import_file(db: Database, user_id: int, path: str, file_format: str) -> ImportResult:
+    """Импорт файла в базу без загрузки его целиком в память"""
+    result = ImportResult()
+    with open(path, encoding=detect_encoding(path), newline='') as stream:
+        db.import_transactions(user_id, parse_transactions(stream, file_format, result))
+    return result
+
+async def import_file_async(db: AsyncDatabase, user_id: int, path: str, file_format: str) -> ImportResult:
+    """import_file для обработчиков: файл разбирается вне потока записи, порции пишутся по одной"""
+    result = ImportResult()
+    encoding = await asyncio.get_running_loop().run_in_executor(None, detect_encoding, path)
+    with open(path, encoding=encoding, newline='') as stream:
+        await db.import_transactions(user_id, parse_transactions(stream, file_format, result))
+    return result
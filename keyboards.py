@@ -0,0 +1,71 @@
+"""
+Готовые клавиатуры бота, собираемые один раз при запуске
+"""
+
+from types import MappingProxyType
+from typing import Mapping, Tuple
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from config import EXPENSE_CATEGORIES, INCOME_CATEGORIES
+
+# (подпись, callback_data)
+Button = Tuple[str, str]
+
+BACK_TO_MAIN: Button = ("🔙 Назад", "back_to_main")
+
+MAIN_MENU: Tuple[Button, ...] = (
+    ("💰 Доход", "income"),
+    ("💸 Расход", "expense"),
+    ("📊 Баланс", "balance"),
+    ("🎯 Цели", "goals"),
+    ("🏆 Достижения", "achievements"),
+    ("💡 Советы", "tips"),
+    ("📈 Аналитика", "analytics"),
+    ("📋 История", "history"),
+)
+
+ANALYTICS_MENU: Tuple[Button, ...] = (
+    ("📊 Расходы по категориям", "analytics_expenses"),
+    ("📈 Доходы vs Расходы", "analytics_income_vs_expense"),
+    ("🎯 Прогресс целей", "analytics_goals"),
+    ("📊 Месячные тренды", "analytics_trends"),
+)
+
+def markup(*rows: Tuple[Button, ...]) -> InlineKeyboardMarkup:
+    """Клавиатура из строк кнопок (подпись, callback_data)"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(text, callback_data=data) for text, data in row]
+        for row in rows
+    ])
+
+def build_keyboards() -> Mapping[str, InlineKeyboardMarkup]:
+    """Реестр клавиатур, не зависящих от данных пользователя
+
+    InlineKeyboardMarkup в python-telegram-bot 20 неизменяем, поэтому один
+    экземпляр безопасно отдавать во все ответы, а не собирать его заново на
+    каждое нажатие. Сам реестр доступен только для чтения.
+    """
+    def categories(transaction_type: str, names) -> InlineKeyboardMarkup:
+        return markup(*(((name, f"category_{transaction_type}_{name}"),) for name in names), (BACK_TO_MAIN,))
+
+    def analytics_menu(text_mode: bool) -> InlineKeyboardMarkup:
+        toggle = ("📄 Текстом: вкл" if text_mode else "📄 Текстом: выкл", "analytics_text")
+        return markup(*((button,) for button in ANALYTICS_MENU), (toggle,), (BACK_TO_MAIN,))
+
+    return MappingProxyType({
+        'main_menu': markup(*((button,) for button in MAIN_MENU)),
+        'income_categories': categories('income', INCOME_CATEGORIES),
+        'expense_categories': categories('expense', EXPENSE_CATEGORIES),
+        'back_to_main': markup((BACK_TO_MAIN,)),
+        'main_menu_link': markup((("🔙 Главное меню", "back_to_main"),)),
+        'cancel': markup((("🔙 Отмена", "cancel"),)),
+        'goals': markup((("➕ Добавить цель", "add_goal"),), (BACK_TO_MAIN,)),
+        'goal_types': markup((("💰 Накопить сумму", "goal_type_save"),),
+                             (("💸 Не тратить на категорию", "goal_type_spend"),),
+                             (("🔙 Назад", "goals"),)),
+        'tips': markup((("🔄 Другой совет", "tips"),), (BACK_TO_MAIN,)),
+        'analytics_menu': analytics_menu(False),
+        'analytics_menu_text': analytics_menu(True),
+        'analytics_back': markup((("🔙 Назад", "analytics"),)),
+    })
+
+KEYBOARDS = build_keyboards()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Служебные команды обслуживания базы данных
+Запуск: python manage.py <команда> [параметры]
+"""
+
+import argparse
+import logging
+from database import Database
+
+# Настройка логирования
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+def reconcile(db: Database, args):
+    """Сверка и перестроение материализованных балансов"""
+    drifts = db.reconcile_balances(fix=not args.dry_run)
+
+    for drift in drifts:
+        logger.warning(
+            f"Расхождение у пользователя {drift['user_id']}: "
+            f"доходы {drift['stored_income']:.2f} -> {drift['income']:.2f}, "
+            f"расходы {drift['stored_expense']:.2f} -> {drift['expense']:.2f}"
+        )
+
+    if not drifts:
+        logger.info("Балансы совпадают с журналом транзакций")
+    elif args.dry_run:
+        logger.info(f"Найдено расхождений: {len(drifts)} (без исправления)")
+    else:
+        logger.info(f"Исправлено расхождений: {len(drifts)}")
+
+def rebuild_rollups(db: Database, args):
+    """Перестроение дневных сводок по всей истории транзакций"""
+    db.rebuild_rollups()
+    logger.info("Дневные сводки перестроены")
+
+def recompute_stats(db: Database, args):
+    """Потоковая сверка общих сводок /admin_stats с журналом транзакций"""
+    drifts = db.recompute_global_rollups()
+    if drifts:
+        logger.info(f"Исправлено строк общих сводок: {drifts}")
+    else:
+        logger.info("Общие сводки совпадают с журналом транзакций")
+
+COMMANDS = {
+    'reconcile': reconcile,
+    'rebuild-rollups': rebuild_rollups,
+    'recompute-stats': recompute_stats,
+}
+
+def main():
+    """Разбор аргументов и запуск команды"""
+    parser = argparse.ArgumentParser(description="Обслуживание базы финансового бота")
+    parser.add_argument('command', choices=sorted(COMMANDS))
+    parser.add_argument('--db', help="Путь к базе данных (по умолчанию из config.py)")
+    parser.add_argument('--dry-run', action='store_true', help="Только показать расхождения")
+    args = parser.parse_args()
+
+    db = Database(args.db)
+    try:
+        COMMANDS[args.command](db, args)
+    finally:
+        db.close()
+
+if __name__ == '__main__':
+    main()
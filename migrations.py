@@ -0,0 +1,413 @@
+"""
+Версионированные миграции схемы базы данных
+"""
+
+import sqlite3
+
+def _create_base_tables(cursor: sqlite3.Cursor):
+    """Базовые таблицы бота"""
+    # Таблица пользователей
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            points INTEGER DEFAULT 0,
+            is_premium BOOLEAN DEFAULT FALSE
+        )
+    ''')
+
+    # Таблица транзакций
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            amount REAL,
+            category TEXT,
+            description TEXT,
+            transaction_type TEXT,
+            date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''')
+
+    # Таблица целей
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS goals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            title TEXT,
+            target_amount REAL,
+            current_amount REAL DEFAULT 0,
+            goal_type TEXT,
+            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_completed BOOLEAN DEFAULT FALSE,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''')
+
+    # Таблица достижений
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS achievements (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            achievement_id TEXT,
+            earned_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''')
+
+def _add_query_indexes(cursor: sqlite3.Cursor):
+    """Индексы под выборки по пользователю и дате"""
+    # История транзакций: WHERE user_id = ? ORDER BY date
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_transactions_user_date
+        ON transactions (user_id, date)
+    ''')
+
+    # Баланс и расходы по категориям читаются только из индекса
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_transactions_user_type_date
+        ON transactions (user_id, transaction_type, date, category, amount)
+    ''')
+
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_goals_user_created
+        ON goals (user_id, created_date)
+    ''')
+
+    # Без уникального ключа INSERT OR IGNORE копил дубликаты - оставляем первое получение
+    cursor.execute('''
+        DELETE FROM achievements
+        WHERE id NOT IN (
+            SELECT MIN(id) FROM achievements GROUP BY user_id, achievement_id
+        )
+    ''')
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_achievements_user_achievement
+        ON achievements (user_id, achievement_id)
+    ''')
+
+def rebuild_balances(cursor: sqlite3.Cursor):
+    """Пересчет материализованных балансов по журналу транзакций"""
+    cursor.execute('DELETE FROM balances')
+    cursor.execute('''
+        INSERT INTO balances (user_id, income, expense)
+        SELECT user_id,
+            COALESCE(SUM(CASE WHEN transaction_type = 'income' THEN amount ELSE 0 END), 0),
+            COALESCE(SUM(CASE WHEN transaction_type = 'expense' THEN amount ELSE 0 END), 0)
+        FROM transactions
+        GROUP BY user_id
+    ''')
+
+def _add_balances(cursor: sqlite3.Cursor):
+    """Материализованный баланс пользователя, обновляемый при записи"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS balances (
+            user_id INTEGER PRIMARY KEY,
+            income REAL NOT NULL DEFAULT 0,
+            expense REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    rebuild_balances(cursor)
+
+def rebuild_rollups(cursor: sqlite3.Cursor):
+    """Пересчет дневных сводок по журналу транзакций (даты в секундах Unix, схема 5+)"""
+    cursor.execute('DELETE FROM daily_rollups')
+    cursor.execute('''
+        INSERT INTO daily_rollups (user_id, transaction_type, day, category, total, count)
+        SELECT user_id, transaction_type, date / 86400, COALESCE(category, ''), SUM(amount), COUNT(*)
+        FROM transactions
+        GROUP BY user_id, transaction_type, date / 86400, COALESCE(category, '')
+    ''')
+
+def _rebuild_text_date_rollups(cursor: sqlite3.Cursor):
+    """Сводки схемы 4: даты транзакций еще текстовые, день - 'YYYY-MM-DD'"""
+    cursor.execute('DELETE FROM daily_rollups')
+    cursor.execute('''
+        INSERT INTO daily_rollups (user_id, transaction_type, day, category, total, count)
+        SELECT user_id, transaction_type, date(date), COALESCE(category, ''), SUM(amount), COUNT(*)
+        FROM transactions
+        GROUP BY user_id, transaction_type, date(date), COALESCE(category, '')
+    ''')
+
+def _add_daily_rollups(cursor: sqlite3.Cursor):
+    """Дневные сводки по категориям, обновляемые при записи"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_rollups (
+            user_id INTEGER NOT NULL,
+            transaction_type TEXT NOT NULL,
+            day TEXT NOT NULL,
+            category TEXT NOT NULL,
+            total REAL NOT NULL DEFAULT 0,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, transaction_type, day, category)
+        ) WITHOUT ROWID
+    ''')
+    _rebuild_text_date_rollups(cursor)
+
+# Текущее время в секундах Unix по умолчанию для новых записей
+_NOW_EPOCH = "(CAST(strftime('%s', 'now') AS INTEGER))"
+
+def _use_integer_units(cursor: sqlite3.Cursor):
+    """Суммы в целых копейках, даты в секундах Unix (UTC)
+
+    Тип столбца в SQLite не меняется через ALTER, поэтому таблицы
+    пересоздаются с копированием данных. Балансы и сводки строятся заново.
+    """
+    cursor.execute(f'''
+        CREATE TABLE transactions_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            amount INTEGER NOT NULL,
+            category TEXT,
+            description TEXT,
+            transaction_type TEXT,
+            date INTEGER NOT NULL DEFAULT {_NOW_EPOCH},
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''')
+    cursor.execute('''
+        INSERT INTO transactions_new (id, user_id, amount, category, description, transaction_type, date)
+        SELECT id, user_id, CAST(ROUND(amount * 100) AS INTEGER), category, description,
+               transaction_type, CAST(strftime('%s', date) AS INTEGER)
+        FROM transactions
+    ''')
+    cursor.execute('DROP TABLE transactions')
+    cursor.execute('ALTER TABLE transactions_new RENAME TO transactions')
+
+    cursor.execute(f'''
+        CREATE TABLE goals_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            title TEXT,
+            target_amount INTEGER,
+            current_amount INTEGER NOT NULL DEFAULT 0,
+            goal_type TEXT,
+            created_date INTEGER NOT NULL DEFAULT {_NOW_EPOCH},
+            is_completed BOOLEAN DEFAULT FALSE,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''')
+    cursor.execute('''
+        INSERT INTO goals_new (id, user_id, title, target_amount, current_amount, goal_type,
+                               created_date, is_completed)
+        SELECT id, user_id, title, CAST(ROUND(target_amount * 100) AS INTEGER),
+               CAST(ROUND(COALESCE(current_amount, 0) * 100) AS INTEGER), goal_type,
+               CAST(strftime('%s', created_date) AS INTEGER), is_completed
+        FROM goals
+    ''')
+    cursor.execute('DROP TABLE goals')
+    cursor.execute('ALTER TABLE goals_new RENAME TO goals')
+
+    # Индексы удалены вместе со старыми таблицами
+    _add_query_indexes(cursor)
+
+    cursor.execute('DROP TABLE balances')
+    cursor.execute('''
+        CREATE TABLE balances (
+            user_id INTEGER PRIMARY KEY,
+            income INTEGER NOT NULL DEFAULT 0,
+            expense INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    rebuild_balances(cursor)
+
+    # День сводки - номер дня от начала эпохи (date / 86400)
+    cursor.execute('DROP TABLE daily_rollups')
+    cursor.execute('''
+        CREATE TABLE daily_rollups (
+            user_id INTEGER NOT NULL,
+            transaction_type TEXT NOT NULL,
+            day INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, transaction_type, day, category)
+        ) WITHOUT ROWID
+    ''')
+    rebuild_rollups(cursor)
+
+def _add_data_versions(cursor: sqlite3.Cursor):
+    """Версия данных пользователя для инвалидации кэша графиков"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS data_versions (
+            user_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+def _add_data_version_times(cursor: sqlite3.Cursor):
+    """Время последнего изменения данных: по нему находятся недавно активные пользователи"""
+    cursor.execute('ALTER TABLE data_versions ADD COLUMN updated_at INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_data_versions_updated ON data_versions (updated_at)')
+
+def rebuild_global_rollups(cursor: sqlite3.Cursor):
+    """Пересчет общих дневных сводок по сводкам пользователей"""
+    cursor.execute('DELETE FROM global_rollups')
+    cursor.execute('''
+        INSERT INTO global_rollups (day, transaction_type, category, total, count)
+        SELECT day, transaction_type, category, SUM(total), SUM(count)
+        FROM daily_rollups
+        GROUP BY day, transaction_type, category
+    ''')
+
+def rebuild_activity(cursor: sqlite3.Cursor):
+    """Восстановление недельной активности по дневным сводкам
+
+    Неделя - номер недели от начала эпохи, начиная с понедельника: (день + 3) / 7.
+    Когорта пользователя - неделя его первого изменения данных.
+    """
+    # Пользователи с операциями, но без версии данных (не писали с версии схемы 6)
+    cursor.execute('''
+        INSERT OR IGNORE INTO data_versions (user_id, version, updated_at)
+        SELECT user_id, 0, MAX(day) * 86400 FROM daily_rollups GROUP BY user_id
+    ''')
+    cursor.execute('''
+        UPDATE data_versions SET
+            created_at = COALESCE((SELECT MIN(day) * 86400 FROM daily_rollups
+                                   WHERE daily_rollups.user_id = data_versions.user_id), updated_at),
+            updated_at = MAX(updated_at, COALESCE((SELECT MAX(day) * 86400 FROM daily_rollups
+                                                   WHERE daily_rollups.user_id = data_versions.user_id), 0))
+    ''')
+    cursor.execute('DELETE FROM activity_weeks')
+    cursor.execute('''
+        INSERT INTO activity_weeks (cohort_week, week, users)
+        SELECT (data_versions.created_at / 86400 + 3) / 7, activity.week, COUNT(*)
+        FROM (
+            SELECT user_id, (day + 3) / 7 AS week FROM daily_rollups
+            UNION SELECT user_id, (created_at / 86400 + 3) / 7 FROM data_versions
+            UNION SELECT user_id, (updated_at / 86400 + 3) / 7 FROM data_versions
+        ) AS activity
+        JOIN data_versions USING (user_id)
+        GROUP BY 1, 2
+    ''')
+
+def _add_global_stats(cursor: sqlite3.Cursor):
+    """Общие счетчики для статистики администратора, обновляемые при записи"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS global_rollups (
+            day INTEGER NOT NULL,
+            transaction_type TEXT NOT NULL,
+            category TEXT NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, transaction_type, category)
+        ) WITHOUT ROWID
+    ''')
+    rebuild_global_rollups(cursor)
+
+    # Число пользователей когорты, менявших данные в неделю week
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS activity_weeks (
+            cohort_week INTEGER NOT NULL,
+            week INTEGER NOT NULL,
+            users INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (cohort_week, week)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('ALTER TABLE data_versions ADD COLUMN created_at INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_data_versions_created ON data_versions (created_at)')
+    rebuild_activity(cursor)
+
+def _add_conversation_states(cursor: sqlite3.Cursor):
+    """Незавершенные диалоги ввода операции: переживают перезапуск и общие для всех процессов"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_states (
+            user_id INTEGER PRIMARY KEY,
+            transaction_type TEXT NOT NULL,
+            category TEXT NOT NULL,
+            amount INTEGER,
+            expires_at INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_conversation_states_expires
+        ON conversation_states (expires_at)
+    ''')
+
+def _add_achievement_progress(cursor: sqlite3.Cursor):
+    """Счетчики правил достижений и пересчет очков, начислявшихся повторно"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS achievement_progress (
+            user_id INTEGER PRIMARY KEY,
+            week INTEGER NOT NULL,
+            week_income INTEGER NOT NULL DEFAULT 0,
+            week_expense INTEGER NOT NULL DEFAULT 0,
+            fast_food_since INTEGER NOT NULL,
+            earned INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    # Счетчики заполняются по журналу при первой записи пользователя после миграции.
+    # Раньше очки начислялись при каждой проверке достижения - считаем их заново по выданным
+    cursor.execute('''
+        UPDATE users SET points = COALESCE((
+            SELECT SUM(CASE achievement_id
+                WHEN 'first_save' THEN 10
+                WHEN 'week_saver' THEN 50
+                WHEN 'goal_reached' THEN 100
+                WHEN 'smart_spender' THEN 30
+                WHEN 'big_saver' THEN 200
+                ELSE 0 END)
+            FROM achievements
+            WHERE achievements.user_id = users.user_id
+        ), 0)
+    ''')
+
+def _add_analytics_text_setting(cursor: sqlite3.Cursor):
+    """Настройка "аналитика текстом" хранится у пользователя, а не в памяти процесса"""
+    cursor.execute('ALTER TABLE users ADD COLUMN analytics_text INTEGER NOT NULL DEFAULT 0')
+
+# Миграции применяются строго по возрастанию версии, уже выпущенные не меняются
+MIGRATIONS = [
+    (1, 'Базовые таблицы', _create_base_tables),
+    (2, 'Индексы транзакций, целей и достижений', _add_query_indexes),
+    (3, 'Материализованные балансы', _add_balances),
+    (4, 'Дневные сводки по категориям', _add_daily_rollups),
+    (5, 'Целые копейки и время в секундах Unix', _use_integer_units),
+    (6, 'Версии данных пользователей', _add_data_versions),
+    (7, 'Время изменения данных пользователей', _add_data_version_times),
+    (8, 'Общие сводки и недельная активность', _add_global_stats),
+    (9, 'Состояния диалогов', _add_conversation_states),
+    (10, 'Счетчики достижений', _add_achievement_progress),
+    (11, 'Настройка аналитики текстом', _add_analytics_text_setting),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    """Текущая версия схемы (0 для новой или старой базы без версий)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    return row[0] or 0
+
+def apply_migrations(conn: sqlite3.Connection) -> int:
+    """Применение недостающих миграций, каждой в своей транзакции"""
+    version = get_schema_version(conn)
+
+    for migration_version, description, migrate in MIGRATIONS:
+        if migration_version <= version:
+            continue
+
+        # IMMEDIATE не даст двум процессам одновременно мигрировать одну базу
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if get_schema_version(conn) < migration_version:
+                migrate(conn.cursor())
+                conn.execute('''
+                    INSERT INTO schema_version (version, description) VALUES (?, ?)
+                ''', (migration_version, description))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        version = migration_version
+
+    return version
@@ -0,0 +1,90 @@
+"""
+Фоновая отрисовка графиков недавно активных пользователей
+"""
+
+import asyncio
+import logging
+import time
+from typing import Optional, Tuple
+from async_database import AsyncDatabase
+from analytics_engine import AnalyticsEngine
+from render_pool import ChartRenderPool, RenderPoolBusy, RenderTimeout
+from config import (PRERENDER_ACTIVE_WINDOW, PRERENDER_MAX_USERS, PRERENDER_CPU_BUDGET,
+                    PRERENDER_CHARTS)
+
+logger = logging.getLogger(__name__)
+
+class ChartPrerenderer:
+    """Медленно меняющиеся графики рисуются заранее, пока бот простаивает
+
+    Проход запускается JobQueue: берет пользователей, чьи данные менялись
+    за последние active_window секунд, прогревает их сводки в AnalyticsEngine
+    и рисует графики, которых еще нет в кэше для текущей версии данных.
+    Обработчик потом отдает их из кэша без ожидания.
+
+    Нагрузка ограничена долей одного ядра cpu_budget: после графика, который
+    рисовался t секунд, проход спит t * (1 / cpu_budget - 1). Как только в пуле
+    появляются графики по запросам пользователей, проход прерывается до
+    следующего запуска.
+    """
+
+    def __init__(self, db: AsyncDatabase, render_pool: ChartRenderPool,
+                 engine: Optional[AnalyticsEngine] = None, charts: Tuple = PRERENDER_CHARTS,
+                 active_window: int = PRERENDER_ACTIVE_WINDOW, max_users: int = PRERENDER_MAX_USERS,
+                 cpu_budget: float = PRERENDER_CPU_BUDGET):
+        self.db = db
+        self.render_pool = render_pool
+        self.engine = engine
+        self.charts = charts
+        self.active_window = active_window
+        self.max_users = max_users
+        self.cpu_budget = cpu_budget
+        self._running = False
+
+        self.rendered = 0
+        self.skipped = 0
+        self.paused = 0
+
+    async def run(self, context=None) -> int:
+        """Один проход (callback для JobQueue.run_repeating); возвращает число нарисованных графиков"""
+        if self._running:
+            return 0
+        self._running = True
+        try:
+            return await self._run()
+        finally:
+            self._running = False
+
+    async def _run(self) -> int:
+        since = int(time.time()) - self.active_window
+        users = await self.db.get_recently_active_users(since, self.max_users)
+        rendered = 0
+
+        for user_id in users:
+            if self.engine is not None:
+                await self.db.run_read(self.engine.load, user_id)
+
+            for chart in self.charts:
+                if self.render_pool.live_pending > 0:
+                    self.paused += 1
+                    logger.info("Фоновая отрисовка приостановлена: графики ждут пользователи")
+                    return rendered
+                if await self.render_pool.cached(chart, user_id) is not None:
+                    self.skipped += 1
+                    continue
+
+                start = time.perf_counter()
+                try:
+                    await self.render_pool.render(chart, user_id, background=True)
+                except (RenderPoolBusy, RenderTimeout) as e:
+                    logger.warning(f"Фоновая отрисовка {chart} для {user_id} прервана: {e!r}")
+                    return rendered
+                rendered += 1
+                self.rendered += 1
+
+                elapsed = time.perf_counter() - start
+                await asyncio.sleep(elapsed * (1 / self.cpu_budget - 1))
+
+        if rendered:
+            logger.info(f"Фоновая отрисовка: {rendered} графиков для {len(users)} пользователей")
+        return rendered
@@ -44,12 +44,20 @@ def run_web_server():
 async def run_telegram_bot():
     """Запуск Telegram бота"""
     try:
-        from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ConversationHandler
-        from config import BOT_TOKEN
+        from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters
+        from config import (BOT_TOKEN, PRERENDER_INTERVAL, GLOBAL_STATS_RECOMPUTE_INTERVAL,
+                            CONVERSATION_SWEEP_INTERVAL)
         from database import Database
+        from async_database import AsyncDatabase
         from analytics import Analytics
-        from handlers import BotHandlers, ENTERING_AMOUNT, ENTERING_DESCRIPTION
-        from telegram import Update
+        from analytics_engine import AnalyticsEngine
+        from text_analytics import TextAnalytics
+        from render_pool import ChartRenderPool
+        from prerender import ChartPrerenderer
+        from conversation_state import ConversationStore
+        from handlers import BotHandlers
+        from update_processor import UserOrderedUpdateProcessor
+        from webhook import run_bot
         
         if not BOT_TOKEN:
             logger.error("Не установлен BOT_TOKEN в переменных окружения!")
@@ -57,35 +65,54 @@ async def run_telegram_bot():
         
         # Инициализация компонентов
         db = Database()
-        analytics = Analytics(db)
-        handlers = BotHandlers(db, analytics)
+        async_db = AsyncDatabase(db)
+        render_pool = ChartRenderPool(async_db, Analytics(db))
+        render_pool.start()
+        handlers = BotHandlers(async_db, render_pool, TextAnalytics(AnalyticsEngine(db)),
+                               ConversationStore(async_db))
         
         # Создание приложения
-        application = Application.builder().token(BOT_TOKEN).build()
+        # Разные пользователи обрабатываются параллельно, обновления одного - по очереди
+        application = Application.builder().token(BOT_TOKEN).concurrent_updates(UserOrderedUpdateProcessor()).build()
+        
+        # Фоновые задачи: отрисовка графиков активных пользователей в периоды простоя
+        if application.job_queue is not None:
+            prerenderer = ChartPrerenderer(async_db, render_pool, handlers.text_analytics.engine)
+            application.job_queue.run_repeating(prerenderer.run, interval=PRERENDER_INTERVAL,
+                                                first=PRERENDER_INTERVAL)
+            # Общие счетчики /admin_stats сверяются с журналом транзакций
+            application.job_queue.run_repeating(handlers.recompute_global_stats,
+                                                interval=GLOBAL_STATS_RECOMPUTE_INTERVAL,
+                                                first=GLOBAL_STATS_RECOMPUTE_INTERVAL)
+            # Брошенные на середине диалоги ввода операции
+            application.job_queue.run_repeating(handlers.conversations.sweep, interval=CONVERSATION_SWEEP_INTERVAL)
+        else:
+            logger.warning("JobQueue недоступна (pip install \"python-telegram-bot[job-queue]\"), "
+                           "фоновые задачи отключены")
         
         # Настройка обработчиков
         application.add_handler(CommandHandler("start", handlers.start))
+        application.add_handler(CommandHandler("import", handlers.start_import))
+        application.add_handler(CommandHandler("export", handlers.export_history))
+        application.add_handler(CommandHandler("admin_stats", handlers.admin_stats))
+        application.add_handler(MessageHandler(
+            filters.Document.FileExtension("csv") | filters.Document.FileExtension("jsonl")
+            | filters.Document.FileExtension("json"),
+            handlers.handle_import_document
+        ))
         application.add_handler(CallbackQueryHandler(handlers.button_handler))
         
-        # ConversationHandler для добавления транзакций
-        conv_handler = ConversationHandler(
-            entry_points=[CallbackQueryHandler(handlers.handle_category_selection, pattern="^category_")],
-            states={
-                ENTERING_AMOUNT: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, handlers.handle_amount_input)
-                ],
-                ENTERING_DESCRIPTION: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, handlers.handle_description_input)
-                ]
-            },
-            fallbacks=[CommandHandler("cancel", handlers.cancel)]
-        )
-        
-        application.add_handler(conv_handler)
+        # Ввод суммы и описания операции: шаг диалога берется из базы
+        application.add_handler(CommandHandler("cancel", handlers.cancel))
+        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handlers.handle_text_input))
         
         # Запуск бота
         logger.info("Запуск финансового бота...")
-        await application.run_polling(allowed_updates=Update.ALL_TYPES)
+        try:
+            await run_bot(application)
+        finally:
+            render_pool.close()
+            async_db.close()
         
     except Exception as e:
         logger.error(f"Ошибка при запуске бота: {e}")
@@ -94,13 +121,16 @@ def main():
     """Основная функция"""
     logger.info("Запуск приложения на Railway...")
     
-    # Запускаем веб-сервер в отдельном потоке
-    web_thread = threading.Thread(target=run_web_server, daemon=True)
-    web_thread.start()
-    logger.info("Веб-сервер запущен")
-    
-    # Даем время веб-серверу запуститься
-    time.sleep(2)
+    # В режиме webhook health check отвечает HTTP-сервер бота на том же порту
+    from config import BOT_MODE
+    if BOT_MODE == 'polling':
+        # Запускаем веб-сервер в отдельном потоке
+        web_thread = threading.Thread(target=run_web_server, daemon=True)
+        web_thread.start()
+        logger.info("Веб-сервер запущен")
+        
+        # Даем время веб-серверу запуститься
+        time.sleep(2)
     
     # Запускаем Telegram бота
     logger.info("Запуск Telegram бота...")
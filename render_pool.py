@@ -0,0 +1,141 @@
+"""
+Отрисовка графиков в пуле процессов с ограниченной очередью
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import signal
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+from async_database import AsyncDatabase
+from analytics import Analytics
+from config import RENDER_WORKERS, RENDER_QUEUE_SIZE, RENDER_TIMEOUT, RENDER_KILL_GRACE
+
+logger = logging.getLogger(__name__)
+
+class RenderPoolBusy(Exception):
+    """Очередь отрисовки заполнена"""
+
+class RenderTimeout(Exception):
+    """График не отрисовался за отведенное время"""
+
+# Состояние процесса-исполнителя
+_worker_analytics: Optional[Analytics] = None
+
+def _raise_timeout(signum, frame):
+    raise RenderTimeout("Превышено время отрисовки графика")
+
+def _init_worker(db_path: str):
+    """Подготовка процесса: matplotlib импортирован заранее, соединение с базой открыто"""
+    global _worker_analytics
+    from database import Database
+
+    # Ctrl+C обрабатывает основной процесс, он же останавливает пул
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if hasattr(signal, 'SIGALRM'):
+        signal.signal(signal.SIGALRM, _raise_timeout)
+    _worker_analytics = Analytics(Database(db_path))
+
+def _warm_up() -> bool:
+    """Первая отрисовка загружает шрифты и кэши matplotlib"""
+    _worker_analytics._create_empty_chart("")
+    return True
+
+def _render_in_worker(chart: str, user_id: int, params: dict, timeout: float) -> bytes:
+    """Отрисовка графика в процессе пула с ограничением по времени"""
+    # Таймер прерывает зависшую отрисовку, не убивая процесс (в Windows таймера нет)
+    if hasattr(signal, 'setitimer'):
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return _worker_analytics.render(chart, user_id, **params)
+    finally:
+        if hasattr(signal, 'setitimer'):
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+class ChartRenderPool:
+    """Графики рисуются в отдельных процессах, цикл событий бота не блокируется
+
+    Кэш графиков и версии данных остаются в основном процессе: в пул попадают
+    только промахи. Если в работе уже max_pending графиков, новый запрос
+    сразу получает RenderPoolBusy. Фоновые графики (background=True) учитываются
+    отдельно, чтобы фоновая отрисовка могла уступать живым запросам.
+    """
+
+    def __init__(self, db: AsyncDatabase, analytics: Analytics, workers: int = RENDER_WORKERS,
+                 max_pending: int = RENDER_QUEUE_SIZE, timeout: float = RENDER_TIMEOUT):
+        self.db = db
+        self.analytics = analytics
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._pending = 0
+        self._background = 0
+        self._executor = self._create_executor()
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        """Пул процессов, запускаемых через spawn (fork копировал бы потоки и соединения SQLite)"""
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(self.analytics.db.db_path,)
+        )
+
+    def start(self):
+        """Заблаговременный запуск всех процессов пула"""
+        for _ in range(self.workers):
+            self._executor.submit(_warm_up)
+
+    @property
+    def live_pending(self) -> int:
+        """Графики в работе по запросам пользователей"""
+        return self._pending - self._background
+
+    async def cached(self, chart: str, user_id: int, **params) -> Optional[bytes]:
+        """Готовый график для текущей версии данных или None"""
+        version = await self.db.get_data_version(user_id)
+        return self.analytics.cache.get(self.analytics.cache_key(chart, user_id, version, **params))
+
+    async def render(self, chart: str, user_id: int, background: bool = False, **params) -> bytes:
+        """Готовый график из кэша или отрисовка в пуле"""
+        version = await self.db.get_data_version(user_id)
+        key = self.analytics.cache_key(chart, user_id, version, **params)
+        chart_bytes = self.analytics.cache.get(key)
+        if chart_bytes is not None:
+            return chart_bytes
+
+        if self._pending >= self.max_pending:
+            raise RenderPoolBusy()
+
+        self._pending += 1
+        self._background += background
+        try:
+            future = self._executor.submit(_render_in_worker, chart, user_id, params, self.timeout)
+            try:
+                chart_bytes = await asyncio.wait_for(asyncio.wrap_future(future),
+                                                     self.timeout + RENDER_KILL_GRACE)
+            except asyncio.TimeoutError:
+                # Таймер в процессе не сработал (например, завис код на C) - пул пересоздается
+                logger.warning(f"Отрисовка {chart} для {user_id} зависла, перезапуск пула")
+                self._restart()
+                raise RenderTimeout("Превышено время отрисовки графика")
+        finally:
+            self._pending -= 1
+            self._background -= background
+
+        self.analytics.cache.put(key, chart_bytes)
+        return chart_bytes
+
+    def _restart(self):
+        """Принудительная остановка процессов и запуск нового пула"""
+        executor, self._executor = self._executor, self._create_executor()
+        # У ProcessPoolExecutor нет публичного способа прервать выполняющуюся задачу
+        for process in list(getattr(executor, '_processes', {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+        self.start()
+
+    def close(self):
+        """Остановка пула"""
+        self._executor.shutdown(wait=True, cancel_futures=True)
@@ -4,10 +4,46 @@
 """
 
 import asyncio
+import csv
+import datetime
+import gc
+import inspect
+import io
+import os
 import sqlite3
-from database import Database
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from database import Database, WriteQueue, format_timestamp, to_timestamp, week_number
+from async_database import AsyncDatabase
+from migrations import LATEST_VERSION, MIGRATIONS, get_schema_version
+from importer import import_file
+from exporter import export_csv, export_parquet, parquet_available
 from analytics import Analytics
-from config import EXPENSE_CATEGORIES, INCOME_CATEGORIES, ACHIEVEMENTS
+from analytics_engine import AnalyticsEngine
+from text_analytics import TextAnalytics, bar, sparkline, display_width, admin_report
+from chart_cache import ChartCache
+from render_pool import ChartRenderPool, RenderPoolBusy, RenderTimeout
+from prerender import ChartPrerenderer
+from conversation_state import ConversationState, ConversationStore
+from achievements import ACHIEVEMENT_BITS, AchievementProgress
+from handlers import BotHandlers
+from callback_router import CallbackRouter
+from keyboards import KEYBOARDS
+from webhook import WebhookServer, run_bot
+from update_processor import KeyedLock, UserOrderedUpdateProcessor, update_key
+from fake_telegram import FakeTelegram, message_update
+from telegram import Update
+from telegram.ext import MessageHandler, SimpleUpdateProcessor, filters
+import httpx
+from config import EXPENSE_CATEGORIES, INCOME_CATEGORIES, ACHIEVEMENTS, FAST_FOOD_CATEGORY
+from typing import Tuple
+from PIL import Image
 
 async def test_database():
     """Тестирование функций базы данных"""
@@ -81,6 +117,1618 @@ async def test_analytics():
     
     print("✅ Все тесты аналитики пройдены!\n")
 
+async def test_connection_pool():
+    """Тестирование пула соединений"""
+    print("🔌 Тестирование пула соединений...")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'pool.db'))
+        
+        # Соединение переиспользуется внутри потока
+        conn = db._get_connection()
+        assert db._get_connection() is conn
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        print("✅ Соединение переиспользуется, включен WAL")
+        
+        # В другом потоке - собственное соединение
+        other = []
+        thread = threading.Thread(target=lambda: other.append(db._get_connection()))
+        thread.start()
+        thread.join()
+        assert other[0] is not conn
+        print("✅ Каждый поток получает свое соединение")
+        
+        # Ошибка внутри записи откатывается и не оставляет открытую транзакцию
+        try:
+            with conn:
+                conn.execute("INSERT INTO goals (user_id, title) VALUES (1, 'Откат')")
+                conn.execute('INSERT INTO missing_table VALUES (1)')
+        except sqlite3.OperationalError:
+            pass
+        assert not conn.in_transaction
+        assert db.get_user_goals(1) == []
+        print("✅ Ошибка записи откатывает транзакцию")
+        
+        db.close()
+    
+    print("✅ Все тесты пула соединений пройдены!\n")
+
+def _query_plans(db: Database, method, *args) -> list:
+    """Планы выполнения всех запросов, выполненных методом Database"""
+    conn = db._get_connection()
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        method(*args)
+    finally:
+        conn.set_trace_callback(None)
+    
+    plans = []
+    for statement in statements:
+        if statement.lstrip().upper().startswith('SELECT'):
+            rows = conn.execute('EXPLAIN QUERY PLAN ' + statement).fetchall()
+            plans.append(' | '.join(row[3] for row in rows))
+    return plans
+
+async def test_migrations():
+    """Тестирование миграций схемы и планов запросов"""
+    print("🗄 Тестирование миграций...")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'legacy.db')
+        
+        # База в формате до появления миграций, с дублями достижений
+        conn = sqlite3.connect(path)
+        conn.executescript('''
+            CREATE TABLE users (user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT,
+                registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                points INTEGER DEFAULT 0, is_premium BOOLEAN DEFAULT FALSE);
+            CREATE TABLE transactions (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER,
+                amount REAL, category TEXT, description TEXT, transaction_type TEXT,
+                date TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+            CREATE TABLE goals (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, title TEXT,
+                target_amount REAL, current_amount REAL DEFAULT 0, goal_type TEXT,
+                created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP, is_completed BOOLEAN DEFAULT FALSE);
+            CREATE TABLE achievements (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER,
+                achievement_id TEXT, earned_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+            INSERT INTO transactions (user_id, amount, category, description, transaction_type)
+                VALUES (1, 500, '💰 Зарплата', 'Старая запись', 'income');
+            INSERT INTO transactions (user_id, amount, category, description, transaction_type, date)
+                VALUES (1, 0.1, '🚌 Транспорт', 'Копейки', 'expense', '2024-09-01 12:30:00');
+            INSERT INTO goals (user_id, title, target_amount, current_amount, goal_type)
+                VALUES (1, 'Велосипед', 15000, 0.3, 'savings');
+            INSERT INTO achievements (user_id, achievement_id) VALUES (1, 'first_save');
+            INSERT INTO achievements (user_id, achievement_id) VALUES (1, 'first_save');
+            INSERT INTO users (user_id, username, first_name, points) VALUES (1, 'old', 'Old', 30);
+        ''')
+        conn.commit()
+        
+        # Миграция 4 видит еще текстовые даты и строит сводки по дням 'YYYY-MM-DD'
+        staged = sqlite3.connect(':memory:')
+        conn.backup(staged)
+        conn.close()
+        for _, _, migrate in MIGRATIONS[:4]:
+            migrate(staged.cursor())
+        assert ('2024-09-01', 0.1) in staged.execute('SELECT day, total FROM daily_rollups').fetchall()
+        staged.close()
+        
+        db = Database(path)
+        assert get_schema_version(db._get_connection()) == LATEST_VERSION
+        assert db.get_user_balance(1) == 499.9
+        assert db.get_user_achievements(1) == ['first_save']
+        oldest = db.get_transactions(1, 10)[-1]
+        assert (oldest['amount'], oldest['date']) == (0.1, '2024-09-01 12:30:00')
+        assert oldest['timestamp'] == 1725193800
+        assert db.get_user_goals(1)[0]['current_amount'] == 0.3
+        db.add_achievement(1, 'first_save')
+        assert db.get_user_achievements(1) == ['first_save']
+        assert db.get_user_points(1) == ACHIEVEMENTS['first_save']['points']
+        stats = db.get_global_stats()
+        assert (stats['users'], stats['active'][1], stats['transactions']) == (1, 1, 1)
+        assert stats['top_categories'] == [] and stats['income'] == 500
+        print("✅ Старая база обновлена на месте: копейки и секунды Unix, дубли достижений удалены")
+        
+        # Повторное открытие не применяет миграции заново
+        db.close()
+        db = Database(path)
+        assert get_schema_version(db._get_connection()) == LATEST_VERSION
+        print("✅ Повторный запуск миграций ничего не меняет")
+        
+        # (метод, аргументы, сортировка должна идти по индексу)
+        checks = [
+            (db.get_user_balance, (1,), False),
+            (db.get_transactions, (1, 10), True),
+            (db.get_expenses_by_category, (1, 30), False),
+            (db.get_user_goals, (1,), True),
+            (db.get_user_achievements, (1,), False),
+        ]
+        for method, args, sorted_by_index in checks:
+            for plan in _query_plans(db, method, *args):
+                assert 'USING' in plan, f"{method.__name__}: {plan}"
+                assert 'SCAN' not in plan, f"{method.__name__}: {plan}"
+                if sorted_by_index:
+                    assert 'TEMP B-TREE' not in plan, f"{method.__name__}: {plan}"
+        print("✅ Запросы используют индексы без полного сканирования")
+        
+        db.close()
+    
+    print("✅ Все тесты миграций пройдены!\n")
+
+async def test_balances():
+    """Тестирование материализованных балансов"""
+    print("💰 Тестирование балансов...")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'balances.db'))
+        
+        db.add_transaction(1, 1000, "💰 Зарплата", "Зарплата", "income")
+        db.add_transaction(1, 250.5, "🍔 Еда и фастфуд", "Обед", "expense")
+        db.add_transaction(2, 40, "🚌 Транспорт", "Проезд", "expense")
+        assert db.get_user_balance(1) == 749.5
+        assert db.get_user_balance(2) == -40
+        assert db.get_user_balance(3) == 0
+        print("✅ Баланс обновляется при записи транзакции")
+        
+        # Суммы в копейках складываются без погрешности float
+        for _ in range(10):
+            db.add_transaction(3, 0.1, "💸 Другое", "Мелочь", "income")
+        assert db.get_user_balance(3) == 1.0
+        conn = db._get_connection()
+        assert conn.execute('SELECT income FROM balances WHERE user_id = 3').fetchone()[0] == 100
+        
+        # Суммы, не помещающиеся в INTEGER, отклоняются до записи
+        for amount in (float('inf'), float('nan'), 1e17, -1e20):
+            try:
+                db.add_transaction(3, amount, "💸 Другое", "Переполнение", "income")
+            except ValueError:
+                pass
+            else:
+                raise AssertionError(f"сумма {amount} должна отклоняться")
+        assert db.get_user_balance(3) == 1.0
+        print("✅ Суммы хранятся в целых копейках")
+        
+        assert db.reconcile_balances() == []
+        
+        # Портим баланс и проверяем, что сверка находит и исправляет расхождение
+        with conn:
+            conn.execute('UPDATE balances SET income = 0 WHERE user_id = 1')
+            conn.execute('INSERT INTO balances (user_id, income, expense) VALUES (9, 5, 0)')
+        
+        drifts = db.reconcile_balances(fix=False)
+        assert sorted(drift['user_id'] for drift in drifts) == [1, 9]
+        assert db.get_user_balance(1) == -250.5
+        
+        db.reconcile_balances()
+        assert db.reconcile_balances() == []
+        assert db.get_user_balance(1) == 749.5
+        assert db.get_user_balance(9) == 0
+        print("✅ Сверка находит и исправляет расхождения")
+        
+        db.close()
+    
+    print("✅ Все тесты балансов пройдены!\n")
+
+async def test_async_database():
+    """Тестирование асинхронного доступа к базе"""
+    print("⚡ Тестирование асинхронной базы данных...")
+    
+    # У каждого публичного метода Database есть асинхронный аналог
+    # (генераторы потребляются целиком внутри run_read, например при экспорте)
+    for name in dir(Database):
+        if not name.startswith('_') and name != 'close' and not inspect.isgeneratorfunction(getattr(Database, name)):
+            assert asyncio.iscoroutinefunction(getattr(AsyncDatabase, name)), name
+    print("✅ Все методы Database доступны асинхронно")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = AsyncDatabase(Database(os.path.join(tmp, 'async.db')))
+        
+        async def measure_lag(workload) -> Tuple[float, float]:
+            """Время работы нагрузки и максимальная задержка цикла событий"""
+            max_lag = 0
+            running = True
+            
+            async def ticker():
+                nonlocal max_lag
+                while running:
+                    start = time.perf_counter()
+                    await asyncio.sleep(0.001)
+                    max_lag = max(max_lag, time.perf_counter() - start - 0.001)
+            
+            ticker_task = asyncio.create_task(ticker())
+            await asyncio.sleep(0)
+            start = time.perf_counter()
+            await workload()
+            elapsed = time.perf_counter() - start
+            running = False
+            await ticker_task
+            return elapsed, max_lag
+        
+        async def async_workload():
+            async def user_session(user_id: int):
+                for i in range(100):
+                    await db.add_transaction(user_id, 10, "🚌 Транспорт", f"Поездка {i}", "expense")
+                    await db.get_user_balance(user_id)
+            await asyncio.gather(*[user_session(user_id) for user_id in range(1, 21)])
+        
+        async def blocking_workload():
+            # Так обработчики обращались к базе раньше - прямо из цикла событий
+            for user_id in range(21, 41):
+                for i in range(100):
+                    db.db.add_transaction(user_id, 10, "🚌 Транспорт", f"Поездка {i}", "expense")
+                    db.db.get_user_balance(user_id)
+        
+        # Паузы сборщика мусора (после импорта matplotlib) не относятся к работе с базой
+        gc.collect()
+        gc.disable()
+        try:
+            elapsed, max_lag = await measure_lag(async_workload)
+            _, blocking_lag = await measure_lag(blocking_workload)
+        finally:
+            gc.enable()
+        
+        assert await db.get_user_balance(1) == -1000
+        assert max_lag < 0.05, f"цикл событий заблокирован на {max_lag * 1000:.1f} мс"
+        print(f"✅ 2000 записей и чтений за {elapsed * 1000:.0f} мс, макс. задержка цикла "
+              f"{max_lag * 1000:.1f} мс (при прямых вызовах {blocking_lag * 1000:.1f} мс)")
+        
+        db.close()
+    
+    print("✅ Все тесты асинхронной базы данных пройдены!\n")
+
+async def test_write_queue():
+    """Тестирование группового коммита"""
+    print("📦 Тестирование очереди записи...")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'queue.db'))
+        db.add_user(1, "queue", "Queue")
+        
+        # Пакет из 10 записей уходит одной транзакцией, не дожидаясь секундного таймера
+        write_queue = WriteQueue(db, batch_size=10, flush_interval_ms=1000)
+        start = time.perf_counter()
+        futures = [write_queue.add_transaction(1, 10, "🚌 Транспорт", f"Поездка {i}", "expense")
+                   for i in range(10)]
+        for future in futures:
+            future.result(timeout=5)
+        assert time.perf_counter() - start < 0.5, "пакет не сброшен по размеру"
+        assert db.get_user_balance(1) == -100
+        print("✅ Полный пакет записывается сразу, не дожидаясь таймера")
+        write_queue.close()
+        
+        # Неполный пакет сбрасывается по таймеру
+        write_queue = WriteQueue(db, batch_size=1000, flush_interval_ms=20)
+        write_queue.add_achievement(1, "first_save").result(timeout=5)
+        write_queue.update_user_points(1, 10).result(timeout=5)
+        assert db.get_user_achievements(1) == ["first_save"]
+        assert db.get_user_points(1) == 10
+        print("✅ Неполный пакет записывается по таймеру")
+        
+        # Ошибка одной операции не отменяет остальные записи пакета
+        def broken(cursor):
+            cursor.execute('INSERT INTO missing_table VALUES (1)')
+        
+        good = write_queue.add_transaction(1, 100, "💰 Зарплата", "Зарплата", "income")
+        bad = write_queue.submit(broken)
+        good.result(timeout=5)
+        try:
+            bad.result(timeout=5)
+            assert False, "ошибка не передана вызывающему"
+        except sqlite3.OperationalError:
+            pass
+        assert db.get_user_balance(1) == 0
+        print("✅ Ошибочная запись не отменяет остальные")
+        
+        # После закрытия запись отклоняется, а не ждет коммита, который не наступит
+        write_queue.close()
+        try:
+            write_queue.add_transaction(1, 10, "🚌 Транспорт", "Поздно", "expense")
+            assert False, "запись после закрытия принята"
+        except RuntimeError:
+            pass
+        write_queue.close()
+        print("✅ Запись в закрытую очередь отклоняется")
+        
+        # В AsyncDatabase пакеты пишет тот же единственный поток, что и остальные записи
+        async_db = AsyncDatabase(db)
+        writer_thread = await async_db.run_write(lambda: threading.current_thread())
+        flush_thread = await asyncio.wrap_future(
+            async_db.write_queue.submit(lambda cursor: threading.current_thread()))
+        assert flush_thread is writer_thread
+        await async_db.add_transaction(1, 10, "🚌 Транспорт", "Поездка", "expense")
+        async_db.close()
+        print("✅ Пакеты записываются в потоке записи AsyncDatabase")
+    
+    print("✅ Все тесты очереди записи пройдены!\n")
+
+async def test_rollups():
+    """Тестирование дневных сводок"""
+    print("🧮 Тестирование дневных сводок...")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'rollups.db'))
+        conn = db._get_connection()
+        
+        db.add_transaction(1, 300, "🍔 Еда и фастфуд", "Обед", "expense")
+        db.add_transaction(1, 200, "🍔 Еда и фастфуд", "Ужин", "expense")
+        db.add_transaction(1, 50, "🚌 Транспорт", "Проезд", "expense")
+        db.add_transaction(1, 1000, "💰 Зарплата", "Зарплата", "income")
+        
+        snapshot = conn.execute('SELECT * FROM daily_rollups ORDER BY 1, 2, 3, 4').fetchall()
+        db.rebuild_rollups()
+        assert conn.execute('SELECT * FROM daily_rollups ORDER BY 1, 2, 3, 4').fetchall() == snapshot
+        rows = {row[3]: (row[4], row[5]) for row in snapshot}
+        assert rows["🍔 Еда и фастфуд"] == (50000, 2)
+        print("✅ Сводки, обновляемые при записи, совпадают с полным пересчетом")
+        
+        # Старая трата за пределами периода, записанная в обход Database
+        with conn:
+            conn.execute('''
+                INSERT INTO transactions (user_id, amount, category, description, transaction_type, date)
+                VALUES (1, 99900, '🎮 Развлечения', 'Давно', 'expense',
+                        CAST(strftime('%s', 'now', '-60 days') AS INTEGER))
+            ''')
+        db.rebuild_rollups()
+        
+        assert db.get_expenses_by_category(1, 30) == [("🍔 Еда и фастфуд", 500), ("🚌 Транспорт", 50)]
+        assert db.get_expenses_by_category(1, 90)[0] == ("🎮 Развлечения", 999)
+        print("✅ Расходы по категориям читаются из сводок с учетом периода")
+        
+        db.close()
+    
+    print("✅ Все тесты дневных сводок пройдены!\n")
+
+async def test_period_totals():
+    """Тестирование сумм по дням и месяцам"""
+    print("📆 Тестирование сумм по периодам...")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'totals.db'))
+        
+        # История больше прежних лимитов выборки (1000 и 5000 строк)
+        start = int(datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc).timestamp())
+        rows = [(format_timestamp(start + i * 5000), i % 700 + 0.25, "🍔 Еда и фастфуд", "Операция",
+                 'income' if i % 4 == 0 else 'expense') for i in range(8000)]
+        db.import_transactions(1, rows)
+        db.add_transaction(2, 100, "🚌 Транспорт", "Чужая", "expense")
+        
+        expected_days, expected_months = {}, {}
+        for date, amount, _, _, transaction_type in rows:
+            for totals, period in ((expected_days, date[:10]), (expected_months, date[:7])):
+                income, expense = totals.get(period, (0, 0))
+                cents = round(amount * 100)
+                totals[period] = (income + cents, expense) if transaction_type == 'income' else (income, expense + cents)
+        
+        def as_cents(totals):
+            return [(period, round(income * 100), round(expense * 100)) for period, income, expense in totals]
+        
+        assert as_cents(db.get_daily_totals(1)) == [(day, *expected_days[day]) for day in sorted(expected_days)]
+        months = sorted(expected_months)
+        assert len(months) > 12
+        assert as_cents(db.get_monthly_totals(1)) == [(month, *expected_months[month]) for month in months]
+        assert as_cents(db.get_monthly_totals(1, limit=6)) == [(month, *expected_months[month]) for month in months[-6:]]
+        print("✅ Суммы по дням и месяцам точны для всей истории")
+        
+        since = to_timestamp('2023-03-01 00:00:00')
+        until = to_timestamp('2023-03-08 00:00:00')
+        week = db.get_daily_totals(1, since=since, until=until)
+        assert [day for day, _, _ in week] == [f'2023-03-0{i}' for i in range(1, 8)]
+        assert [month for month, _, _ in db.get_monthly_totals(1, since=since, until=until)] == ['2023-03']
+        print("✅ Период [since, until) ограничивает выборку")
+        
+        # Графики строятся по агрегатам, а не по списку транзакций
+        db.add_transaction(1, 500, "💰 Зарплата", "Аванс", "income")
+        analytics = Analytics(db, ChartCache(max_bytes=0, disk_dir=None))
+        db.get_transactions = None
+        assert analytics.create_monthly_trend_chart(1).startswith(b'\x89PNG')
+        assert analytics.create_income_vs_expense_chart(1).startswith(b'\x89PNG')
+        print("✅ Графики трендов и доходов/расходов читают агрегаты")
+        
+        db.close()
+    
+    print("✅ Все тесты сумм по периодам пройдены!\n")
+
+async def test_global_stats():
+    """Тестирование общих счетчиков статистики администратора"""
+    print("👑 Тестирование статистики администратора...")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'global.db'))
+        conn = db._get_connection()
+        now = int(time.time())
+        today = format_timestamp(now)
+        
+        db.add_transaction(1, 1000, "💼 Подработка", "Зарплата", "income")
+        db.add_transaction(1, 300, "🍔 Еда и фастфуд", "Обед", "expense")
+        db.add_transaction(2, 500, "🚌 Транспорт", "Проездной", "expense")
+        db.import_transactions(3, [(today, 200, "🍔 Еда и фастфуд", "Кафе", "expense"),
+                                   ("2020-01-01 12:00:00", 50, "🍔 Еда и фастфуд", "Давно", "expense")])
+        queue = WriteQueue(db)
+        queue.add_transaction(2, 100, "🍔 Еда и фастфуд", "Перекус", "expense").result()
+        queue.close()
+        
+        # Общие сводки совпадают с суммой сводок пользователей
+        def aggregated(table, key):
+            return conn.execute(f'''
+                SELECT {key}, SUM(total), SUM(count) FROM {table} GROUP BY {key} ORDER BY {key}
+            ''').fetchall()
+        key = 'day, transaction_type, category'
+        assert aggregated('global_rollups', key) == aggregated('daily_rollups', key)
+        
+        stats = db.get_global_stats(days=30)
+        assert stats['users'] == 3 and stats['new_users'] == 3
+        assert stats['active'] == {1: 3, 7: 3, 30: 3}
+        assert stats['transactions'] == 5
+        assert stats['income'] == 1000 and stats['expense'] == 1100
+        assert stats['top_categories'][0] == ("🍔 Еда и фастфуд", 600, 3)
+        assert stats['retention'][-1][1] == 3
+        print("✅ Пользователи, объем и топ категорий считаются по общим счетчикам")
+        
+        # Недельная активность: первое изменение за неделю засчитывается один раз
+        week = week_number(now)
+        assert conn.execute('SELECT users FROM activity_weeks WHERE cohort_week = ? AND week = ?',
+                            (week, week)).fetchone()[0] == 3
+        conn.execute('''
+            UPDATE data_versions SET created_at = created_at - 14 * 86400, updated_at = updated_at - 14 * 86400
+            WHERE user_id = 2
+        ''')
+        conn.execute('''
+            INSERT INTO activity_weeks (cohort_week, week, users) VALUES (?, ?, 1)
+        ''', (week - 2, week - 2))
+        conn.commit()
+        db.add_goal(2, "Велосипед", 10000, "savings")
+        db.add_transaction(2, 10, "🚌 Транспорт", "Проезд", "expense")
+        assert conn.execute('SELECT users FROM activity_weeks WHERE cohort_week = ? AND week = ?',
+                            (week - 2, week)).fetchone()[0] == 1
+        
+        stats = db.get_global_stats(days=30, cohort_weeks=3)
+        assert [(size, shares) for _, size, shares in stats['retention']] == [(1, [0.0, 1.0]), (0, [None]), (3, [])]
+        report = admin_report(stats)
+        assert "Удержание" in report and "100%" in report and "<pre>" in report
+        print("✅ Удержание по недельным когортам обновляется при записи")
+        
+        # Потоковая сверка: окна по id, операции во время чтения журнала не теряются
+        assert db.recompute_global_rollups(chunk_size=2) == 0
+        conn.execute("UPDATE global_rollups SET total = total + 1 WHERE transaction_type = 'expense'")
+        conn.execute("INSERT INTO global_rollups VALUES (1, 'expense', 'Мусор', 1, 1)")
+        conn.commit()
+        
+        totals, until_id = db.stream_global_rollups(chunk_size=2)
+        db.add_transaction(4, 70, "🎮 Развлечения", "Игра", "expense")
+        assert db.replace_global_rollups(totals, until_id) > 0
+        assert aggregated('global_rollups', key) == aggregated('daily_rollups', key)
+        assert db.recompute_global_rollups() == 0
+        print("✅ Потоковый пересчет исправляет расхождения и учитывает новые операции")
+        
+        # Запросы статистики не читают журнал транзакций
+        plans = _query_plans(db, db.get_global_stats)
+        assert not any('transactions' in plan for plan in plans), plans
+        print("✅ Статистика читается только из общих счетчиков и индексов")
+        
+        db.close()
+    
+    print("✅ Все тесты статистики администратора пройдены!\n")
+
+async def test_analytics_engine():
+    """Тестирование векторных наборов данных аналитики"""
+    print("🧠 Тестирование наборов данных аналитики...")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'engine.db'))
+        engine = AnalyticsEngine(db, max_users=2)
+        
+        assert engine.datasets(1) == {'categories': [], 'daily': [], 'monthly': [], 'totals': (0, 0, 0)}
+        
+        # Категория "Другое" встречается и в доходах, и в расходах
+        now = int(time.time())
+        categories = ["🍔 Еда и фастфуд", "🚌 Транспорт", "💸 Другое"]
+        db.import_transactions(1, [
+            (format_timestamp(now - i * 7000), i % 300 + 0.15, categories[i % 3], "Операция",
+             'income' if i % 5 == 0 else 'expense') for i in range(5000)
+        ])
+        
+        since = (now // 86400 - 30) * 86400
+        datasets = engine.datasets(1, days=30, months=4)
+        assert datasets['categories'] == db.get_expenses_by_category(1, 30)
+        assert datasets['daily'] == db.get_daily_totals(1, since=since)
+        assert [row[:3] for row in datasets['monthly']] == db.get_monthly_totals(1, limit=4)
+        assert all(savings == round(income - expense, 2) for _, income, expense, savings in datasets['monthly'])
+        income = sum(day[1] for day in datasets['daily'])
+        expense = sum(day[2] for day in datasets['daily'])
+        assert [round(value, 2) for value in datasets['totals']] == [round(income, 2), round(expense, 2),
+                                                                     round(income - expense, 2)]
+        print("✅ Наборы данных совпадают с агрегатами SQL")
+        
+        # Новая запись меняет версию данных - сводки перечитываются
+        frame = engine.load(1)
+        assert engine.load(1) is frame
+        db.add_transaction(1, 1000, "🎮 Развлечения", "Кино", "expense")
+        assert engine.load(1) is not frame
+        assert engine.datasets(1)['categories'] == db.get_expenses_by_category(1, 30)
+        
+        engine.load(2)
+        engine.load(3)
+        assert 1 not in engine._frames and len(engine._frames) == 2
+        print("✅ Сводки перечитываются после записи и вытесняются по LRU")
+        
+        db.close()
+    
+    print("✅ Все тесты наборов данных аналитики пройдены!\n")
+
+async def test_text_analytics():
+    """Тестирование текстовой аналитики"""
+    print("📄 Тестирование текстовой аналитики...")
+    
+    assert bar(5, 10, width=4) == '██' and bar(1, 8, width=1) == '▏' and bar(0, 10) == ''
+    assert sparkline([1, 2, 3, 8]) == '▁▂▃█' and sparkline([5, 5]) == '▁▁'
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'text.db'))
+        text_analytics = TextAnalytics(AnalyticsEngine(db))
+        assert text_analytics.render('expenses', 1) == "📊 Нет данных о расходах"
+        assert text_analytics.render('goals', 1) == "🎯 У вас нет активных целей"
+        
+        now = int(time.time())
+        db.import_transactions(1, [
+            (format_timestamp(now - i * 20000), 100 + i, EXPENSE_CATEGORIES[i % 3], "Операция",
+             'income' if i % 4 == 0 else 'expense') for i in range(400)
+        ])
+        db.add_goal(1, "<Ноутбук>", 80000, "savings")
+        
+        # Цифры берутся из тех же наборов данных, что и графики
+        datasets = text_analytics.engine.datasets(1)
+        report = text_analytics.render('expenses', 1)
+        for category, amount in datasets['categories']:
+            assert f"{amount:,.0f}".replace(',', ' ') in report
+        report = text_analytics.render('trends', 1)
+        for month, income, expense, savings in datasets['monthly']:
+            assert month in report and f"{expense:,.0f}".replace(',', ' ') in report
+        assert "&lt;Ноутбук&gt;" in text_analytics.render('goals', 1)
+        print("✅ Четыре вида отчетов строятся по тем же агрегатам, что и графики")
+        
+        # Строки таблицы расходов одной ширины с учетом двойной ширины эмодзи
+        table = text_analytics.render('expenses', 1).split('<pre>')[1].split('</pre>')[0]
+        assert len({display_width(line) for line in table.split('\n')[:-1]}) == 1
+        
+        start = time.perf_counter()
+        for view in text_analytics.views:
+            text_analytics.render(view, 1)
+        print(f"✅ Таблицы выровнены, все отчеты за {(time.perf_counter() - start) * 1000:.1f} мс")
+        
+        db.close()
+    
+    # Текстовый путь не загружает библиотеки отрисовки
+    loaded = subprocess.run(
+        [sys.executable, '-c', "import sys, text_analytics; print('matplotlib' in sys.modules or 'PIL' in sys.modules)"],
+        capture_output=True, text=True, check=True
+    ).stdout.strip()
+    assert loaded == 'False'
+    print("✅ matplotlib и Pillow не импортируются")
+    
+    print("✅ Все тесты текстовой аналитики пройдены!\n")
+
+async def test_conversations():
+    """Тестирование хранилища диалогов ввода операции"""
+    print("💬 Тестирование состояний диалогов...")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'conversations.db')
+        async_db = AsyncDatabase(Database(path))
+        store = ConversationStore(async_db, ttl=60, sweep_batch=5)
+        
+        state = await store.save(1, ConversationState('expense', "🍔 Еда и фастфуд"))
+        assert not hasattr(state, '__dict__')
+        state.amount = 99.99
+        await store.save(1, state)
+        loaded = await store.get(1)
+        assert (loaded.transaction_type, loaded.category, loaded.amount) == ('expense', "🍔 Еда и фастфуд", 99.99)
+        assert loaded.expires_at >= int(time.time()) + 59
+        
+        # Второй процесс с той же базой и перезапуск видят тот же диалог
+        other = AsyncDatabase(Database(path))
+        assert (await ConversationStore(other).get(1)).amount == 99.99
+        other.close()
+        async_db.close()
+        async_db = AsyncDatabase(Database(path))
+        store = ConversationStore(async_db, ttl=60, sweep_batch=5)
+        assert (await store.get(1)).category == "🍔 Еда и фастфуд"
+        print("✅ Диалог переживает перезапуск и виден другим процессам")
+        
+        # Истекшие диалоги не возвращаются и удаляются порциями
+        expired = ConversationStore(async_db, ttl=0)
+        for user_id in range(100, 112):
+            await expired.save(user_id, ConversationState('income', "💼 Подработка"))
+        assert await store.get(100) is None
+        assert await store.sweep() == 12
+        assert await store.sweep() == 0
+        assert await store.get(1) is not None
+        await store.discard(1)
+        assert await store.get(1) is None
+        print("✅ Истекшие диалоги не видны и удаляются сборщиком")
+        
+        # Полный диалог через обработчики: категория -> сумма -> описание
+        handlers = BotHandlers(async_db, None, None, store)
+        replies = []
+        
+        async def reply_text(text, **kwargs):
+            replies.append(text)
+        
+        async def edit_message_text(text, **kwargs):
+            replies.append(text)
+        
+        def message(text):
+            return SimpleNamespace(effective_user=SimpleNamespace(id=7),
+                                   message=SimpleNamespace(text=text, reply_text=reply_text))
+        
+        async def answer():
+            pass
+        
+        query = SimpleNamespace(data="category_expense_🚌 Транспорт", from_user=SimpleNamespace(id=7),
+                                answer=answer, edit_message_text=edit_message_text)
+        await handlers.button_handler(SimpleNamespace(callback_query=query), None)
+        for text in ("abc", "inf", "nan", "1e17", "1e20"):
+            await handlers.handle_text_input(message(text), None)
+            assert replies[-1] == "Пожалуйста, введите корректную сумму!", text
+        assert (await store.get(7)).amount is None
+        await handlers.handle_text_input(message("150,5"), None)
+        assert (await store.get(7)).amount == 150.5
+        await handlers.handle_text_input(message("Такси"), None)
+        assert await store.get(7) is None
+        transaction = (await async_db.get_transactions(7, 1))[0]
+        assert (transaction['amount'], transaction['category'], transaction['description']) == (150.5, "🚌 Транспорт", "Такси")
+        await handlers.handle_text_input(message("просто текст"), None)
+        assert len(await async_db.get_transactions(7, 10)) == 1
+        print("✅ Текст направляется на шаг диалога, сохраненный в базе")
+        
+        # "Отмена" забывает начатый ввод: число после нее не становится операцией
+        query.data = "category_expense_🎮 Развлечения"
+        await handlers.button_handler(SimpleNamespace(callback_query=query), None)
+        query.data = "cancel"
+        await handlers.button_handler(SimpleNamespace(callback_query=query), None)
+        assert await store.get(7) is None
+        await handlers.handle_text_input(message("500"), None)
+        assert len(await async_db.get_transactions(7, 10)) == 1
+        print("✅ Кнопка «Отмена» удаляет состояние диалога")
+        
+        async_db.close()
+    
+    print("✅ Все тесты состояний диалогов пройдены!\n")
+
+async def test_achievements():
+    """Тестирование правил достижений по счетчикам"""
+    print("🏆 Тестирование достижений...")
+    
+    # Правила на счетчиках: неделя 2000 начинается в понедельник start
+    day = 86400
+    start = (2000 * 7 - 3) * day
+    big = 100_000  # 1000 руб. в копейках
+    progress = AchievementProgress(2000, fast_food_since=start)
+    assert progress.record_transaction(50_000, "💼 Подработка", 'income', start, 2000, 50_000, big) == ['first_save']
+    assert progress.record_transaction(20_000, FAST_FOOD_CATEGORY, 'expense', start + day, 2000, 30_000, big) == []
+    # Первая операция следующей недели закрывает неделю с экономией; после фастфуда прошло 6 дней
+    assert progress.record_transaction(1_000, "🚌 Транспорт", 'expense', start + 7 * day, 2001, 29_000, big) == ['week_saver']
+    assert progress.record_transaction(1_000, "🚌 Транспорт", 'expense', start + 8 * day, 2001, 28_000, big) == ['smart_spender']
+    # Операция задним числом не меняет счетчики текущей недели
+    progress.record_transaction(1_000, "🚌 Транспорт", 'expense', start + 2 * day, 2000, 27_000, big)
+    assert (progress.week, progress.week_income, progress.week_expense) == (2001, 0, 2_000)
+    # Неделя 2001 без экономии, баланс дорос до 1000 руб.
+    assert progress.record_transaction(92_000, "💼 Подработка", 'income', start + 14 * day, 2002, 119_000, big) == ['big_saver']
+    assert progress.record_transaction(1_000, "💼 Подработка", 'income', start + 21 * day, 2003, 120_000, big) == []
+    assert progress.earned == sum(ACHIEVEMENT_BITS.values()) - ACHIEVEMENT_BITS['goal_reached']
+    assert not hasattr(progress, '__dict__')
+    print("✅ Правила недельной экономии, серии без фастфуда и баланса")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'achievements.db'))
+        conn = db._get_connection()
+        db.add_user(1, "saver", "Saver")
+        
+        # Каждое достижение выдается один раз, очки начисляются один раз
+        assert db.add_transaction(1, 400, "💼 Подработка", "Аванс", "income") == ['first_save']
+        assert db.add_transaction(1, 700, "💼 Подработка", "Зарплата", "income") == ['big_saver']
+        assert db.add_transaction(1, 700, "💼 Подработка", "Премия", "income") == []
+        assert sorted(db.get_user_achievements(1)) == ['big_saver', 'first_save']
+        assert db.get_user_points(1) == 210
+        
+        db.add_goal(1, "Велосипед", 1000, "savings")
+        goal_id = conn.execute('SELECT id FROM goals WHERE user_id = 1').fetchone()[0]
+        assert db.update_goal_progress(goal_id, 600) == []
+        assert db.update_goal_progress(goal_id, 600) == ['goal_reached']
+        assert db.update_goal_progress(goal_id, 100) == []
+        assert db.get_user_points(1) == 310
+        print("✅ Достижение и очки выдаются ровно один раз")
+        
+        # Число запросов на запись не зависит от длины истории, журнал не сканируется
+        db.import_transactions(1, [("2024-01-01 12:00:00", 1, "🚌 Транспорт", "", "expense")] * 2000)
+        db.add_transaction(1, 10, "🚌 Транспорт", "Прогрев", "expense")
+        statements = []
+        conn.set_trace_callback(statements.append)
+        db.add_transaction(1, 10, "🚌 Транспорт", "Метро", "expense")
+        conn.set_trace_callback(None)
+        assert not any('transactions WHERE user_id' in sql for sql in statements), statements
+        assert len(statements) <= 12, statements
+        print(f"✅ Запись с проверкой достижений: {len(statements)} запросов при истории из 2000 операций")
+        
+        # Параллельные записи через групповой коммит: без повторных выдач
+        async_db = AsyncDatabase(db)
+        db.add_user(2, "rush", "Rush")
+        results = await asyncio.gather(*(async_db.add_transaction(2, 100, "💼 Подработка", "Доход", "income")
+                                         for _ in range(30)))
+        assert sorted(achievement for earned in results for achievement in earned) == ['big_saver', 'first_save']
+        assert await async_db.get_user_points(2) == 210
+        print("✅ Параллельные записи не выдают достижение дважды")
+        
+        # Импортированная история: счетчики строятся по журналу, дальше работают события
+        now = int(time.time())
+        db.add_user(3, "history", "History")
+        db.import_transactions(3, [(format_timestamp(now - 10 * day), 300, FAST_FOOD_CATEGORY, "Бургер", "expense"),
+                                   (format_timestamp(now - 7 * day), 500, "💼 Подработка", "Зарплата", "income")])
+        assert db.get_user_achievements(3) == ['first_save']
+        assert sorted(db.add_transaction(3, 50, "🚌 Транспорт", "Метро", "expense")) == ['smart_spender', 'week_saver']
+        assert db.get_user_points(3) == 10 + 50 + 30
+        print("✅ Недельная экономия и неделя без фастфуда по импортированной истории")
+        
+        async_db.close()
+    
+    print("✅ Все тесты достижений пройдены!\n")
+
+async def test_callback_routing():
+    """Тестирование готовых клавиатур и таблицы обработчиков кнопок"""
+    print("🔘 Тестирование клавиатур и маршрутизации кнопок...")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = AsyncDatabase(Database(os.path.join(tmp, 'routing.db')))
+        handlers = BotHandlers(db, None, None, None)
+        router = handlers.router
+        assert router.resolve("balance") == (handlers.show_balance, ())
+        assert router.resolve("history") == (handlers.show_history, ())
+        assert router.resolve("history_older_1725193800_42") == (handlers.show_history, ("older_1725193800_42",))
+        assert router.resolve("analytics") == (handlers.show_analytics_menu, ())
+        assert router.resolve("analytics_text") == (handlers.handle_analytics_selection, ("text",))
+        assert router.resolve("category_income_💼 Подработка") == (handlers.handle_category_selection,
+                                                                  ("income_💼 Подработка",))
+        assert router.resolve("unknown") is None and router.resolve("category") is None
+        try:
+            CallbackRouter().prefix("goal_type", handlers.start_add_goal)
+            assert False, "префикс с '_' не найдется разбором до первого '_'"
+        except ValueError:
+            pass
+        print("✅ Точные совпадения и префиксы находятся поиском в словаре")
+        
+        # Каждая кнопка готовых клавиатур ведет к обработчику (кроме еще не реализованных типов целей)
+        buttons = [button for keyboard in KEYBOARDS.values() for row in keyboard.inline_keyboard for button in row]
+        unrouted = {button.callback_data for button in buttons if router.resolve(button.callback_data) is None}
+        assert unrouted == {"goal_type_save", "goal_type_spend"}, unrouted
+        assert all(len(button.callback_data.encode()) <= 64 for button in buttons)
+        print(f"✅ {len(buttons)} кнопок в {len(KEYBOARDS)} клавиатурах, callback_data не длиннее 64 байт")
+        
+        # Одни и те же неизменяемые объекты отдаются во все ответы
+        markups = []
+        
+        async def answer():
+            pass
+        
+        async def edit_message_text(text, reply_markup=None, **kwargs):
+            markups.append(reply_markup)
+        
+        query = SimpleNamespace(data="tips", from_user=SimpleNamespace(id=1), answer=answer,
+                                edit_message_text=edit_message_text)
+        for data in ("tips", "tips", "back_to_main", "analytics", "analytics_text", "analytics_text"):
+            query.data = data
+            await handlers.button_handler(SimpleNamespace(callback_query=query), None)
+        assert markups[0] is markups[1] is KEYBOARDS['tips']
+        assert markups[2] is KEYBOARDS['main_menu']
+        assert markups[3] is KEYBOARDS['analytics_menu']
+        assert markups[4] is KEYBOARDS['analytics_menu_text'] and markups[5] is KEYBOARDS['analytics_menu']
+        try:
+            KEYBOARDS['main_menu'].inline_keyboard = ()
+            assert False, "клавиатура должна быть неизменяемой"
+        except AttributeError:
+            pass
+        try:
+            KEYBOARDS['tips'] = None
+            assert False, "реестр должен быть только для чтения"
+        except TypeError:
+            pass
+        print("✅ Клавиатуры собираются один раз и не меняются")
+        
+        # Настройка "Текстом" хранится в базе: ее видит новый процесс бота
+        query.data = "analytics_text"
+        await handlers.button_handler(SimpleNamespace(callback_query=query), None)
+        db.close()
+        db = AsyncDatabase(Database(os.path.join(tmp, 'routing.db')))
+        query.data = "analytics"
+        await BotHandlers(db, None, None, None).button_handler(SimpleNamespace(callback_query=query), None)
+        assert markups[-1] is KEYBOARDS['analytics_menu_text']
+        db.close()
+        print("✅ Аналитика текстом сохраняется после перезапуска")
+    
+    print("✅ Все тесты маршрутизации кнопок пройдены!\n")
+
+async def test_pagination():
+    """Тестирование постраничной истории"""
+    print("📋 Тестирование постраничной истории...")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'pages.db'))
+        
+        # Много записей с одинаковым временем - порядок должен задаваться id
+        for i in range(25):
+            db.add_transaction(1, i + 1, "🚌 Транспорт", f"Поездка {i}", "expense")
+        expected = [trans['id'] for trans in db.get_transactions(1, 100)]
+        assert expected == sorted(expected, reverse=True)
+        
+        pages = []
+        page, has_older, has_newer = db.get_transactions_page(1, 10)
+        assert not has_newer
+        pages.append(page)
+        while has_older:
+            last = page[-1]
+            page, has_older, has_newer = db.get_transactions_page(1, 10, before=(last['timestamp'], last['id']))
+            assert has_newer
+            pages.append(page)
+        
+        assert [len(page) for page in pages] == [10, 10, 5]
+        assert [trans['id'] for page in pages for trans in page] == expected
+        print("✅ Страницы покрывают всю историю без пропусков и повторов")
+        
+        # Возврат к более новой странице дает ту же страницу
+        first = pages[2][0]
+        page, has_older, has_newer = db.get_transactions_page(1, 10, after=(first['timestamp'], first['id']))
+        assert page == pages[1] and has_older and has_newer
+        first = pages[1][0]
+        page, has_older, has_newer = db.get_transactions_page(1, 10, after=(first['timestamp'], first['id']))
+        assert page == pages[0] and has_older and not has_newer
+        print("✅ Навигация назад возвращает прежние страницы")
+        
+        plans = _query_plans(db, db.get_transactions_page, 1, 10, (first['timestamp'], first['id']))
+        assert all('USING INDEX idx_transactions_user_date' in plan and 'TEMP B-TREE' not in plan
+                   for plan in plans), plans
+        print("✅ Страницы читаются по индексу без OFFSET и сортировки")
+        
+        db.close()
+    
+    print("✅ Все тесты постраничной истории пройдены!\n")
+
+async def test_import():
+    """Тестирование импорта транзакций"""
+    print("📥 Тестирование импорта...")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'import.db'))
+        db.add_transaction(1, 100, "💰 Зарплата", "До импорта", "income")
+        
+        # Выписка банка: точка с запятой, запятая в суммах, знак вместо типа, cp1251
+        statement = os.path.join(tmp, 'statement.csv')
+        with open(statement, 'w', encoding='cp1251', newline='') as f:
+            f.write("Дата операции;Сумма операции;Категория;Описание\n")
+            f.write("01.09.2024 12:30:00;-1 250,50;Транспорт;Такси\n")
+            f.write("02.09.2024;-300;Фастфуд;Бургер\n")
+            f.write("05.09.2024;15 000,00;Зарплата;Аванс\n")
+            f.write("вчера;-10;;Ошибка\n")
+        
+        result = import_file(db, 1, statement, 'csv')
+        assert (result.imported, result.skipped) == (3, 1), (result.imported, result.errors)
+        assert "строка 5" in result.errors[0]
+        
+        jsonl = os.path.join(tmp, 'history.jsonl')
+        with open(jsonl, 'w', encoding='utf-8') as f:
+            f.write('{"date": "2024-09-03 08:00:00", "amount": 45, "category": "🚌 Транспорт", "type": "expense"}\n')
+            f.write('{"date": "2024-09-04", "amount": "500", "category": "стипендия", "type": "доход"}\n')
+            f.write('не json\n')
+            f.write('{"date": "2024-09-05", "amount": 1e20, "category": "🚌 Транспорт", "type": "expense"}\n')
+        
+        result = import_file(db, 1, jsonl, 'jsonl')
+        assert (result.imported, result.skipped) == (2, 2)
+        assert "некорректная сумма" in result.errors[1]
+        print("✅ CSV-выписка и JSONL разобраны, ошибочные строки пропущены")
+        
+        history = {trans['description']: trans for trans in db.get_transactions(1, 100)}
+        assert history['Такси']['amount'] == 1250.5 and history['Такси']['type'] == 'expense'
+        assert history['Такси']['category'] == "🚌 Транспорт"
+        assert history['Бургер']['category'] == "💸 Другое"
+        assert history['Аванс']['date'] == "2024-09-05 00:00:00"
+        print("✅ Категории сопоставлены со списками бота")
+        
+        # Баланс и сводки, обновленные один раз на импорт, совпадают с журналом
+        assert db.get_user_balance(1) == 100 + 15000 + 500 - 1250.5 - 300 - 45
+        assert db.reconcile_balances(fix=False) == []
+        conn = db._get_connection()
+        snapshot = conn.execute('SELECT * FROM daily_rollups ORDER BY 1, 2, 3, 4').fetchall()
+        db.rebuild_rollups()
+        assert conn.execute('SELECT * FROM daily_rollups ORDER BY 1, 2, 3, 4').fetchall() == snapshot
+        print("✅ Баланс и сводки согласованы с журналом")
+        
+        # Порции импорта коммитятся по одной: чужая запись не ждет конца загрузки
+        async_db = AsyncDatabase(db)
+        other_written = threading.Event()
+        
+        def rows():
+            for i in range(30):
+                if i == 20:
+                    assert other_written.wait(5), "запись ждала окончания импорта"
+                yield ("2024-09-10 10:00:00", 10, "🚌 Транспорт", "", "expense")
+        
+        import_task = asyncio.create_task(async_db.import_transactions(5, rows(), chunk_size=10))
+        while await async_db.get_user_balance(5) == 0:
+            await asyncio.sleep(0.005)
+        await async_db.add_transaction(6, 100, "💰 Зарплата", "Во время импорта", "income")
+        other_written.set()
+        assert await import_task == 30
+        assert await async_db.get_user_balance(5) == -300
+        assert await async_db.reconcile_balances(fix=False) == []
+        print("✅ Импорт пишется короткими транзакциями, другие записи идут между ними")
+        
+        # Оборванный импорт: закоммиченные порции остаются и учитываются в достижениях
+        def broken():
+            for _ in range(15):
+                yield ("2024-09-10 10:00:00", 100, "💰 Зарплата", "", "income")
+            raise ValueError("файл оборвался")
+        
+        for user_id in (7, 8):
+            try:
+                if user_id == 7:
+                    db.import_transactions(user_id, broken(), chunk_size=10)
+                else:
+                    await async_db.import_transactions(user_id, broken(), chunk_size=10)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError("импорт должен прерваться")
+            assert await async_db.get_user_balance(user_id) == 1000
+            assert sorted(await async_db.get_user_achievements(user_id)) == ['big_saver', 'first_save']
+        print("✅ Оборванный импорт завершается по закоммиченным порциям")
+        
+        async_db.close()
+    
+    print("✅ Все тесты импорта пройдены!\n")
+
+async def test_export():
+    """Тестирование потокового экспорта"""
+    print("📤 Тестирование экспорта...")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'export.db'))
+        source = os.path.join(tmp, 'source.jsonl')
+        with open(source, 'w', encoding='utf-8') as f:
+            for i in range(25):
+                f.write(f'{{"date": "2024-09-{i + 1:02d} 10:00:00", "amount": {i + 0.5}, '
+                        f'"category": "🍔 Еда и фастфуд", "description": "Обед, «{i}»", "type": "expense"}}\n')
+        import_file(db, 1, source, 'jsonl')
+        db.add_transaction(2, 999, "💰 Зарплата", "Чужая", "income")
+        
+        # Пачки меньше истории: файл собирается из нескольких fetchmany
+        batches = list(db.iter_transactions(1, batch_size=10))
+        assert [len(batch) for batch in batches] == [10, 10, 5]
+        
+        path = os.path.join(tmp, 'export.csv')
+        assert export_csv(db, 1, path) == 25
+        with open(path, encoding='utf-8-sig', newline='') as f:
+            rows = list(csv.DictReader(f))
+        assert len(rows) == 25 and rows[0]['date'] == "2024-09-01 10:00:00"
+        assert rows[3]['description'] == "Обед, «3»" and float(rows[3]['amount']) == 3.5
+        print("✅ CSV выгружен по порядку, только транзакции пользователя")
+        
+        # Выгрузка снова загружается импортом без потерь
+        copy = Database(os.path.join(tmp, 'copy.db'))
+        result = import_file(copy, 1, path, 'csv')
+        assert (result.imported, result.skipped) == (25, 0)
+        assert copy.get_user_balance(1) == db.get_user_balance(1)
+        copy.close()
+        print("✅ Выгрузка CSV повторно импортируется")
+        
+        if parquet_available():
+            import pyarrow.parquet as pq
+            path = os.path.join(tmp, 'export.parquet')
+            assert export_parquet(db, 1, path) == 25
+            table = pq.read_table(path)
+            assert table.num_rows == 25
+            assert sum(table.column('amount').to_pylist()) == sum(i + 0.5 for i in range(25))
+            print("✅ Parquet выгружен")
+        else:
+            print("⚠️ pyarrow не установлен, экспорт в Parquet не проверен")
+        
+        db.close()
+    
+    print("✅ Все тесты экспорта пройдены!\n")
+
+async def test_chart_cache():
+    """Тестирование кэша графиков"""
+    print("🖼 Тестирование кэша графиков...")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        # LRU вытесняет давно не использованные графики по суммарному размеру
+        cache = ChartCache(max_bytes=100, disk_dir=None)
+        cache.put('a', b'x' * 40)
+        cache.put('b', b'x' * 40)
+        assert cache.get('a') is not None
+        cache.put('c', b'x' * 40)
+        assert cache.get('b') is None and cache.get('a') is not None and cache.get('c') is not None
+        cache.put('huge', b'x' * 101)
+        assert cache.get('huge') is None
+        stats = cache.stats()
+        assert (stats['hits'], stats['misses'], stats['evictions']) == (3, 2, 1)
+        assert stats['bytes'] == 80
+        print("✅ LRU ограничен по байтам, счетчики попаданий и промахов ведутся")
+        
+        # Дисковый уровень переживает перезапуск и сам ограничен по размеру
+        disk_dir = os.path.join(tmp, 'charts')
+        cache = ChartCache(max_bytes=100, disk_dir=disk_dir, disk_max_bytes=100)
+        cache.put((1, 'pie', (30,), 1), b'p' * 40)
+        cache.put((1, 'trend', (6,), 1), b't' * 40)
+        restarted = ChartCache(max_bytes=100, disk_dir=disk_dir, disk_max_bytes=100)
+        assert restarted.get((1, 'pie', (30,), 1)) == b'p' * 40
+        assert restarted.stats()['disk_hits'] == 1
+        restarted.put((2, 'pie', (30,), 1), b'q' * 40)
+        assert len(os.listdir(disk_dir)) == 2
+        assert restarted.get((1, 'trend', (6,), 1)) is None
+        print("✅ Дисковый кэш сохраняется между запусками")
+        
+        # Запись транзакции или цели меняет версию данных и ключ графика
+        db = Database(os.path.join(tmp, 'charts.db'))
+        analytics = Analytics(db, ChartCache(disk_dir=None))
+        db.add_transaction(1, 300, "🍔 Еда и фастфуд", "Обед", "expense")
+        
+        first = analytics.create_expense_pie_chart(1)
+        assert analytics.create_expense_pie_chart(1, days=30) is first
+        assert analytics.cache.stats()['hits'] == 1
+        
+        version = db.get_data_version(1)
+        db.add_transaction(1, 100, "🚌 Транспорт", "Проезд", "expense")
+        assert db.get_data_version(1) == version + 1
+        assert analytics.create_expense_pie_chart(1) is not first
+        
+        db.add_goal(1, "Наушники", 5000, "savings")
+        goal_id = db.get_user_goals(1)[0]['id']
+        db.update_goal_progress(goal_id, 1000)
+        assert db.get_data_version(1) == version + 3
+        assert db.get_data_version(2) == 0
+        assert analytics.cache.stats()['misses'] == 2
+        print("✅ Новые записи инвалидируют графики пользователя")
+        
+        db.close()
+    
+    print("✅ Все тесты кэша графиков пройдены!\n")
+
+async def test_render_pool():
+    """Тестирование пула отрисовки графиков"""
+    print("🎨 Тестирование пула отрисовки...")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'render.db'))
+        db.add_transaction(1, 300, "🍔 Еда и фастфуд", "Обед", "expense")
+        async_db = AsyncDatabase(db)
+        pool = ChartRenderPool(async_db, Analytics(db, ChartCache(disk_dir=None)), workers=1, max_pending=1)
+        pool.start()
+        
+        chart = await pool.render('create_expense_pie_chart', 1)
+        assert chart.startswith(b'\x89PNG')
+        assert await pool.render('create_expense_pie_chart', 1) is chart
+        print("✅ График отрисован в отдельном процессе, повтор взят из кэша")
+        
+        # Сверх max_pending запросы сразу получают отказ, а не ждут в очереди
+        results = await asyncio.gather(
+            *(pool.render('create_monthly_trend_chart', 1) for _ in range(3)),
+            return_exceptions=True
+        )
+        assert sum(isinstance(result, bytes) for result in results) == 1
+        assert sum(isinstance(result, RenderPoolBusy) for result in results) == 2
+        print("✅ Переполненная очередь отвечает \"занято\"")
+        
+        # Зависшая отрисовка прерывается таймером в процессе, сам процесс остается в пуле
+        pool.timeout = 0.001
+        try:
+            await pool.render('create_income_vs_expense_chart', 1)
+        except RenderTimeout:
+            pass
+        else:
+            raise AssertionError("отрисовка должна прерваться по таймеру")
+        pool.timeout = 20
+        assert (await pool.render('create_income_vs_expense_chart', 1)).startswith(b'\x89PNG')
+        print("✅ Отрисовка прерывается по таймауту")
+        
+        pool.close()
+        async_db.close()
+    
+    print("✅ Все тесты пула отрисовки пройдены!\n")
+
+async def test_prerender():
+    """Тестирование фоновой отрисовки графиков"""
+    print("🌙 Тестирование фоновой отрисовки...")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'prerender.db'))
+        for user_id in (1, 2, 3):
+            db.add_transaction(user_id, 100 * user_id, "🍔 Еда и фастфуд", "Обед", "expense")
+        # Пользователь 3 давно не заходил
+        conn = db._get_connection()
+        conn.execute("UPDATE data_versions SET updated_at = updated_at - 7 * 86400 WHERE user_id = 3")
+        conn.commit()
+        
+        active = db.get_recently_active_users(int(time.time()) - 3600)
+        assert sorted(active) == [1, 2], active
+        assert db.get_recently_active_users(int(time.time()) - 3600, limit=1) in ([1], [2])
+        print("✅ Недавно активные пользователи выбираются по времени изменения данных")
+        
+        async_db = AsyncDatabase(db)
+        pool = ChartRenderPool(async_db, Analytics(db, ChartCache(disk_dir=None)), workers=1)
+        pool.start()
+        engine = AnalyticsEngine(db)
+        charts = ('create_monthly_trend_chart', 'create_expense_pie_chart')
+        prerenderer = ChartPrerenderer(async_db, pool, engine, charts=charts, cpu_budget=1.0)
+        
+        assert await pool.cached('create_expense_pie_chart', 1) is None
+        assert await prerenderer.run() == 4
+        for user_id in (1, 2):
+            for chart in charts:
+                assert (await pool.cached(chart, user_id)).startswith(b'\x89PNG')
+        assert await pool.cached('create_expense_pie_chart', 3) is None
+        assert engine.load(1) is engine.load(1)
+        print("✅ Графики активных пользователей нарисованы заранее и лежат в кэше")
+        
+        # Повторный проход ничего не рисует; после новой операции - только ее владельцу
+        assert await prerenderer.run() == 0 and prerenderer.skipped == 4
+        db.add_transaction(2, 50, "🚌 Транспорт", "Проезд", "expense")
+        assert await pool.cached('create_expense_pie_chart', 2) is None
+        assert await prerenderer.run() == 2
+        print("✅ Перерисовываются только графики с изменившимися данными")
+        
+        # Пока графики ждут пользователи, фоновый проход уступает им
+        db.add_transaction(1, 70, "🚌 Транспорт", "Проезд", "expense")
+        pool._pending += 1
+        assert await prerenderer.run() == 0 and prerenderer.paused == 1
+        pool._pending -= 1
+        assert pool.live_pending == 0
+        print("✅ Фоновая отрисовка приостанавливается при живой нагрузке")
+        
+        # Доля процессора: после каждого графика проход спит пропорционально времени отрисовки
+        prerenderer.cpu_budget = 0.5
+        start = time.perf_counter()
+        assert await prerenderer.run() == 2
+        elapsed = time.perf_counter() - start
+        assert pool.live_pending == 0 and pool._background == 0
+        assert elapsed >= 0.1, elapsed
+        print(f"✅ Проход с бюджетом 50% ЦП занял {elapsed:.2f}с")
+        
+        pool.close()
+        async_db.close()
+    
+    print("✅ Все тесты фоновой отрисовки пройдены!\n")
+
+async def test_parallel_rendering():
+    """Тестирование одновременной отрисовки графиков в потоках"""
+    print("🧵 Тестирование параллельной отрисовки...")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'parallel.db'))
+        for user_id in (1, 2, 3):
+            db.import_transactions(user_id, (
+                (f"2024-{i % 12 + 1:02d}-{i % 28 + 1:02d} 12:00:00", i * user_id + 10, "🍔 Еда и фастфуд",
+                 "Операция", 'expense' if i % 3 else 'income')
+                for i in range(200)
+            ))
+            db.add_transaction(user_id, 100 * user_id, "🚌 Транспорт", "Проезд", "expense")
+            db.add_goal(user_id, "Наушники", 5000, "savings")
+        
+        analytics = Analytics(db, ChartCache(max_bytes=0, disk_dir=None),
+                              profiles={'test': {'dpi': 40, 'format': 'png'}})
+        charts = ['create_expense_pie_chart', 'create_income_vs_expense_chart',
+                  'create_savings_progress_chart', 'create_monthly_trend_chart']
+        jobs = [(charts[i % len(charts)], i % 3 + 1) for i in range(100)]
+        
+        def render(job):
+            return analytics.render(*job, profile='test')
+        
+        # Эталон - последовательная отрисовка каждого графика
+        expected = {job: render(job) for job in set(jobs)}
+        
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            results = list(executor.map(render, jobs))
+        
+        mismatches = [job for job, result in zip(jobs, results) if result != expected[job]]
+        assert not mismatches, mismatches
+        print("✅ 100 одновременных отрисовок совпадают с последовательными побайтно")
+        
+        db.close()
+    
+    print("✅ Все тесты параллельной отрисовки пройдены!\n")
+
+async def test_chart_profiles():
+    """Тестирование профилей вывода графиков"""
+    print("🖨 Тестирование профилей графиков...")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'profiles.db'))
+        db.add_transaction(1, 300, "🍔 Еда и фастфуд", "Обед", "expense")
+        db.add_transaction(1, 120, "🚌 Транспорт", "Проезд", "expense")
+        analytics = Analytics(db, ChartCache(max_bytes=0, disk_dir=None))
+        
+        charts = {name: analytics.render('create_expense_pie_chart', 1, profile=name)
+                  for name in ('print', 'full', 'lite', 'webp')}
+        assert charts['print'].startswith(b'\x89PNG') and charts['full'].startswith(b'\x89PNG')
+        assert charts['lite'].startswith(b'\xff\xd8') and charts['webp'][8:12] == b'WEBP'
+        with Image.open(io.BytesIO(charts['full'])) as image:
+            assert image.mode == 'P'
+        assert len(charts['full']) < len(charts['print']) / 3
+        print("✅ Профили задают разрешение и формат: PNG, PNG с палитрой, JPEG, WebP")
+        
+        # Первый профиль не укладывается в бюджет по размеру - берется более легкий
+        analytics.byte_budget = len(charts['full']) - 1
+        chart = analytics.render('create_expense_pie_chart', 1)
+        assert len(chart) <= analytics.byte_budget and chart.startswith(b'\x89PNG')
+        
+        # Профили, кодировавшиеся дольше бюджета по времени, пропускаются сразу
+        analytics.byte_budget = 10 * 1024 * 1024
+        analytics.time_budget = 0
+        assert analytics.render('create_expense_pie_chart', 1).startswith(b'\xff\xd8')
+        print("✅ Профиль 'auto' укладывается в бюджеты размера и времени")
+        
+        db.close()
+    
+    print("✅ Все тесты профилей графиков пройдены!\n")
+
+async def test_chart_templates():
+    """Тестирование заготовок графиков"""
+    print("🧩 Тестирование заготовок графиков...")
+    
+    def pixels(chart: bytes):
+        with Image.open(io.BytesIO(chart)) as image:
+            return np.asarray(image.convert('RGB'), dtype=np.int16)
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'templates.db'))
+        now = int(time.time())
+        categories = ["🍔 Еда и фастфуд", "🚌 Транспорт", "🎮 Развлечения"]
+        # Разные масштабы сумм меняют деления и ширину подписей осей
+        for user_id, scale in ((1, 1), (2, 1000), (3, 0.01)):
+            db.import_transactions(user_id, [
+                (format_timestamp(now - i * 40000 * user_id), (i % 90 + 10) * scale,
+                 categories[i % user_id], "Операция", 'income' if i % 4 == 0 else 'expense')
+                for i in range(300)
+            ])
+            for goal in range(user_id + 1):
+                db.add_goal(user_id, f"Цель {goal}", 5000 * (goal + 1), "savings")
+        
+        profiles = {'test': {'dpi': 50, 'format': 'png'}}
+        fresh = Analytics(db, ChartCache(max_bytes=0, disk_dir=None), profiles=profiles, max_templates=0)
+        reused = Analytics(db, ChartCache(max_bytes=0, disk_dir=None), profiles=profiles)
+        charts = ['create_expense_pie_chart', 'create_income_vs_expense_chart',
+                  'create_savings_progress_chart', 'create_monthly_trend_chart']
+        
+        # Одна и та же заготовка получает данные разных пользователей по очереди
+        for user_id in (1, 2, 3, 1, 4, 2):
+            for chart in charts:
+                expected = pixels(fresh.render(chart, user_id, profile='test'))
+                actual = pixels(reused.render(chart, user_id, profile='test'))
+                assert expected.shape == actual.shape, (chart, user_id)
+                assert np.abs(expected - actual).max() == 0, (chart, user_id)
+        print("✅ Графики из заготовок попиксельно совпадают с новыми фигурами")
+        
+        templates = reused._local.templates
+        figures = {id(template['fig']) for template in templates.values()}
+        reused.render('create_monthly_trend_chart', 1, profile='test')
+        assert {id(template['fig']) for template in templates.values()} == figures
+        assert not hasattr(fresh._local, 'templates')
+        print(f"✅ Фигуры переиспользуются: {len(templates)} заготовок на поток")
+        
+        # Отрисовка, прерванная после новых секторов, не ломает следующие
+        pie = templates[('pie',)]
+        draw = pie['ax'].pie
+        
+        def interrupted(*args, **kwargs):
+            draw(*args, **kwargs)
+            raise RenderTimeout("Отрисовка прервана")
+        
+        pie['ax'].pie = interrupted
+        try:
+            reused.render('create_expense_pie_chart', 2, profile='test')
+        except RenderTimeout:
+            pass
+        else:
+            raise AssertionError("отрисовка должна прерваться")
+        for user_id in (1, 3):
+            expected = pixels(fresh.render('create_expense_pie_chart', user_id, profile='test'))
+            actual = pixels(reused.render('create_expense_pie_chart', user_id, profile='test'))
+            assert expected.shape == actual.shape and np.abs(expected - actual).max() == 0, user_id
+        assert templates[('pie',)] is not pie
+        print("✅ После прерванной отрисовки круговая диаграмма строится заново")
+        
+        db.close()
+    
+    print("✅ Все тесты заготовок графиков пройдены!\n")
+
+async def test_webhook():
+    """Тестирование приема обновлений через webhook и polling"""
+    print("🌐 Тестирование webhook...")
+    
+    telegram = FakeTelegram()
+    await telegram.start()
+    application = telegram.build_application()
+    handled = []
+    release = asyncio.Event()
+    release.set()
+    active = peak = 0
+    
+    async def on_text(update, context):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        try:
+            await release.wait()
+            await asyncio.sleep(0.02)
+            handled.append((update.effective_user.id, int(update.message.text)))
+            await update.message.reply_text("ok")
+        finally:
+            active -= 1
+    
+    application.add_handler(MessageHandler(filters.TEXT, on_text))
+    await application.initialize()
+    
+    server = WebhookServer(application, path='/telegram', secret_token='s3cret', host='127.0.0.1',
+                           port=0, queue_size=100)
+    await server.start()
+    base = f"http://127.0.0.1:{server.port}"
+    
+    async with httpx.AsyncClient() as client:
+        health = await client.get(base + '/')
+        assert health.status_code == 200 and health.json()['status'] == 'healthy'
+        assert (await client.get(base + '/health')).json() == {"status": "ok", "queued": 0}
+        assert (await client.post(base + '/telegram', json=message_update(1, 1, "1"))).status_code == 403
+        for body in (b'{', b'1', b'[]', b'\xff', b'{"update_id": "abc"}', b'{"update_id": true}',
+                     b'{"update_id": 1, "message": 5}'):
+            response = await client.post(base + '/telegram', content=body,
+                                         headers={'X-Telegram-Bot-Api-Secret-Token': 's3cret'})
+            assert response.status_code == 400, (body, response.status_code)
+        assert (await client.get(base + '/missing')).status_code == 404
+    
+    # Заголовки, которые httpx не отправит: ответ 400 и закрытое соединение вместо обрыва
+    secret = b"X-Telegram-Bot-Api-Secret-Token: s3cret\r\n"
+    for head in (b"POST /telegram HTTP/1.1\r\n" + secret + b"Content-Length: abc\r\n\r\n",
+                 b"POST /telegram HTTP/1.1\r\n" + secret + b"Content-Length: -5\r\n\r\n",
+                 b"GARBAGE\r\n\r\n"):
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+        writer.write(head)
+        response = await reader.read()
+        writer.close()
+        assert response.startswith(b"HTTP/1.1 400 "), (head, response)
+    assert server.accepted == 0
+    print("✅ Проверка здоровья, секретный заголовок и ошибки запроса")
+    
+    # Без секрета тело не читается; медленный или молчащий клиент не держит соединение
+    guarded = WebhookServer(application, path='/telegram', secret_token='s3cret', host='127.0.0.1', port=0,
+                            read_timeout=0.2, idle_timeout=0.5, max_connections=2)
+    await guarded.start()
+    
+    async def exchange(data: bytes) -> bytes:
+        reader, writer = await asyncio.open_connection('127.0.0.1', guarded.port)
+        writer.write(data)
+        response = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        return response
+    
+    assert (await exchange(b"POST /telegram HTTP/1.1\r\nContent-Length: 100000\r\n\r\n")).startswith(b"HTTP/1.1 403 ")
+    assert (await exchange(b"POST /telegram HTTP/1.1\r\nContent-")).startswith(b"HTTP/1.1 408 ")
+    assert (await exchange(b"POST /telegram HTTP/1.1\r\nX-Telegram-Bot-Api-Secret-Token: s3cret\r\n"
+                           b"Content-Length: 10\r\n\r\n{}")).startswith(b"HTTP/1.1 408 ")
+    started = time.monotonic()
+    assert await exchange(b"") == b""
+    assert time.monotonic() - started >= 0.5
+    
+    # Открытых соединений не больше max_connections
+    idle = [await asyncio.open_connection('127.0.0.1', guarded.port) for _ in range(2)]
+    while len(guarded._connections) < 2:
+        await asyncio.sleep(0.01)
+    assert (await exchange(b"GET /health HTTP/1.1\r\n\r\n")).startswith(b"HTTP/1.1 503 ")
+    for _, writer in idle:
+        writer.close()
+    await guarded.stop()
+    assert guarded.accepted == 0
+    print("✅ Таймауты чтения и простоя, предел соединений, секрет до чтения тела")
+    
+    # 4 пользователя по 10 сообщений: пока обработчики задержаны, в работе по одному на пользователя
+    release.clear()
+    updates = [message_update(i, i % 4 + 1, str(i)) for i in range(40)]
+    statuses = await telegram.post_updates(base + '/telegram', updates, connections=8, secret_token='s3cret')
+    assert statuses == [200] * 40
+    
+    async def all_users_active():
+        while active < 4:
+            await asyncio.sleep(0.01)
+    
+    await asyncio.wait_for(all_users_active(), 5)
+    release.set()
+    await server.stop()
+    assert peak == 4, peak
+    assert server.processed == 40 and len(telegram.sent) == 40
+    for user_id in range(1, 5):
+        texts = [text for user, text in handled if user == user_id]
+        assert texts == sorted(texts) and len(texts) == 10
+    print("✅ 40 обновлений: 4 пользователя одновременно, порядок внутри пользователя сохранен")
+    
+    await application.shutdown()
+    
+    # У каждого обновления своя задача: пришедшие после долгого обновления пользователя 1 не ждут его
+    slow = asyncio.Event()
+    finished = []
+    
+    async def on_slow(update, context):
+        if update.effective_user.id == 1:
+            await slow.wait()
+        finished.append(update.effective_user.id)
+    
+    application = telegram.build_application()
+    application.add_handler(MessageHandler(filters.TEXT, on_slow))
+    await application.initialize()
+    server = WebhookServer(application, path='/telegram', secret_token='s3cret', host='127.0.0.1', port=0)
+    await server.start()
+    statuses = await telegram.post_updates(f"http://127.0.0.1:{server.port}/telegram",
+                                           [message_update(200, 1, "1"), message_update(201, 9, "9"),
+                                            message_update(202, 2, "2")], connections=3, secret_token='s3cret')
+    assert statuses == [200] * 3
+    
+    async def others_finished():
+        while len(finished) < 2:
+            await asyncio.sleep(0.01)
+    
+    await asyncio.wait_for(others_finished(), 5)
+    assert sorted(finished) == [2, 9] and server.in_flight == 1
+    slow.set()
+    await server.stop()
+    assert finished[-1] == 1
+    await application.shutdown()
+    print("✅ Долгое обновление одного пользователя не задерживает других")
+    
+    # Переполненная очередь отвечает 503, Telegram повторит доставку: в работе одно обновление, два ждут
+    release.clear()
+    application = telegram.build_application(UserOrderedUpdateProcessor(concurrency=1, max_pending=1))
+    application.add_handler(MessageHandler(filters.TEXT, on_text))
+    await application.initialize()
+    server = WebhookServer(application, path='/telegram', secret_token='', host='127.0.0.1',
+                           port=0, queue_size=2)
+    await server.start()
+    statuses = await telegram.post_updates(f"http://127.0.0.1:{server.port}/telegram",
+                                           [message_update(100 + i, 9, str(i)) for i in range(6)], connections=1)
+    assert statuses.count(503) >= 3 and server.rejected == statuses.count(503), (statuses, server.rejected)
+    release.set()
+    await server.stop()
+    assert server.processed == server.accepted == statuses.count(200)
+    print("✅ Ограниченная очередь: лишние обновления получают 503")
+    await application.shutdown()
+    
+    # run_bot в обоих режимах на одном и том же Application
+    for mode in ('polling', 'webhook'):
+        handled.clear()
+        application = telegram.build_application()
+        application.add_handler(MessageHandler(filters.TEXT, on_text))
+        stop = asyncio.Event()
+        server = WebhookServer(application, host='127.0.0.1', port=0, secret_token='s3cret')
+        if mode == 'polling':
+            telegram.add_updates([message_update(1000 + i, 1, str(i)) for i in range(5)])
+        runner = asyncio.create_task(run_bot(application, mode, 'https://bot.example.com', server, stop))
+        if mode == 'webhook':
+            while server._server is None:
+                await asyncio.sleep(0.01)
+            await telegram.post_updates(f"http://127.0.0.1:{server.port}{server.path}",
+                                        [message_update(2000 + i, 1, str(i)) for i in range(5)], connections=2,
+                                        secret_token='s3cret')
+        while len(handled) < 5:
+            await asyncio.sleep(0.01)
+        stop.set()
+        await runner
+        assert [text for _, text in handled] == list(range(5))
+    assert telegram.webhook_url == 'https://bot.example.com' + server.path
+    
+    # Без секрета webhook не запускается
+    application = telegram.build_application()
+    try:
+        await run_bot(application, 'webhook', 'https://bot.example.com',
+                      WebhookServer(application, secret_token=''), asyncio.Event())
+        assert False, "webhook запущен без секрета"
+    except ValueError:
+        pass
+    await telegram.stop()
+    print("✅ run_bot принимает обновления в режимах polling и webhook")
+    
+    print("✅ Все тесты webhook пройдены!\n")
+
+async def test_update_processor():
+    """Тестирование параллельной обработки обновлений с порядком внутри пользователя"""
+    print("🔀 Тестирование параллельной обработки обновлений...")
+    
+    # Пользователь, приславший много обновлений, занимает одно место обработчика
+    processor = UserOrderedUpdateProcessor(concurrency=2, max_pending=100)
+    log = []
+    
+    async def handle(user_id, index):
+        await asyncio.sleep(0.02)
+        log.append((user_id, index))
+    
+    updates = [(Update.de_json(message_update(i, 1, str(i)), None), 1, i) for i in range(6)]
+    updates.append((Update.de_json(message_update(6, 2, "0"), None), 2, 0))
+    await asyncio.gather(*(processor.process_update(update, handle(user_id, index))
+                           for update, user_id, index in updates))
+    assert [entry for entry in log if entry[0] == 1] == [(1, i) for i in range(6)]
+    assert log.index((2, 0)) <= 1
+    assert len(processor._users) == 0
+    assert update_key(updates[0][0]) == 1 and update_key(object()) is None
+    print("✅ Обновления пользователя по порядку, ожидание очереди не занимает обработчик")
+    
+    lock = KeyedLock()
+    async with lock.hold('a'):
+        assert len(lock) == 1
+    assert len(lock) == 0
+    
+    # Сумма и описание, присланные подряд, через настоящие обработчики диалога
+    users = range(1, 11)
+    
+    async def run_dialogs(update_processor, together: int = 1) -> Tuple[int, int, list]:
+        """(сохранено операций, наибольшее число одновременных обработчиков, порядок начала обработки)
+        
+        Обработчики ждут, пока одновременно не начнется together обновлений.
+        """
+        telegram = FakeTelegram(latency=0.05)
+        await telegram.start()
+        with tempfile.TemporaryDirectory() as tmp:
+            async_db = AsyncDatabase(Database(os.path.join(tmp, 'ordering.db')))
+            store = ConversationStore(async_db)
+            handlers = BotHandlers(async_db, None, None, store)
+            active = peak = 0
+            started = []
+            gathered = asyncio.Event()
+            
+            async def handle(update, context):
+                nonlocal active, peak
+                active += 1
+                peak = max(peak, active)
+                started.append((update.effective_user.id, update.message.text))
+                if active >= together:
+                    gathered.set()
+                try:
+                    await gathered.wait()
+                    await handlers.handle_text_input(update, context)
+                finally:
+                    active -= 1
+            
+            application = telegram.build_application(update_processor)
+            application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle))
+            for user_id in users:
+                await store.save(user_id, ConversationState('expense', "🚌 Транспорт"))
+                telegram.add_updates([message_update(user_id * 2, user_id, "150"),
+                                      message_update(user_id * 2 + 1, user_id, "Такси")])
+            
+            async def all_replied():
+                while len(telegram.sent) < 2 * len(users):
+                    await asyncio.sleep(0.01)
+            
+            stop = asyncio.Event()
+            runner = asyncio.create_task(run_bot(application, 'polling', stop=stop))
+            await asyncio.wait_for(all_replied(), 30)
+            stop.set()
+            await runner
+            
+            saved = 0
+            for user_id in users:
+                saved += sum(trans['description'] == "Такси" for trans in await async_db.get_transactions(user_id, 10))
+            async_db.close()
+        await telegram.stop()
+        return saved, peak, started
+    
+    saved, peak, _ = await run_dialogs(SimpleUpdateProcessor(1))
+    assert saved == len(users) and peak == 1
+    # Первые обновления всех 10 пользователей обрабатываются одновременно, вторые ждут своей очереди
+    saved, peak, started = await run_dialogs(UserOrderedUpdateProcessor(), together=len(users))
+    assert saved == len(users)
+    assert peak == len(users), peak
+    for user_id in users:
+        assert [text for user, text in started if user == user_id] == ["150", "Такси"]
+    print(f"✅ 10 диалогов: {peak} обработчиков одновременно, ни одно описание не принято за сумму")
+    
+    # Без очереди по пользователям описание читает шаг диалога раньше, чем сохранена сумма
+    saved, _, _ = await run_dialogs(SimpleUpdateProcessor(32))
+    assert saved < len(users)
+    print(f"✅ Без очереди по пользователям сохранено {saved} из {len(users)} операций - гонка воспроизводится")
+    
+    print("✅ Все тесты параллельной обработки пройдены!\n")
+
 async def test_config():
     """Тестирование конфигурации"""
     print("⚙️ Тестирование конфигурации...")
@@ -97,6 +1745,30 @@ async def main():
     
     await test_config()
     await test_database()
+    await test_connection_pool()
+    await test_migrations()
+    await test_balances()
+    await test_async_database()
+    await test_write_queue()
+    await test_rollups()
+    await test_period_totals()
+    await test_global_stats()
+    await test_analytics_engine()
+    await test_text_analytics()
+    await test_conversations()
+    await test_achievements()
+    await test_callback_routing()
+    await test_pagination()
+    await test_import()
+    await test_export()
+    await test_chart_cache()
+    await test_render_pool()
+    await test_prerender()
+    await test_parallel_rendering()
+    await test_chart_profiles()
+    await test_chart_templates()
+    await test_webhook()
+    await test_update_processor()
     await test_analytics()
     
     print("🎉 Все тесты пройдены успешно!")
@@ -0,0 +1,185 @@
+"""
+Текстовая аналитика: полосы из блоков Unicode, спарклайны и выровненные таблицы
+"""
+
+import html
+import unicodedata
+from typing import List, Sequence
+from analytics_engine import AnalyticsEngine
+
+# Восьмые доли блока для полос и высоты столбиков для спарклайнов
+_BAR_EIGHTHS = ' ▏▎▍▌▋▊▉'
+_SPARK_LEVELS = '▁▂▃▄▅▆▇█'
+BAR_WIDTH = 12
+
+def display_width(text: str) -> int:
+    """Ширина строки в моноширинном шрифте: эмодзи и иероглифы занимают две клетки"""
+    width = 0
+    for char in text:
+        if unicodedata.combining(char) or char == '\ufe0f':
+            continue
+        width += 2 if unicodedata.east_asian_width(char) in ('W', 'F') else 1
+    return width
+
+def _pad(text: str, width: int) -> str:
+    """Дополнение пробелами справа до ширины width"""
+    return text + ' ' * max(width - display_width(text), 0)
+
+def _money(amount: float) -> str:
+    """12345.5 -> '12 346'"""
+    return f"{amount:,.0f}".replace(',', ' ')
+
+def bar(value: float, maximum: float, width: int = BAR_WIDTH) -> str:
+    """Горизонтальная полоса с точностью до восьмой доли символа"""
+    if maximum <= 0 or value <= 0:
+        return ''
+    eighths = round(value / maximum * width * 8)
+    full, rest = divmod(eighths, 8)
+    return '█' * full + (_BAR_EIGHTHS[rest] if rest else '')
+
+def sparkline(values: Sequence[float]) -> str:
+    """Спарклайн ряда значений: минимум - '▁', максимум - '█'"""
+    if not values:
+        return ''
+    low, high = min(values), max(values)
+    if high == low:
+        return _SPARK_LEVELS[0] * len(values)
+    scale = (len(_SPARK_LEVELS) - 1) / (high - low)
+    return ''.join(_SPARK_LEVELS[round((value - low) * scale)] for value in values)
+
+def _table(rows: List[List[str]], align_right: Sequence[bool]) -> str:
+    """Таблица с колонками, выровненными по ширине в моноширинном шрифте"""
+    widths = [max(display_width(row[i]) for row in rows) for i in range(len(align_right))]
+    lines = []
+    for row in rows:
+        cells = []
+        for cell, width, right in zip(row, widths, align_right):
+            padding = ' ' * (width - display_width(cell))
+            cells.append(padding + cell if right else cell + padding)
+        lines.append('  '.join(cells).rstrip())
+    return '\n'.join(lines)
+
+def _pre(text: str) -> str:
+    """Моноширинный блок для parse_mode=HTML"""
+    return f"<pre>{html.escape(text)}</pre>"
+
+class TextAnalytics:
+    """Те же четыре вида аналитики, что и графики, но текстом за миллисекунды
+
+    Данные берутся из AnalyticsEngine - тех же агрегатов, по которым строятся
+    графики; matplotlib и Pillow не нужны. Результат - HTML для Telegram.
+    """
+
+    def __init__(self, engine: AnalyticsEngine):
+        self.engine = engine
+        self.db = engine.db
+        self.views = {
+            'expenses': self.expenses,
+            'income_vs_expense': self.income_vs_expense,
+            'goals': self.goals,
+            'trends': self.trends,
+        }
+
+    def render(self, view: str, user_id: int) -> str:
+        """Текстовый отчет по имени вида из меню аналитики"""
+        return self.views[view](user_id)
+
+    def expenses(self, user_id: int, days: int = 30) -> str:
+        """Расходы по категориям"""
+        categories = self.engine.datasets(user_id, days=days)['categories']
+        if not categories:
+            return "📊 Нет данных о расходах"
+
+        total = sum(amount for _, amount in categories)
+        largest = categories[0][1]
+        rows = [[category, bar(amount, largest), _money(amount), f"{amount / total * 100:.1f}%"]
+                for category, amount in categories]
+        rows.append(['Итого', '', _money(total), ''])
+        return (f"📊 <b>Расходы по категориям за {days} дней</b>, руб.\n"
+                + _pre(_table(rows, (False, False, True, True))))
+
+    def income_vs_expense(self, user_id: int, days: int = 30) -> str:
+        """Доходы и расходы по дням"""
+        datasets = self.engine.datasets(user_id, days=days)
+        daily = datasets['daily']
+        if not daily:
+            return f"📈 Нет данных за последние {days} дней"
+
+        income, expense, savings = datasets['totals']
+        largest = max(income, expense)
+        rows = [
+            ['Доходы', bar(income, largest), _money(income)],
+            ['Расходы', bar(expense, largest), _money(expense)],
+            ['Разница', '', ('+' if savings > 0 else '') + _money(savings)],
+        ]
+        lines = [
+            _table(rows, (False, False, True)),
+            '',
+            f"Доходы   {sparkline([day[1] for day in daily])}",
+            f"Расходы  {sparkline([day[2] for day in daily])}",
+            f"         {daily[0][0][5:]} … {daily[-1][0][5:]}",
+        ]
+        return f"📈 <b>Доходы vs Расходы за {days} дней</b>, руб.\n" + _pre('\n'.join(lines))
+
+    def goals(self, user_id: int) -> str:
+        """Прогресс накоплений по активным целям"""
+        goals = self.db.get_user_goals(user_id)
+        if not goals:
+            return "🎯 У вас нет активных целей"
+        active_goals = [goal for goal in goals if not goal['is_completed']]
+        if not active_goals:
+            return "🎯 Все цели достигнуты! 🎉"
+
+        rows = []
+        for goal in active_goals:
+            target = goal['target_amount'] or 0
+            share = goal['current_amount'] / target if target > 0 else 0
+            progress = _pad(bar(min(share, 1), 1), BAR_WIDTH).replace(' ', '░')
+            rows.append([goal['title'], progress, f"{share * 100:.1f}%",
+                         f"{_money(goal['current_amount'])} / {_money(target)}"])
+        return "🎯 <b>Прогресс накоплений</b>, руб.\n" + _pre(_table(rows, (False, False, True, True)))
+
+    def trends(self, user_id: int, months: int = 6) -> str:
+        """Доходы, расходы и накопления по месяцам"""
+        monthly = self.engine.datasets(user_id, months=max(months, 2))['monthly']
+        if len(monthly) < 2:
+            return "📊 Недостаточно данных для анализа трендов"
+        monthly = monthly[-months:]
+
+        rows = [['Месяц', 'Доходы', 'Расходы', 'Накопления']]
+        for month, income, expense, savings in monthly:
+            rows.append([month, _money(income), _money(expense),
+                         ('+' if savings > 0 else '') + _money(savings)])
+        lines = [
+            _table(rows, (False, True, True, True)),
+            '',
+            f"Накопления  {sparkline([row[3] for row in monthly])}",
+        ]
+        return f"📊 <b>Месячные тренды за {len(monthly)} мес.</b>, руб.\n" + _pre('\n'.join(lines))
+
+def admin_report(stats: dict) -> str:
+    """Отчет /admin_stats по результату Database.get_global_stats"""
+    days = stats['days']
+    rows = [['Пользователи', _money(stats['users'])],
+            [f'Новых за {days} дн.', _money(stats['new_users'])]]
+    rows += [[f'Активны за {window} дн.', _money(count)] for window, count in stats['active'].items()]
+    rows += [[f'Операций за {days} дн.', _money(stats['transactions'])],
+             ['Доходы, руб.', _money(stats['income'])],
+             ['Расходы, руб.', _money(stats['expense'])]]
+    text = "👑 <b>Статистика бота</b>\n" + _pre(_table(rows, (False, True)))
+
+    if stats['top_categories']:
+        largest = stats['top_categories'][0][1]
+        rows = [[category, bar(amount, largest), _money(amount), _money(count)]
+                for category, amount, count in stats['top_categories']]
+        text += (f"\n🏆 <b>Топ расходов за {days} дн.</b>, руб. и операций\n"
+                 + _pre(_table(rows, (False, False, True, True))))
+
+    weeks = max(len(shares) for _, _, shares in stats['retention'])
+    rows = [['Неделя', 'Новых'] + [f'+{offset}' for offset in range(1, weeks + 1)]]
+    for week, size, shares in stats['retention']:
+        rows.append([week[5:], _money(size)] + ['' if share is None else f"{share * 100:.0f}%" for share in shares]
+                    + [''] * (weeks - len(shares)))
+    text += ("\n📈 <b>Удержание по недельным когортам</b>\n"
+             + _pre(_table(rows, (False,) + (True,) * (weeks + 1))))
+    return text
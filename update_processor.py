@@ -0,0 +1,83 @@
+"""
+Параллельная обработка обновлений с сохранением порядка внутри пользователя
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Dict, Hashable, List, Optional
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+from config import CONCURRENT_UPDATES, MAX_PENDING_UPDATES
+
+def update_key(update: object) -> Optional[int]:
+    """Ключ очередности: пользователь, иначе чат; None - обновление ни к кому не привязано"""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user is not None:
+        return update.effective_user.id
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    return None
+
+class KeyedLock:
+    """Блокировка на ключ; запись удаляется, когда ключ никто не держит и не ждет
+
+    Ожидающие одного ключа получают блокировку в порядке вызова hold -
+    asyncio.Lock будит их по очереди.
+    """
+
+    def __init__(self):
+        self._locks: Dict[Hashable, List] = {}  # ключ -> [блокировка, держащие и ждущие]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def hold(self, key: Hashable):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Обновления разных пользователей обрабатываются параллельно, одного - строго по очереди
+
+    Долгий график одного пользователя больше не задерживает остальных, а шаги
+    диалога (сумма, затем описание) одного пользователя никогда не выполняются
+    одновременно и не меняются местами.
+
+    Семафор BaseUpdateProcessor ограничивает max_pending обновлений в работе
+    вместе с ожидающими своей очереди; одновременно выполняется не больше
+    concurrency обработчиков. Обновление, ждущее предыдущее того же
+    пользователя, место обработчика не занимает, поэтому один пользователь,
+    приславший много сообщений, не останавливает других.
+    """
+
+    def __init__(self, concurrency: int = CONCURRENT_UPDATES, max_pending: int = MAX_PENDING_UPDATES):
+        super().__init__(max(max_pending, concurrency))
+        self.concurrency = concurrency
+        self._slots = asyncio.Semaphore(concurrency)
+        self._users = KeyedLock()
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]):
+        key = update_key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+        async with self._users.hold(key):
+            async with self._slots:
+                await coroutine
+
+    async def initialize(self):
+        """Ресурсов не требует"""
+
+    async def shutdown(self):
+        """Ресурсов не требует"""
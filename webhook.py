@@ -0,0 +1,361 @@
+"""
+Прием обновлений Telegram: long polling или webhook в том же цикле событий
+"""
+
+import asyncio
+import json
+import logging
+import signal
+import time
+from http import HTTPStatus
+from typing import Dict, Optional, Set, Tuple
+from telegram import Update
+from telegram.ext import Application
+from config import (BOT_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT,
+                    WEBHOOK_QUEUE_SIZE, WEBHOOK_MAX_CONNECTIONS, WEBHOOK_MAX_CLIENT_CONNECTIONS,
+                    WEBHOOK_READ_TIMEOUT, WEBHOOK_IDLE_TIMEOUT)
+
+logger = logging.getLogger(__name__)
+
+# Обновление Telegram - несколько килобайт; больший запрос не разбирается
+MAX_BODY_SIZE = 1024 * 1024
+
+class BadRequest(Exception):
+    """Запрос не разобран: клиент получает status, соединение закрывается"""
+
+    def __init__(self, status: int = HTTPStatus.BAD_REQUEST):
+        super().__init__(HTTPStatus(status).phrase)
+        self.status = status
+
+async def read_head(reader: asyncio.StreamReader, idle_timeout: float = None,
+                    read_timeout: float = None) -> Optional[Tuple[str, str, str, Dict[str, str]]]:
+    """(метод, путь, версия HTTP, заголовки) или None, если соединение закрыто
+
+    None и тогда, когда следующий запрос не начался за idle_timeout секунд.
+    Имена заголовков приводятся к нижнему регистру. Некорректная строка
+    запроса - BadRequest, заголовки не дочитаны за read_timeout - BadRequest(408).
+    """
+    try:
+        start = await asyncio.wait_for(reader.readexactly(1), idle_timeout)
+    except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+        return None
+    try:
+        head = start + await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), read_timeout)
+    except asyncio.TimeoutError:
+        raise BadRequest(HTTPStatus.REQUEST_TIMEOUT)
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        return None
+
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, path, version = lines[0].split(' ', 2)
+    except ValueError:
+        raise BadRequest()
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        if value:
+            headers[name.strip().lower()] = value.strip()
+    return method, path, version, headers
+
+async def read_body(reader: asyncio.StreamReader, headers: Dict[str, str],
+                    read_timeout: float = None) -> Optional[bytes]:
+    """Тело запроса по Content-Length или None, если соединение закрыто
+
+    Некорректный Content-Length - BadRequest, тело не дочитано за
+    read_timeout - BadRequest(408).
+    """
+    try:
+        length = int(headers.get('content-length') or 0)
+    except ValueError:
+        raise BadRequest()
+    if length < 0:
+        raise BadRequest()
+    if length > MAX_BODY_SIZE:
+        raise BadRequest(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+    try:
+        return await asyncio.wait_for(reader.readexactly(length), read_timeout) if length else b''
+    except asyncio.TimeoutError:
+        raise BadRequest(HTTPStatus.REQUEST_TIMEOUT)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+
+async def read_request(reader: asyncio.StreamReader, idle_timeout: float = None,
+                       read_timeout: float = None) -> Optional[Tuple[str, str, str, Dict[str, str], bytes]]:
+    """(метод, путь, версия HTTP, заголовки, тело) или None, если соединение закрыто"""
+    head = await read_head(reader, idle_timeout, read_timeout)
+    if head is None:
+        return None
+    body = await read_body(reader, head[3], read_timeout)
+    if body is None:
+        return None
+    return (*head, body)
+
+def keep_alive(version: str, headers: Dict[str, str]) -> bool:
+    """HTTP/1.1 держит соединение открытым, если клиент не попросил закрыть"""
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.0':
+        return connection == 'keep-alive'
+    return connection != 'close'
+
+async def write_response(writer: asyncio.StreamWriter, status: int, body: bytes = b'',
+                         keep_open: bool = True, extra_headers: Dict[str, str] = None):
+    """Ответ HTTP/1.1 с JSON-телом"""
+    headers = {
+        'Content-Type': 'application/json',
+        'Content-Length': str(len(body)),
+        'Connection': 'keep-alive' if keep_open else 'close',
+        **(extra_headers or {}),
+    }
+    head = f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+    head += ''.join(f"{name}: {value}\r\n" for name, value in headers.items())
+    writer.write(head.encode('latin-1') + b'\r\n' + body)
+    await writer.drain()
+
+class WebhookServer:
+    """HTTP-сервер для setWebhook в цикле событий бота
+
+    Запрос Telegram только разбирается и кладется в ограниченную очередь -
+    ответ 200 уходит сразу, не дожидаясь обработчиков. Задача-диспетчер
+    запускает для каждого обновления отдельную задачу с update_processor
+    приложения, как это делает long polling: обновления разных
+    пользователей обрабатываются параллельно, а порядок внутри пользователя
+    держит UserOrderedUpdateProcessor.
+
+    В работе одновременно не больше max_concurrent_updates обработчика
+    update_processor, остальные ждут в очереди. Когда заполнена и она,
+    Telegram получает 503 и повторит доставку позже - память не растет под
+    пиковой нагрузкой. Здесь же отвечают проверки здоровья / и /health.
+
+    Соединение не держится дольше read_timeout на заголовках или теле и
+    дольше idle_timeout между запросами; открытых соединений не больше
+    max_connections. Секретный заголовок сверяется до чтения тела.
+    """
+
+    def __init__(self, application: Application, path: str = WEBHOOK_PATH, secret_token: str = WEBHOOK_SECRET,
+                 host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT, queue_size: int = WEBHOOK_QUEUE_SIZE,
+                 read_timeout: float = WEBHOOK_READ_TIMEOUT, idle_timeout: float = WEBHOOK_IDLE_TIMEOUT,
+                 max_connections: int = WEBHOOK_MAX_CLIENT_CONNECTIONS):
+        self.application = application
+        self.path = path
+        self.secret_token = secret_token
+        self.host = host
+        self.port = port
+        self.read_timeout = read_timeout
+        self.idle_timeout = idle_timeout
+        self.max_connections = max_connections
+        self._queue = asyncio.Queue(queue_size)
+        # Столько же, сколько пропускает семафор update_processor: он никогда не ждет
+        self._in_flight = asyncio.Semaphore(application.update_processor.max_concurrent_updates)
+        self._server = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._connections = set()
+
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+
+    @property
+    def queued(self) -> int:
+        """Принятые, но еще не обработанные обновления"""
+        return self._queue.qsize() + len(self._tasks)
+
+    @property
+    def in_flight(self) -> int:
+        """Обновления, переданные в update_processor"""
+        return len(self._tasks)
+
+    async def start(self):
+        """Запуск сервера и диспетчера; port=0 выбирает свободный порт"""
+        self._dispatcher = asyncio.create_task(self._dispatch())
+        self._server = await asyncio.start_server(self._serve_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Webhook слушает {self.host}:{self.port}{self.path}")
+
+    async def stop(self):
+        """Остановка приема; уже принятые обновления обрабатываются до конца"""
+        self._server.close()
+        for writer in list(self._connections):
+            writer.close()
+        await self._server.wait_closed()
+        await self._queue.join()
+        self._dispatcher.cancel()
+        await asyncio.gather(self._dispatcher, return_exceptions=True)
+
+    async def _serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Соединение Telegram держится открытым и несет много запросов подряд"""
+        if len(self._connections) >= self.max_connections:
+            # Запросы лишнего соединения не разбираются: 503 и закрытие
+            try:
+                await self._reject(reader, writer, 503, {'Retry-After': '1'})
+            except ConnectionError:
+                pass
+            writer.close()
+            return
+
+        self._connections.add(writer)
+        try:
+            while True:
+                try:
+                    head = await read_head(reader, self.idle_timeout, self.read_timeout)
+                    if head is None:
+                        break
+                    method, path, version, headers = head
+                    # Чужой запрос отклоняется по заголовкам, его тело не читается и не занимает память
+                    if method == 'POST' and path == self.path and not self._authorized(headers):
+                        await self._reject(reader, writer, 403)
+                        break
+                    body = await read_body(reader, headers, self.read_timeout)
+                except BadRequest as e:
+                    # Границы следующего запроса неизвестны - соединение дальше не разбирается
+                    await self._reject(reader, writer, e.status)
+                    break
+                if body is None:
+                    break
+                status, response, extra_headers = self._route(method, path, body)
+                keep_open = keep_alive(version, headers)
+                await write_response(writer, status, response, keep_open, extra_headers)
+                if not keep_open:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    async def _reject(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, status: int,
+                      extra_headers: Dict[str, str] = None):
+        """Ответ с закрытием соединения; остаток запроса отбрасывается не дольше read_timeout
+
+        Сокет, закрытый с непрочитанными данными, отправляет клиенту RST,
+        и ответ может до него не дойти.
+        """
+        await write_response(writer, status, keep_open=False, extra_headers=extra_headers)
+        if writer.can_write_eof():
+            writer.write_eof()
+        try:
+            await asyncio.wait_for(self._discard(reader), self.read_timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    @staticmethod
+    async def _discard(reader: asyncio.StreamReader):
+        """Чтение до конца потока без сохранения"""
+        while await reader.read(64 * 1024):
+            pass
+
+    def _route(self, method: str, path: str, body: bytes) -> Tuple[int, bytes, Optional[Dict[str, str]]]:
+        """(статус, тело ответа, дополнительные заголовки)"""
+        if method == 'POST' and path == self.path:
+            return self._accept(body)
+        if method == 'GET' and path == '/':
+            return 200, json.dumps({
+                "status": "healthy",
+                "service": "Telegram Finance Bot",
+                "timestamp": time.time()
+            }).encode(), None
+        if method == 'GET' and path == '/health':
+            return 200, json.dumps({"status": "ok", "queued": self.queued}).encode(), None
+        return 404, b'', None
+
+    def _authorized(self, headers: Dict[str, str]) -> bool:
+        """Заголовок X-Telegram-Bot-Api-Secret-Token совпадает с секретом из setWebhook"""
+        return not self.secret_token or headers.get('x-telegram-bot-api-secret-token') == self.secret_token
+
+    def _accept(self, body: bytes) -> Tuple[int, bytes, Optional[Dict[str, str]]]:
+        """Разбор обновления и постановка в очередь без ожидания обработки"""
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return 400, b'', None
+        # update_id нужен для очереди и журнала; запрос доступен любому, кто знает адрес
+        if not isinstance(data, dict) or type(data.get('update_id')) is not int:
+            return 400, b'', None
+        try:
+            update = Update.de_json(data, self.application.bot)
+        except Exception:
+            logger.debug("Некорректное обновление", exc_info=True)
+            return 400, b'', None
+        if update is None:
+            return 400, b'', None
+
+        try:
+            self._queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return 503, b'', {'Retry-After': '1'}
+        self.accepted += 1
+        return 200, b'', None
+
+    async def _dispatch(self):
+        """Обновления из очереди по порядку поступления -> задачи обработки
+
+        Задачи стартуют в порядке создания, а блокировка пользователя в
+        UserOrderedUpdateProcessor выдается в порядке запроса, поэтому
+        обновления одного пользователя не обгоняют друг друга.
+        """
+        while True:
+            # Место занимается до выборки: обновление, ждущее места, остается в очереди и учитывается в ее размере
+            await self._in_flight.acquire()
+            update = await self._queue.get()
+            task = asyncio.create_task(self._process(update))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, update: Update):
+        """Обработка одного обновления"""
+        try:
+            await self.application.update_processor.process_update(
+                update, self.application.process_update(update))
+        except Exception:
+            logger.exception(f"Ошибка обработки обновления {update.update_id}")
+        finally:
+            self._in_flight.release()
+            self.processed += 1
+            self._queue.task_done()
+
+async def run_bot(application: Application, mode: str = BOT_MODE, webhook_url: str = WEBHOOK_URL,
+                  server: WebhookServer = None, stop: asyncio.Event = None):
+    """Прием обновлений в режиме mode ('polling' или 'webhook') до SIGINT/SIGTERM или события stop"""
+    if mode not in ('polling', 'webhook'):
+        raise ValueError(f"Неизвестный режим приема обновлений: {mode}")
+    if mode == 'webhook' and not webhook_url:
+        raise ValueError("Для режима webhook нужен WEBHOOK_URL")
+    if mode == 'webhook':
+        server = server or WebhookServer(application)
+        # Без секрета обновления от имени Telegram может прислать кто угодно
+        if not server.secret_token:
+            raise ValueError("Для режима webhook нужен WEBHOOK_SECRET")
+
+    if stop is None:
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except (NotImplementedError, RuntimeError):
+                pass  # Windows: остановка по KeyboardInterrupt
+
+    async with application:
+        await application.start()
+        if mode == 'webhook':
+            await server.start()
+            await application.bot.set_webhook(
+                url=webhook_url.rstrip('/') + server.path,
+                secret_token=server.secret_token,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=WEBHOOK_MAX_CONNECTIONS
+            )
+        else:
+            await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        logger.info(f"Бот принимает обновления ({mode})")
+
+        try:
+            await stop.wait()
+        finally:
+            if mode == 'webhook':
+                await server.stop()
+            else:
+                await application.updater.stop()
+            await application.stop()